@@ -12,6 +12,7 @@ from util.loggers import CoreLog as cl, BackendLog as bl, SimulationLog as sl
 from util.greet import greeting
 
 import modules.start_tasks as start_tasks
+from modules.change_feed import CONTROL_OBJECT
 
 def parse_commandline():
     """
@@ -48,6 +49,72 @@ def parse_commandline():
         "-s", "--simulation_port", type=int, default=8010,
         help="The port on which the simulation can connect"
     )
+    parser.add_argument(
+        "-i", "--index_snapshot",
+        default=str(
+            pathlib.Path(__file__).parent / ".indexsnapshot" / "index.pickle"),
+        help="File for persisting the index between runs"
+    )
+    parser.add_argument(
+        "--no_index_snapshot",
+        help="Do not load or write the index snapshot",
+        action="store_true",
+        default=False
+    )
+    parser.add_argument(
+        "--index_refresh_interval", type=int, default=300,
+        help="Seconds between comparing the index with the object names on "
+        "the cluster (0 disables refreshing the index)"
+    )
+    parser.add_argument(
+        "--shm_slots", type=int, default=16,
+        help="Number of shared memory slots for object data (0 disables "
+        "shared memory)"
+    )
+    parser.add_argument(
+        "--shm_slot_size", type=int, default=16,
+        help="Size of a shared memory slot in MiB, larger objects are sent "
+        "through the queues"
+    )
+    parser.add_argument(
+        "--cache_size", type=int, default=1024,
+        help="Size of the cache for objects from the cluster in MiB"
+    )
+    parser.add_argument(
+        "-d", "--disk_cache",
+        default=str(pathlib.Path(__file__).parent / ".diskcache"),
+        help="Directory for caching objects from the cluster on disk"
+    )
+    parser.add_argument(
+        "--disk_cache_size", type=int, default=10240,
+        help="Size of the disk cache in MiB"
+    )
+    parser.add_argument(
+        "--no_disk_cache",
+        help="Do not cache objects on disk",
+        action="store_true",
+        default=False
+    )
+    parser.add_argument(
+        "--min_connections", type=int, default=2,
+        help="Smallest number of connections to the ceph cluster"
+    )
+    parser.add_argument(
+        "--max_connections", type=int, default=12,
+        help="Largest number of connections to the ceph cluster, more are "
+        "opened while there is a lot to do"
+    )
+    parser.add_argument(
+        "--change_feed",
+        help="Follow the changes that writers publish on the cluster",
+        action="store_true",
+        default=False
+    )
+    parser.add_argument(
+        "--change_feed_object", default=CONTROL_OBJECT,
+        help="Object in the default namespace of the pool that keeps the "
+        "published changes"
+    )
     parser.add_argument(
         "-l", "--log",
         help="Set the logging level",
@@ -61,6 +128,70 @@ def parse_commandline():
         default=False
     )
 
+    subparsers = parser.add_subparsers(
+        dest="command",
+        help="Run a maintenance task instead of the gateway"
+    )
+
+    backfill_parser = subparsers.add_parser(
+        "backfill",
+        help="Calculate and write missing sha1sums of the objects",
+        description="Calculate and write the sha1sums of all objects that "
+        "do not have one yet.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    backfill_parser.add_argument(
+        "-n", "--namespace", action="append",
+        help="Only backfill this namespace (can be given several times, "
+        "default is every namespace)"
+    )
+    backfill_parser.add_argument(
+        "-w", "--workers", type=int, default=8,
+        help="Number of objects that are hashed at the same time"
+    )
+    backfill_parser.add_argument(
+        "--max_rate", type=float, default=0,
+        help="Maximum read rate in MiB/s (0 for no limit)"
+    )
+    backfill_parser.add_argument(
+        "--progress_file",
+        default=str(
+            pathlib.Path(__file__).parent / ".backfill" / "progress.jsonl"),
+        help="File for continuing an interrupted backfill"
+    )
+    backfill_parser.add_argument(
+        "--restart",
+        help="Ignore the progress of an interrupted backfill",
+        action="store_true",
+        default=False
+    )
+
+    publish_parser = subparsers.add_parser(
+        "publish",
+        help="Publish a new or removed file to the change feed",
+        description="Tell the gateways that follow the change feed about a "
+        "file that has been added to or removed from the cluster.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    publish_parser.add_argument(
+        "-n", "--namespace", required=True,
+        help="Namespace of the file"
+    )
+    publish_parser.add_argument(
+        "-k", "--key", required=True,
+        help="Name of the file"
+    )
+    publish_parser.add_argument(
+        "-s", "--sha1sum", default="",
+        help="sha1sum of the file, read from the cluster if not given"
+    )
+    publish_parser.add_argument(
+        "--removed",
+        help="The file has been removed",
+        action="store_true",
+        default=False
+    )
+
     args = parser.parse_args()
     return args
 
@@ -100,4 +231,9 @@ if __name__ == "__main__":
         perform_unittests()
     greet()
     setup_logging(args.log)
-    start_tasks.start_tasks(args)
+    if args.command == "backfill":
+        start_tasks.start_backfill(args)
+    elif args.command == "publish":
+        start_tasks.start_publish(args)
+    else:
+        start_tasks.start_tasks(args)
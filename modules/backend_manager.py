@@ -10,14 +10,20 @@ import queue
 import base64
 import struct
 import asyncio
+import hashlib
 import functools
 import threading
+import collections
+import concurrent.futures
 import multiprocessing
 from contextlib import suppress
 
 
 from util.loggers import CoreLog as cl, BackendLog as bl, SimulationLog as sl
 
+from modules.object_cache import ObjectCache
+from modules.disk_cache import DiskCache
+
 
 class BackendManager(object):
     def __init__(self,
@@ -28,7 +34,12 @@ class BackendManager(object):
                  index_data_queue,
                  file_name_request_server_queue,
                  file_content_name_hash_server_queue,
-                 shutdown_backend_manager_event
+                 shutdown_backend_manager_event,
+                 buffer_pool=None,
+                 cache_size=1024 * 1024 * 1024,
+                 disk_cache_directory=None,
+                 disk_cache_size=10 * 1024 * 1024 * 1024,
+                 index_query_queue=None
     ):
         bl.info("BackendManager init: {}:{}".format(host, port))
         self._host = host
@@ -38,10 +49,16 @@ class BackendManager(object):
         self._new_file_send_queue = new_file_send_queue
         self._get_index_server_event = get_index_server_event
         self._index_data_queue = index_data_queue
+        # queries for parts of the index go to the local data copy through
+        # this queue, without it the whole index is always requested
+        self._index_query_queue = index_query_queue
         self._file_name_request_server_queue = file_name_request_server_queue
         self._file_content_name_hash_server_queue = file_content_name_hash_server_queue
         self._shutdown_backend_manager_event = shutdown_backend_manager_event
 
+        # object contents might arrive in shared memory
+        self._buffer_pool = buffer_pool
+
         # create a server
         self._loop = asyncio.get_event_loop()
         self._coro = asyncio.start_server(
@@ -55,16 +72,68 @@ class BackendManager(object):
         self._file_requests_connection_active = False
         self._file_answers_connection_active = False
 
-        # download data from the ceph manager and store it in a dictionary
-        #
-        self._ceph_data_dict = dict()
+        # download data from the ceph manager and keep it in a cache that is
+        # bounded by cache_size bytes; cached objects are copied out of shared
+        # memory, the shared memory of a range is released once no download
+        # is sending it anymore
+        self._object_cache = ObjectCache(
+            cache_size, release_callback=self._release_ceph_data)
+        # seconds between logging the cache statistics
+        self._cache_statistics_interval = 60
+
+        # objects are also kept on the local disk under their sha1sum, so they
+        # survive restarts; to find them there we keep track of the sha1sum of
+        # every namespace/key we hear of (index, new files, downloads)
+        if disk_cache_directory is not None:
+            self._disk_cache = DiskCache(disk_cache_directory, disk_cache_size)
+        else:
+            self._disk_cache = None
+        # reading and writing the disk cache has threads of its own, so
+        # neither the event loop nor the objects arriving from the ceph
+        # manager wait for the disk
+        self._disk_cache_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=2)
+        self._object_hashes = dict()
         # we need a threading lock and not a asyncio lock because we use them in
         # an executor (extra tread)
         self._ceph_data_lock = threading.Lock()
 
+        # futures of download requests that wait for an object from the ceph
+        # manager, resolved by the ceph data executor as soon as the object
+        # arrives; also guarded by the ceph data lock
+        self._ceph_data_waiters = dict()
+
+        # time at which an object was requested from the ceph manager, for
+        # every object that has not arrived yet; concurrent downloads of the
+        # same object only wait for the one read that is already on its way
+        # (also guarded by the ceph data lock)
+        self._ceph_data_requests_in_flight = dict()
+
+        # large objects arrive from the ceph manager in pieces; the object
+        # that is being assembled and its cache entry, for every namespace/key
+        # (also guarded by the ceph data lock)
+        self._ceph_data_streams = dict()
+
+        # seconds to wait for an object from the ceph cluster
+        self._file_download_timeout = 10
+
+        # size of the raw chunks when sending file contents in binary frames
+        self._binary_frame_chunk_size = 1024 * 1024  # 1 MiB
+
+        # framing of the connections that switched to the pipelined mode
+        # during the handshake, keyed by the writer of the connection
+        self._connection_framing = dict()
+        # pipelined messages are prefixed with a fixed width length
+        self._pipelined_length_format = "!Q"
+        self._pipelined_length_size = struct.calcsize(
+            self._pipelined_length_format)
+        # the data of the frame that acknowledges an ack window, it is not
+        # JSON so it can not be mistaken for a message
+        self._pipelined_ack = "ack".encode()
+
         ceph_data_task = self._loop.create_task(self._ceph_data_coro())
-        perdiodically_delete_ceph_data_task = self._loop.create_task(
-            self._periodic_ceph_file_deletion_coro())
+        cache_statistics_task = self._loop.create_task(
+            self._periodic_cache_statistics_coro())
 
         # manage the queue cleanup when there are no active connections
         queue_cleanup_task = self._loop.create_task(self._queue_cleanup_coro())
@@ -125,6 +194,9 @@ class BackendManager(object):
         bl.info("Connection from port {} is tasked with {}".format(
             p_port, task))
 
+        # everything after the handshake might use the pipelined framing
+        self._setup_connection_framing(writer, task_dict)
+
         try:
 
             # watch the connection
@@ -173,8 +245,12 @@ class BackendManager(object):
             # manage requests for file data from the ceph cluster
             if task == "file_download":
 
+                # clients that can handle raw file contents ask for it in the
+                # handshake, everyone else gets the base64 encoded contents
+                binary_frames = bool(task_dict.get("binary_frames", False))
+
                 self.file_download_task = self._loop.create_task(
-                    self._file_download_coro(reader, writer))
+                    self._file_download_coro(reader, writer, binary_frames))
                 # optional?
                 await self.file_download_task
 
@@ -183,6 +259,7 @@ class BackendManager(object):
             raise
 
         finally:
+            self._connection_framing.pop(writer, None)
             writer.close()
 
 
@@ -243,9 +320,11 @@ class BackendManager(object):
 
             if not self._new_file_connection_active:
                 try:
-                    self._new_file_send_queue.get(False)
+                    new_file = self._new_file_send_queue.get(False)
                 except queue.Empty:
                     pass
+                else:
+                    self._invalidate_cached_file(new_file)
 
             if not self._index_connection_active:
                 self._get_index_server_event.clear()
@@ -290,54 +369,483 @@ class BackendManager(object):
                 obj_namespace = request_dict["namespace"]
 
                 object_descriptor = "{}/{}".format(obj_namespace, obj_key)
-                bl.debug("Reading {} and making available".format(
-                    object_descriptor))
 
-                occurence_key = object_descriptor
-                occurence_dict = {
-                    "timestamp": time.time(),
-                    "request_dict": request_dict
-                }
+                if request_dict.get("error", False):
+                    self._receive_object_error(object_descriptor, request_dict)
+                elif "range" in request_dict:
+                    self._receive_object_range(object_descriptor, request_dict)
+                elif "offset" in request_dict:
+                    self._receive_object_piece(object_descriptor, request_dict)
+                else:
+                    self._receive_object(object_descriptor, request_dict)
+
+    def _request_descriptor(self, object_descriptor, byte_range=None):
+        """
+        Return the key for waiters and requests in flight.
+
+        """
+        if byte_range is None:
+            return object_descriptor
+        return "{}@{}+{}".format(
+            object_descriptor, byte_range["offset"], byte_range["length"])
+
+    def _make_object_available(
+            self, object_descriptor, request_dict, byte_range=None):
+        """
+        Hand an object (or a range of it) to everyone waiting for it.
+
+        Complete objects are put into the object cache, ranges are not. Returns
+        the entry, which is pinned once for the caller.
 
-                with self._ceph_data_lock:
-                    self._ceph_data_dict[occurence_key] = occurence_dict
+        """
+        request_descriptor = self._request_descriptor(
+            object_descriptor, byte_range)
+
+        if byte_range is None:
+            request_dict = self._copy_out_of_shared_memory(request_dict)
+
+        bl.debug("Reading {} and making available".format(request_descriptor))
+
+        with self._ceph_data_lock:
+            waiters = self._ceph_data_waiters.pop(request_descriptor, [])
+            self._ceph_data_requests_in_flight.pop(request_descriptor, None)
+
+            # every waiter holds on to the entry until it is sent
+            if byte_range is None:
+                occurence_dict = self._object_cache.put(
+                    object_descriptor, request_dict, pins=len(waiters) + 1)
+            else:
+                occurence_dict = self._object_cache.uncached(
+                    request_dict, pins=len(waiters) + 1)
+
+        # wake up everyone who is waiting for this object
+        for waiter in waiters:
+            self._loop.call_soon_threadsafe(
+                self._resolve_ceph_data_waiter, waiter, occurence_dict)
+
+        return occurence_dict
 
-    async def _periodic_ceph_file_deletion_coro(self):
+    def _receive_object(self, object_descriptor, request_dict):
         """
-        Periodically delete old data in the ceph data dictionary.
+        A complete object arrived from the ceph manager.
 
-        The starter.
+        """
+        occurence_dict = self._make_object_available(
+            object_descriptor, request_dict)
+
+        # keep a copy on disk, the extra pin keeps the contents valid until
+        # they are written
+        self._store_in_disk_cache(object_descriptor, occurence_dict)
 
+    def _receive_object_error(self, object_descriptor, request_dict):
         """
-        file_deletion = await self._loop.run_in_executor(
-            None, self._periodic_ceph_file_deletion_executor)
+        An object (or a range of it) could not be read by the ceph manager.
 
-    def _periodic_ceph_file_deletion_executor(self):
+        The downloads waiting for it fail right away instead of waiting for
+        the download timeout, the next download asks again.
+
+        """
+        byte_range = request_dict.get("range", None)
+        request_descriptor = self._request_descriptor(
+            object_descriptor, byte_range)
+
+        bl.warning("Could not get {} from ceph".format(request_descriptor))
+
+        with self._ceph_data_lock:
+            waiters = self._ceph_data_waiters.pop(request_descriptor, [])
+            self._ceph_data_requests_in_flight.pop(request_descriptor, None)
+
+            # a large object might have failed half way through
+            replaced = None
+            if byte_range is None:
+                replaced = self._ceph_data_streams.pop(object_descriptor, None)
+
+        for waiter in waiters:
+            self._loop.call_soon_threadsafe(
+                self._resolve_ceph_data_waiter, waiter, None)
+
+        if replaced is not None:
+            stream, occurence_dict = replaced
+            stream["failed"] = True
+            self._discard_stream(stream)
+            self._object_cache.unpin(occurence_dict)
+            self._loop.call_soon_threadsafe(
+                self._notify_stream_progress, stream)
+
+    def _receive_object_range(self, object_descriptor, request_dict):
         """
-        Periodically delete old data in the ceph data dictionary.
+        A range of an object arrived from the ceph manager.
 
-        The executor.
+        """
+        occurence_dict = self._make_object_available(
+            object_descriptor, request_dict, request_dict["range"])
+        self._object_cache.unpin(occurence_dict)
 
+    def _receive_object_piece(self, object_descriptor, piece):
         """
-        while True:
+        A piece of a large object arrived from the ceph manager.
 
-            # wait for 1 second, this is essentially a 1 second interval timer
-            if self._shutdown_backend_manager_event.wait(1):
-                return
+        The object is handed out with its first piece. Downloads send what has
+        arrived so far and wait for the rest (see _wait_for_stream).
 
-            current_time = time.time()
+        """
+        if piece["offset"] == 0:
+            stream = {
+                "namespace": piece["namespace"],
+                "object": piece["object"],
+                "tags": piece["tags"],
+                "value": bytearray(piece["size"]),
+                "received": 0,
+                "progress": []
+            }
+            occurence_dict = self._make_object_available(
+                object_descriptor, stream)
+
+            with self._ceph_data_lock:
+                replaced = self._ceph_data_streams.pop(object_descriptor, None)
+                self._ceph_data_streams[object_descriptor] = (
+                    stream, occurence_dict)
 
+            # a stream that is replaced will never be complete
+            if replaced is not None:
+                self._discard_stream(replaced[0])
+                self._object_cache.unpin(replaced[1])
+
+        else:
             with self._ceph_data_lock:
-                for object_descriptor in list(self._ceph_data_dict.keys()):
+                stream, occurence_dict = self._ceph_data_streams.get(
+                    object_descriptor, (None, None))
+
+            if stream is None:
+                bl.debug("Dropping piece of {}, the beginning is "
+                         "missing".format(object_descriptor))
+                return
+
+        # the object might have grown in the meantime
+        value = piece["value"][:len(stream["value"]) - piece["offset"]]
+        end = piece["offset"] + len(value)
+        stream["value"][piece["offset"]:end] = value
+
+        # a sha1sum that has been calculated while reading the object comes
+        # with the last piece; it belongs to the contents that have actually
+        # been read, so it wins over the one the first piece came with (and
+        # is set before the downloads see that the object is complete)
+        if piece["complete"]:
+            sha1sum = piece["tags"].get("sha1sum", "")
+            if sha1sum and sha1sum != stream["tags"].get("sha1sum", ""):
+                stream["tags"] = piece["tags"]
+                occurence_dict["sha1sum"] = sha1sum
+
+        stream["received"] = end
+
+        self._loop.call_soon_threadsafe(self._notify_stream_progress, stream)
+
+        if not piece["complete"]:
+            return
+
+        with self._ceph_data_lock:
+            if self._ceph_data_streams.get(
+                    object_descriptor, (None, None))[0] is stream:
+                self._ceph_data_streams.pop(object_descriptor)
+
+        if stream["received"] == len(stream["value"]):
+            self._store_in_disk_cache(object_descriptor, occurence_dict)
+        else:
+            bl.warning("{} has shrunk while reading it".format(
+                object_descriptor))
+            self._discard_stream(stream)
+            self._object_cache.unpin(occurence_dict)
+
+    def _notify_stream_progress(self, stream):
+        """
+        Wake up the downloads waiting for more of a stream.
+
+        Has to be called from within the event loop.
+
+        """
+        progress, stream["progress"] = stream["progress"], []
+        for future in progress:
+            if not future.done():
+                future.set_result(None)
+
+    def _discard_stream(self, stream):
+        """
+        Drop an object that will never be complete from the cache.
+
+        """
+        object_descriptor = "{}/{}".format(stream["namespace"], stream["object"])
+        self._object_cache.invalidate(object_descriptor, request_dict=stream)
+
+    async def _wait_for_stream(self, file_dictionary, end):
+        """
+        Wait until the first end bytes of an object have arrived.
+
+        Objects that did not arrive in pieces are always there. Returns False
+        if nothing arrives for too long, the object is dropped then, or if the
+        rest could not be read.
+
+        """
+        while file_dictionary.get("received", end) < end:
+            if file_dictionary.get("failed", False):
+                bl.warning("Could not get the rest of {}/{}".format(
+                    file_dictionary["namespace"], file_dictionary["object"]))
+                return False
+
+            progress = self._loop.create_future()
+            file_dictionary["progress"].append(progress)
+            try:
+                await asyncio.wait_for(progress, self._file_download_timeout)
+            except asyncio.TimeoutError:
+                bl.warning("Timed out waiting for the rest of {}/{}".format(
+                    file_dictionary["namespace"], file_dictionary["object"]))
+                self._discard_stream(file_dictionary)
+                return False
+
+        return True
+
+    def _resolve_ceph_data_waiter(self, waiter, occurence_dict):
+        """
+        Hand the data for an object to a waiting download request, None if
+        the object could not be read.
+
+        Has to be called from within the event loop.
+
+        """
+        # the request might have timed out in the meantime
+        if not waiter.done():
+            waiter.set_result(occurence_dict)
+        elif occurence_dict is not None:
+            self._object_cache.unpin(occurence_dict)
+
+    def _copy_out_of_shared_memory(self, request_dict):
+        """
+        Return the request_dict of an object with the contents copied out of
+        shared memory and give the slot back to the pool right away.
+
+        The copy is deliberate: complete objects go into the object cache,
+        which would otherwise keep their slots until they are evicted, and the
+        few slots of the pool would soon all belong to the cache. Sending from
+        the slot and copying into the cache after the send would copy just as
+        much. The shared memory still spares pickling the contents through the
+        queue.
+
+        """
+        shm_descriptor = request_dict.get("shm", None)
+        if shm_descriptor is None or self._buffer_pool is None:
+            return request_dict
+
+        copied_dict = dict(request_dict)
+        del copied_dict["shm"]
+        copied_dict["value"] = bytes(self._buffer_pool.view(shm_descriptor))
+        self._buffer_pool.release(shm_descriptor)
+
+        return copied_dict
+
+    def _release_ceph_data(self, request_dict):
+        """
+        Give the shared memory of an object back to the pool.
+
+        """
+        shm_descriptor = request_dict.get("shm", None)
+        if shm_descriptor is not None and self._buffer_pool is not None:
+            self._buffer_pool.release(shm_descriptor)
+
+    def _file_contents(self, file_dictionary):
+        """
+        Return the contents of an object, either inline or in shared memory.
+
+        """
+        shm_descriptor = file_dictionary.get("shm", None)
+        if shm_descriptor is not None:
+            return self._buffer_pool.view(shm_descriptor)
+        return file_dictionary["value"]
+
+    async def _periodic_cache_statistics_coro(self):
+        """
+        Periodically log the statistics of the object cache.
+
+        """
+        while True:
+            await asyncio.sleep(self._cache_statistics_interval)
+
+            stats = self._object_cache.statistics()
+            bl.verbose("Object cache: {} objects, {:.1f}/{:.1f} MiB, {} hits, "
+                       "{} misses, {} evictions".format(
+                           stats["entries"],
+                           stats["bytes"] / 1024 / 1024,
+                           stats["max_bytes"] / 1024 / 1024,
+                           stats["hits"], stats["misses"], stats["evictions"]))
+
+            if self._disk_cache is not None:
+                stats = self._disk_cache.statistics()
+                bl.verbose("Disk cache: {:.1f}/{:.1f} MiB, {} hits, {} misses, "
+                           "{} stores".format(
+                               stats["bytes"] / 1024 / 1024,
+                               stats["max_bytes"] / 1024 / 1024,
+                               stats["hits"], stats["misses"], stats["stores"]))
+
+    def _invalidate_cached_file(self, new_file):
+        """
+        Drop a cached object if the cluster has a different version of it, or
+        does not have it anymore.
+
+        """
+        try:
+            object_descriptor = "{}/{}".format(
+                new_file["namespace"], new_file["key"])
+            sha1sum = new_file["sha1sum"]
+        except (KeyError, TypeError):
+            return
+
+        if new_file.get("removed", False):
+            # the disk cache is looked up by the sha1sum we know for the
+            # object, without it the object is not served from there either
+            self._object_cache.invalidate(object_descriptor)
+            self._object_hashes.pop(object_descriptor, None)
+            return
+
+        self._object_cache.invalidate(object_descriptor, sha1sum)
+
+        if sha1sum:
+            self._object_hashes[object_descriptor] = sha1sum
+        else:
+            self._object_hashes.pop(object_descriptor, None)
+
+    def _learn_object_hashes(self, index, complete=True):
+        """
+        Remember the sha1sums of all objects in an index of the local data
+        copy.
+
+        If the index is not complete (the answer to a query) the sha1sums are
+        added to the ones we know. Parts of the index that are not
+        dictionaries are skipped.
 
-                    timestamp = self._ceph_data_dict[object_descriptor]["timestamp"]
-                    elapsed_time = current_time - timestamp
+        """
+        object_hashes = dict()
+
+        for namespace, namespace_index in index.items():
+            subtrees = [namespace_index]
+            while subtrees:
+                subtree = subtrees.pop()
+                if not isinstance(subtree, dict):
+                    continue
+                for child in subtree.values():
+                    if isinstance(child, dict):
+                        subtrees.append(child)
+                if subtree.get("sha1sum", None) and "object_key" in subtree:
+                    object_descriptor = "{}/{}".format(
+                        namespace, subtree["object_key"])
+                    object_hashes[object_descriptor] = subtree["sha1sum"]
+
+        if complete:
+            # the index is complete, so this replaces everything we knew
+            self._object_hashes = object_hashes
+        else:
+            self._object_hashes.update(object_hashes)
+
+    def _learn_object_hash_changes(self, changes):
+        """
+        Update the sha1sums we know with the changes of the index of the local
+        data copy.
 
-                    if (elapsed_time > 60):
+        """
+        for change in changes["added"]:
+            object_descriptor = "{}/{}".format(
+                change["namespace"], change["object_key"])
+            if change["sha1sum"]:
+                self._object_hashes[object_descriptor] = change["sha1sum"]
+            else:
+                self._object_hashes.pop(object_descriptor, None)
 
-                        bl.debug("Removing {} after 60 seconds".format(
-                            object_descriptor))
-                        del self._ceph_data_dict[object_descriptor]
+        for change in changes["removed"]:
+            self._object_hashes.pop("{}/{}".format(
+                change["namespace"], change["object_key"]), None)
+
+    def _load_from_disk_cache(self, object_descriptor, sha1sum=None):
+        """
+        Put an object from the disk cache into the object cache.
+
+        Returns True if the object was found on disk. Does blocking file I/O,
+        run it in the disk cache executor.
+
+        """
+        if self._disk_cache is None:
+            return False
+
+        if not sha1sum:
+            sha1sum = self._object_hashes.get(object_descriptor, None)
+        if not sha1sum:
+            return False
+
+        contents = self._disk_cache.open(sha1sum)
+        if contents is None:
+            return False
+
+        bl.debug("Found {} in the disk cache".format(object_descriptor))
+
+        namespace, key = object_descriptor.split("/", 1)
+        request_dict = {
+            "namespace": namespace,
+            "object": key,
+            "tags": {"sha1sum": sha1sum},
+            "value": contents
+        }
+        self._object_cache.put(object_descriptor, request_dict)
+
+        return True
+
+    def _store_in_disk_cache(self, object_descriptor, occurence_dict):
+        """
+        Write an object that came from the ceph cluster to the disk cache.
+
+        Takes over a pin of the cache entry, it is unpinned once the contents
+        are written. The writing happens in the disk cache executor, so the
+        ceph data executor can go on with the next object.
+
+        """
+        request_dict = occurence_dict["request_dict"]
+        sha1sum = request_dict.get("tags", dict()).get("sha1sum", "")
+        if sha1sum:
+            self._object_hashes[object_descriptor] = sha1sum
+
+        if not sha1sum or self._disk_cache is None:
+            self._object_cache.unpin(occurence_dict)
+            return
+
+        self._disk_cache_executor.submit(
+            self._write_to_disk_cache, object_descriptor, sha1sum,
+            occurence_dict)
+
+    def _write_to_disk_cache(self, object_descriptor, sha1sum, occurence_dict):
+        """
+        Write the contents of a pinned cache entry to the disk cache and unpin
+        it. Runs in the disk cache executor.
+
+        The contents are hashed here, off the ceph data executor. An object
+        that does not match the sha1sum it came with (e.g. it changed while it
+        was read) is dropped from the caches, the next download reads it
+        again.
+
+        """
+        request_dict = occurence_dict["request_dict"]
+        try:
+            contents = self._file_contents(request_dict)
+            if hashlib.sha1(contents).hexdigest() != sha1sum:
+                bl.warning("Contents of {} do not match sha1sum {}, dropping "
+                           "them".format(object_descriptor, sha1sum))
+                self._object_cache.invalidate(
+                    object_descriptor, request_dict=request_dict)
+                if self._object_hashes.get(object_descriptor, None) == sha1sum:
+                    self._object_hashes.pop(object_descriptor, None)
+                return
+
+            # hashed above already
+            self._disk_cache.store(sha1sum, contents, check_sha1sum=False)
+        except OSError as e:
+            bl.warning("Could not write {} to the disk cache: {}".format(
+                object_descriptor, e))
+        finally:
+            self._object_cache.unpin(occurence_dict)
 
 
     ##################################################################
@@ -397,6 +905,7 @@ class BackendManager(object):
             except queue.Empty:
                 pass
             else:
+                self._invalidate_cached_file(new_file)
                 return new_file
 
     async def _inform_client_new_file(self, reader, writer, new_file):
@@ -442,26 +951,75 @@ class BackendManager(object):
 
                 bl.debug("Received index request")
 
-                # tell the local data copy that we request the index (index
-                # event)
-                self._get_index_server_event.set()
+                # a query asks for a part of the index only, a version of the
+                # index for the changes since then
+                query = res.get("query", None)
+                since = res.get("since", None)
+
+                if self._index_query_queue is not None:
+                    self._index_query_queue.put({
+                        "query": query,
+                        "since": since,
+                        "index_id": res.get("index_id", None)
+                    })
+                else:
+                    if query is not None or since is not None:
+                        bl.warning("Index queries are not supported, "
+                                   "sending the whole index")
+                        query = None
+                    # tell the local data copy that we request the index
+                    # (index event)
+                    self._get_index_server_event.set()
+
+                index_data = self._index_data_queue.get(True, 10)  # wait up to 10 seconds
+
+                # the sha1sums are only needed for the disk cache, whatever
+                # goes wrong here must not keep the index from the client
+                try:
+                    if "changes" in index_data:
+                        self._learn_object_hash_changes(index_data["changes"])
+                    else:
+                        self._learn_object_hashes(
+                            index_data["index"], complete=query is None)
+                except Exception as e:
+                    bl.error("Could not learn the sha1sums of the index: "
+                             "{}".format(e))
 
-                index = self._index_data_queue.get(True, 10)  # wait up to 10 seconds
-                await self._send_index_to_client(reader, writer, index)
+                await self._send_index_to_client(
+                    reader, writer, index_data, query)
 
 
-    async def _send_index_to_client(self, reader, writer, index):
+    async def _send_index_to_client(self, reader, writer, index_data,
+                                    query=None):
         """
         Prepares a dictionary with the requested index.
 
+        The namespace states tell the client which namespaces have been read
+        from the cluster ("ready") and which are still being read ("indexing")
+        or only known from the last run ("stale"). The answer to a query
+        repeats the query, and the error if it could not be answered.
+
+        With the "index_id" and "version" of the index the client can ask for
+        the "changes" since then, which are sent instead of the "index" if
+        they are still known.
+
         """
         bl.debug("Sending index to client")
 
         todo_val = "index"
         index_dictionary = {
             "todo": todo_val,
-            todo_val: index
+            "namespace_states": index_data["namespace_states"]
         }
+        if "changes" in index_data:
+            index_dictionary["changes"] = index_data["changes"]
+        else:
+            index_dictionary[todo_val] = index_data["index"]
+        for field in ["index_id", "version", "error"]:
+            if field in index_data:
+                index_dictionary[field] = index_data[field]
+        if query is not None:
+            index_dictionary["query"] = query
 
         await self._send_dictionary(reader, writer, index_dictionary)
 
@@ -469,10 +1027,13 @@ class BackendManager(object):
     ##################################################################
     # handle requests for file contents from the client
     #
-    async def _file_download_coro(self, reader, writer):
+    async def _file_download_coro(self, reader, writer, binary_frames=False):
         """
         Respond to download requests.
 
+        If binary_frames is True the file contents are sent as raw bytes after
+        the JSON header instead of being base64 encoded inside of it.
+
         """
         # while the connection is open ...
         if not reader.at_eof():
@@ -491,57 +1052,119 @@ class BackendManager(object):
             res = res["requested_file"]
             namespace = res["namespace"]
             key = res["key"]
+            # optional, a cached copy with a different hash is not used
+            sha1sum = res.get("sha1sum", None)
+            # optional, only send a part of the file
+            byte_range = res.get("range", None)
             request_json = {
                 "namespace": namespace,
                 "key": key
             }
 
+            if byte_range is not None:
+                try:
+                    byte_range = {
+                        "offset": int(byte_range["offset"]),
+                        "length": int(byte_range["length"])
+                    }
+                    if byte_range["offset"] < 0 or byte_range["length"] < 0:
+                        raise ValueError
+                except (KeyError, TypeError, ValueError):
+                    bl.warning("Invalid range {}".format(res["range"]))
+                    await self.send_nack(writer)
+                    return
+                request_json["range"] = byte_range
+
             bl.debug("Request for {}/{} received".format(namespace, key))
 
             await self.send_ack(writer)
 
-            # check if the file is already in the ceph_data_dict
             object_descriptor = "{}/{}".format(namespace, key)
+            # a range that is not in the cache is read on its own
+            request_descriptor = self._request_descriptor(
+                object_descriptor, byte_range)
+
+            # objects that are not in memory might be on disk
+            if (self._disk_cache is not None and
+                object_descriptor not in self._object_cache):
+                await self._loop.run_in_executor(
+                    self._disk_cache_executor, self._load_from_disk_cache,
+                    object_descriptor, sha1sum)
+
+            # check if the file is already in the cache
+
+            waiter = None
 
             with self._ceph_data_lock:
-                if object_descriptor in self._ceph_data_dict:
-                    bl.debug("Found {} in ceph data, updating "
-                             "timestamp".format(object_descriptor))
-                    self._ceph_data_dict[object_descriptor]["timestamp"] = (
-                        time.time())
+                # the entry is pinned until it is sent
+                occurence_dict = self._object_cache.get(
+                    object_descriptor, sha1sum)
+                if occurence_dict is not None:
+                    bl.debug("Found {} in the cache".format(object_descriptor))
                 else:
                     bl.debug("Getting {}".format(object_descriptor))
-                    req = {"namespace": namespace, "key": key}
-                    # drop the request in the queue for the proxy manager
-                    self._file_name_request_server_queue.put(request_json)
-
-            # keep track how often we try to get data from the dictionary
-            counter = 0
+                    # register a waiter before the request goes out, the ceph
+                    # data executor resolves it once the object arrives
+                    waiter = self._loop.create_future()
+                    self._ceph_data_waiters.setdefault(
+                        request_descriptor, []).append(waiter)
+
+                    # only ask the ceph manager if nobody else did already;
+                    # a request that is older than the download timeout is
+                    # considered lost and sent again
+                    requested_at = self._ceph_data_requests_in_flight.get(
+                        request_descriptor, None)
+                    now = time.time()
+                    if (requested_at is None or
+                        now - requested_at > self._file_download_timeout):
+                        self._ceph_data_requests_in_flight[
+                            request_descriptor] = now
+                        # drop the request in the queue for the proxy manager
+                        self._file_name_request_server_queue.put(request_json)
+                    else:
+                        bl.debug("{} is already requested, waiting for "
+                                 "it".format(request_descriptor))
 
             # wait until we have everything downloaded
-            while True:
-
-                # wait a fraction of a second (rate throttling)
-                time.sleep(.1)
-
-                # get a list of keys in the GATEWAY_DATA
-                with self._ceph_data_lock:
-                    keys = list(self._ceph_data_dict.keys())
-
-                if object_descriptor in keys:
+            if waiter is not None:
+                try:
+                    occurence_dict = await asyncio.wait_for(
+                        waiter, self._file_download_timeout)
+                except asyncio.TimeoutError:
+                    bl.warning("Timed out waiting for {}. Could not get data "
+                               "from ceph.".format(request_descriptor))
+                    # the object might have arrived right at the timeout
+                    if (waiter.done() and not waiter.cancelled() and
+                        waiter.result() is not None):
+                        self._object_cache.unpin(waiter.result())
+                    return
+                finally:
                     with self._ceph_data_lock:
-                        self._ceph_data_dict[object_descriptor]["timestamp"] = time.time()
-                        send_this = self._ceph_data_dict[object_descriptor]["request_dict"]
-                        break
-
-                counter += 1
-                if (counter > 100):
-                    bl.warning("Too many iterations. Could not get data from ceph.")
+                        waiters = self._ceph_data_waiters.get(
+                            request_descriptor, [])
+                        if waiter in waiters:
+                            waiters.remove(waiter)
+                            # nobody waits for the request anymore (it failed
+                            # or timed out), the next download asks again
+                            if not waiters:
+                                self._ceph_data_waiters.pop(
+                                    request_descriptor, None)
+                                self._ceph_data_requests_in_flight.pop(
+                                    request_descriptor, None)
+
+                if occurence_dict is None:
+                    bl.warning("Could not get data for {} from "
+                               "ceph.".format(request_descriptor))
                     return
 
             bl.debug("Got file contents from queue")
 
-            await self._send_file_to_client(reader, writer, send_this)
+            try:
+                await self._send_file_to_client(
+                    reader, writer, occurence_dict["request_dict"],
+                    binary_frames, byte_range)
+            finally:
+                self._object_cache.unpin(occurence_dict)
 
 
     async def _check_download_connection(self, reader, writer):
@@ -572,23 +1195,54 @@ class BackendManager(object):
             else:
                 return push_file
 
-    async def _send_file_to_client(self, reader, writer, file_dictionary):
+    async def _send_file_to_client(
+            self, reader, writer, file_dictionary, binary_frames=False,
+            byte_range=None):
         """
         Answer file requests.
 
         Encode the binary data in the file_dictionary as a base64 string. This
         has to be reversed on the other side.
 
+        If binary_frames is True the header dictionary carries the size of the
+        file instead of the contents and the raw contents follow in chunks
+        (see _send_binary_payload). Objects that are still arriving in pieces
+        are sent while they arrive.
+
+        If byte_range is given only this part of the file is sent and the
+        header carries the "range" that is actually sent.
+
         """
         connection_info = writer.get_extra_info('peername')
         p_host = connection_info[0]
         p_port = connection_info[1]
 
+        file_contents = memoryview(self._file_contents(file_dictionary))
+
+        # the file_dictionary might already hold only the requested range
+        start = 0
+        if byte_range is not None and "range" not in file_dictionary:
+            start = min(byte_range["offset"], len(file_contents))
+            file_contents = file_contents[
+                start:start + byte_range["length"]]
+
         out_dict = dict()
         out_dict["namespace"] = file_dictionary["namespace"]
         out_dict["object"] = file_dictionary["object"]
-        out_dict["contents"] = base64.b64encode(
-            file_dictionary["value"]).decode()
+        if byte_range is not None:
+            out_dict["range"] = {
+                "offset": byte_range["offset"],
+                "length": len(file_contents)
+            }
+        if binary_frames:
+            out_dict["encoding"] = "binary"
+            out_dict["size"] = len(file_contents)
+            out_dict["chunk_size"] = self._binary_frame_chunk_size
+        else:
+            if not await self._wait_for_stream(
+                    file_dictionary, start + len(file_contents)):
+                return False
+            out_dict["contents"] = base64.b64encode(file_contents).decode()
         out_dict["tags"] = file_dictionary["tags"]
 
         bl.debug("Sending {}/{} to client [{}]".format(out_dict["namespace"], out_dict["object"], p_port))
@@ -599,12 +1253,99 @@ class BackendManager(object):
             todo_val: out_dict
         }
 
-        await self._send_dictionary(reader, writer, request_answer_dictionary)
+        header_sent = await self._send_dictionary(
+            reader, writer, request_answer_dictionary)
+
+        if binary_frames and header_sent:
+            return await self._send_binary_payload(
+                reader, writer, file_contents, file_dictionary, start)
+
+        return header_sent
+
+    async def _send_binary_payload(
+            self, reader, writer, payload, file_dictionary=None,
+            stream_offset=0):
+        """
+        Send raw bytes to the connected client.
+
+        The length of the payload has been announced in the header before. The
+        payload is written in chunks, waiting for the transport to drain after
+        every chunk, so at most one chunk is buffered on our side. Slicing a
+        memoryview does not copy the payload.
+
+        If the payload is part of an object that is still arriving
+        (file_dictionary, starting at stream_offset) every chunk is sent as
+        soon as it is there. If the rest does not arrive the connection is
+        closed, the client can not make sense of it anymore.
+
+        """
+        payload_view = memoryview(payload)
+        chunk_size = self._binary_frame_chunk_size
+
+        for offset in range(0, len(payload_view), chunk_size):
+            chunk = payload_view[offset:offset + chunk_size]
+
+            if file_dictionary is not None:
+                if not await self._wait_for_stream(
+                        file_dictionary, stream_offset + offset + len(chunk)):
+                    writer.close()
+                    return False
+
+            writer.write(chunk)
+            await writer.drain()
+
+        # pipelined connections do not acknowledge the payload
+        if writer in self._connection_framing:
+            return True
+
+        # check ack or nack
+        is_ack = await self.check_ack(reader)
+        if not is_ack:
+            return False
+
+        return True
 
 
     ##################################################################
     # utility functions for sending and receiving data to and from the client
     #
+    def _setup_connection_framing(self, writer, task_dict):
+        """
+        Switch a connection to the pipelined framing if requested.
+
+        The handshake always uses the legacy framing, where the length and the
+        data of every message are acknowledged separately. A client that puts
+        "framing": "pipelined" in the handshake dictionary sends and receives
+        every following message as a fixed width length prefix (8 bytes,
+        network byte order) directly followed by the data, without any ACKs.
+
+        With "ack_window": N the receiving side sends a single ACK frame (a
+        length prefix followed by the data "ack") after every N messages
+        instead, and the sending side waits for it before it continues. This
+        keeps the amount of unacknowledged data bounded. Messages that arrive
+        while waiting for an ACK frame are kept until they are read.
+
+        """
+        if task_dict.get("framing", "legacy") != "pipelined":
+            return
+
+        try:
+            ack_window = int(task_dict.get("ack_window", 0))
+        except (TypeError, ValueError):
+            ack_window = 0
+
+        bl.debug("Using pipelined framing (ack window {})".format(ack_window))
+
+        self._connection_framing[writer] = {
+            "ack_window": max(ack_window, 0),
+            "sent": 0,
+            "received": 0,
+            # ACK frames that have not been waited for yet
+            "acks": 0,
+            # messages read while waiting for an ACK frame
+            "pending": collections.deque()
+        }
+
     async def read_data(self, reader, writer):
         """
         Read data from the connection.
@@ -615,12 +1356,20 @@ class BackendManager(object):
         await self.send_ack(writer)
         await self.send_nack(writer)
 
+        On pipelined connections sending the ACK or NACK does nothing, so the
+        same calls work for both framings.
+
         """
-        # wait until we have read something that is up to 1k (until the newline
-        # comes)
-        length_b = await reader.read(1024)
+        framing = self._connection_framing.get(writer)
+        if framing is not None:
+            return await self._read_pipelined_data(reader, writer, framing)
 
-        if reader.at_eof():
+        # read exactly the length of the data, reading more than that would
+        # swallow the beginning of the data itself
+        try:
+            length_b = await reader.readexactly(struct.calcsize("L"))
+        except asyncio.IncompleteReadError:
+            # the connection was closed
             return
 
         try:
@@ -661,6 +1410,64 @@ class BackendManager(object):
         # await self.send_nack(writer)
         # NOTE: do not forget to send a final ack or nack
 
+    async def _read_pipelined_data(self, reader, writer, framing):
+        """
+        Read a length prefixed message from a pipelined connection.
+
+        """
+        if framing["pending"]:
+            return framing["pending"].popleft()
+
+        while True:
+            res = await self._read_pipelined_frame(reader, writer, framing)
+            if res is not self._pipelined_ack:
+                return res
+
+    async def _read_pipelined_frame(self, reader, writer, framing):
+        """
+        Read the next frame from a pipelined connection.
+
+        Returns the message, the ACK data for an ACK frame (counted in the
+        framing) or None if the connection was closed. Every ack_window
+        messages an ACK frame is sent back as soon as they are read.
+
+        """
+        try:
+            length_b = await reader.readexactly(self._pipelined_length_size)
+            length = struct.unpack(self._pipelined_length_format, length_b)[0]
+            data = await reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            # the connection was closed
+            return
+
+        if data == self._pipelined_ack:
+            framing["acks"] += 1
+            return self._pipelined_ack
+
+        try:
+            res = json.loads(data.decode("UTF-8"))
+        except Exception as e:
+            # there is no way of asking for the message again, the other side
+            # has to reconnect
+            bl.error("An Exception occured: {}".format(e))
+            raise
+
+        framing["received"] += 1
+        ack_window = framing["ack_window"]
+        if ack_window and framing["received"] % ack_window == 0:
+            self._write_pipelined_frame(writer, self._pipelined_ack)
+            await writer.drain()
+
+        return res
+
+    def _write_pipelined_frame(self, writer, data):
+        """
+        Write the length prefix and the data of a frame.
+
+        """
+        writer.write(struct.pack(self._pipelined_length_format, len(data)))
+        writer.write(data)
+
     async def _send_dictionary(self, reader, writer, dictionary):
         """
         Send a dictionary to the connected client.
@@ -670,6 +1477,20 @@ class BackendManager(object):
         binary_dictionary = dictionary_str.encode()
 
         binary_dictionary_length = len(binary_dictionary)
+
+        framing = self._connection_framing.get(writer)
+        if framing is not None:
+            # length and data in one go, no ACKs
+            self._write_pipelined_frame(writer, binary_dictionary)
+            await writer.drain()
+
+            framing["sent"] += 1
+            ack_window = framing["ack_window"]
+            if ack_window and framing["sent"] % ack_window == 0:
+                return await self._check_window_ack(reader, writer, framing)
+
+            return True
+
         binary_dictionary_length_encoded = struct.pack(
             "L", binary_dictionary_length)
 
@@ -715,11 +1536,32 @@ class BackendManager(object):
                 return True
         return False
 
+    async def _check_window_ack(self, reader, writer, framing):
+        """
+        Wait for the ACK frame that closes an ack window on a pipelined
+        connection.
+
+        Messages that the client sent in the meantime are kept for the next
+        read_data.
+
+        """
+        while not framing["acks"]:
+            res = await self._read_pipelined_frame(reader, writer, framing)
+            if res is None:
+                return False
+            if res is not self._pipelined_ack:
+                framing["pending"].append(res)
+
+        framing["acks"] -= 1
+        return True
+
     async def send_ack(self, writer):
         """
         Send an ACK.
 
         """
+        if writer in self._connection_framing:
+            return              # pipelined, nothing to acknowledge
         writer.write("ack".encode())
         await writer.drain()
 
@@ -728,5 +1570,7 @@ class BackendManager(object):
         Send an ACK.
 
         """
+        if writer in self._connection_framing:
+            return              # pipelined, nothing to acknowledge
         writer.write("nack".encode())
         await writer.drain()
@@ -5,13 +5,15 @@ Opens a steady connection to the ceph cluster.
 It tries to read tasks from a queue and returns the results.
 
 """
-import queue
+import errno
 import pathlib
 import asyncio
 import hashlib
-import subprocess
 import functools
+import contextlib
+import collections
 import multiprocessing
+import concurrent.futures
 
 try:
     import librados.rados as rados   # comes from python3-rados_12.2.7-1_bpo90+1_amd64.deb
@@ -22,67 +24,6 @@ except ImportError:
 from util.loggers import CoreLog as cl, BackendLog as bl, SimulationLog as sl
 
 
-def get_namespaces(ceph_conf, ceph_pool, ceph_user):
-    """
-    Use rados on the commandline to parse all namespaces.
-
-    """
-    ceph_conf = str(pathlib.Path(ceph_conf))
-
-    # a set can not have duplicates
-    namespaces = set()
-
-    cwd = pathlib.Path(__file__).parent.parent
-    pathlib.Path(cwd / ".radosoutput").mkdir(exist_ok=True)
-    rados_file = cwd / ".radosoutput" / "radosoutput.txt"
-
-    # delete existing file first
-    try:
-        rados_file.unlink()
-    except FileNotFoundError:
-        pass
-
-    try:
-        rados_cmd = [
-            "rados",
-            "-p", "{}".format(ceph_pool),
-            "ls", "{}".format(str(rados_file)),
-            "--user", "{}".format(ceph_user),
-            "--keyring", "{}".format(ceph_conf),
-            "--all"
-        ]
-        result = subprocess.call(rados_cmd)
-    except FileNotFoundError:
-        cl.warning("call to commandline failed -- file not found")
-        return None
-
-    if not result == 0:
-        cl.warning("call to command line failed -- non zero exit code")
-        return None
-
-    if not rados_file.exists():
-        cl.warning("no data for parsing present")
-        return None
-
-    cl.verbose("parsing data in .radosoutput/radosoutput.txt")
-
-    with open(str(rados_file), 'r') as rf:
-        while True:
-            line = rf.readline()
-            if line == "":
-                break
-            pts = line.split("\t")  # split on tab
-            # len = 2 -> this has a namespace
-            if len(pts) == 2:
-                if pts[0] != "":
-                    namespaces.add(pts[0])
-
-    cl.verbose("got {} namespaces".format(len(namespaces)))
-
-
-    return namespaces
-
-
 class CephConnection(object):
     """
     Maintain a steady connection to the ceph cluster.
@@ -93,18 +34,16 @@ class CephConnection(object):
             ceph_config,
             ceph_pool,
             pool_user,
-            task_pattern,       # pattern to follow when doing tasks
-            queue_ceph_task,    # queue for receiving things to do
-            queue_ceph_task_data,    # queue for task to retrieve data (contents and hashes)
-            queue_ceph_task_hashes,    # queue for task to retrieve hashes (externally)
-            queue_ceph_task_index_namespace,  # queue for retrieving the index of a namespace
-            queue_ceph_task_index,    # queue for retrieving the index (this will start a series of events like getting the namespaces, then the files in every namespace and then the respective hashes)
+            task_scheduler,     # shared priority queue for things to do
             event_shutdown_process,  # when this event is set the connection will be closed
             queue_index,             # return queue for the index
             queue_namespace_index,   # return queue for the index for a namespace
             queue_object_tags,       # return queue for object tags
             queue_object_data,       # return queue for object data (with tags)
-            queue_object_hash        # return queue for object hash
+            queue_object_hash,       # return queue for object hash
+            buffer_pool=None,        # shared memory for object data
+            autoscaler=None,         # gets the load of this connection
+            autoscaler_slot=None     # slot of this connection in autoscaler
     ):
         """
         initialize connection.
@@ -114,13 +53,7 @@ class CephConnection(object):
         self._target_pool = ceph_pool
         self._rados_id = pool_user
 
-        self._task_pattern = task_pattern
-
-        self._queue_ceph_task = queue_ceph_task
-        self._queue_ceph_task_data = queue_ceph_task_data
-        self._queue_ceph_task_hashes = queue_ceph_task_hashes
-        self._queue_ceph_task_index = queue_ceph_task_index
-        self._queue_ceph_task_index_namespace = queue_ceph_task_index_namespace
+        self._task_scheduler = task_scheduler
 
         self._event_shutdown_process = event_shutdown_process
 
@@ -130,20 +63,50 @@ class CephConnection(object):
         self._queue_object_data = queue_object_data
         self._queue_object_hash = queue_object_hash
 
-        # Connect to cluster
-        self._cluster = rados.Rados(
-            conffile=self._conffile,
-            rados_id=self._rados_id
-        )
+        # object data is written to shared memory if possible
+        self._buffer_pool = buffer_pool
 
-        self._cluster.connect()
+        # the load of this connection is reported to the autoscaler
+        self._autoscaler = autoscaler
+        self._autoscaler_slot = autoscaler_slot
 
-        # Try opening an IO context
-        try:
-            self._ioctx = self._cluster.open_ioctx(self._target_pool)
-        except Exception as ex:
-            cl.error("Exception occured: {}".format(ex))
-            raise
+        # moving average of the time the cluster takes for an asynchronous
+        # operation, the last operation has this weight
+        self._rados_latency = 0
+        self._rados_latency_weight = 5e-2
+
+        # objects are read in pieces of this size, several pieces at a time
+        self._read_chunk_size = 4 * 1024 * 1024  # 4 MiB
+        self._parallel_chunk_reads = 4
+
+        # objects larger than this that do not fit into shared memory are
+        # handed out piece by piece while they are read
+        self._stream_threshold = 16 * 1024 * 1024  # 16 MiB
+
+        # number of tasks this connection works on at the same time; reads are
+        # issued asynchronously, so every task only costs a few completions
+        self._max_concurrent_tasks = 32
+
+        # number of tasks of every class this connection works on at most at
+        # the same time; the less important classes can not take all of them,
+        # so there is always room for a download
+        self._task_class_slots = {
+            "data": 32,
+            "hashes": 24,
+            "index_namespaces": 16,
+            "index": 1
+        }
+
+        # seconds to wait for a task before looking at the shutdown event
+        # again, and when one of the classes is at its limit
+        self._task_poll_time = 1
+        self._task_poll_time_limited = 5e-2
+
+        # the binding has no asynchronous calls for xattrs, these (and
+        # listing objects) run in a few threads; librados releases the GIL
+        self._blocking_workers = 8
+
+        self._connect()
 
         try:
             #
@@ -152,7 +115,7 @@ class CephConnection(object):
 
             # task for reading the queue
             self._queue_reader_task = self._loop.create_task(
-                self._queue_reader_coro(self._task_pattern))
+                self._queue_reader_coro())
 
             self._loop.run_until_complete(self._queue_reader_task)
 
@@ -166,148 +129,201 @@ class CephConnection(object):
             # Ctrl C passes quietly
             pass
 
-    async def _queue_reader_coro(self, pattern=None):
-        """
-        Read the queue for new things to do.
-
-        """
-        # select a priority pattern and parse the queues based on that
-        # we do this because it is very difficult to get a fast priority
-        # queue when multiprocessing is involved
-        #
-        data_pattern = [
-            {"queue": self._queue_ceph_task_data, "blocking_time": 1e-1},
-            {"queue": self._queue_ceph_task_hashes, "blocking_time": 0},
-            # {"queue": self._queue_ceph_task_index_hashes, "blocking_time": 0}
-        ]
-        #
-        hashes_pattern = [
-            {"queue": self._queue_ceph_task_hashes, "blocking_time": 1e-1},
-            {"queue": self._queue_ceph_task_data, "blocking_time": 0},
-            # {"queue": self._queue_ceph_task_index_hashes, "blocking_time": 0}
-        ]
-        index_namespaces_pattern = [
-            {"queue": self._queue_ceph_task_index_namespace, "blocking_time": 1e-1},
-            {"queue": self._queue_ceph_task_hashes, "blocking_time": 0},
-            {"queue": self._queue_ceph_task_data, "blocking_time": 0}
-        ]
-        #
-        index_pattern = [
-            {"queue": self._queue_ceph_task_index, "blocking_time": 1e-1},
-            {"queue": self._queue_ceph_task_hashes, "blocking_time": 0},
-            {"queue": self._queue_ceph_task_data, "blocking_time": 0}
-        ]
-
-        if pattern == "data":
-            queue_pattern = data_pattern
-        elif pattern == "hashes":
-            queue_pattern = hashes_pattern
-        # elif pattern == "index_hashes":
-        #     queue_pattern = index_hashes_pattern
-        elif pattern == "index_namespaces":
-            queue_pattern = index_namespaces_pattern
-        elif pattern == "index":
-            queue_pattern = index_pattern
-        else:
-            cl.verbose_warning("Pattern {} not found, assigning None".format(pattern))
-            queue_pattern = None
-
-        while True:
-            new_task = await self._loop.run_in_executor(
-                None,
-                functools.partial(self._queue_reader_executor,
-                                  pattern=queue_pattern)
-            )
-
-            if not new_task:
-                # return None when we want to stop
-                return None
+    def _connect(self):
+        """
+        Connect to the cluster and open an IO context for the pool.
 
-            try:
-                task = new_task["task"]
-                task_info = new_task["task_info"]
+        """
+        # Connect to cluster
+        self._cluster = rados.Rados(
+            conffile=self._conffile,
+            rados_id=self._rados_id
+        )
 
-            except KeyError:
-                cl.warning("Could not read task dictionary {}".format(new_task))
+        self._cluster.connect()
 
+        # Try opening an IO context
+        try:
+            self._ioctx = self._cluster.open_ioctx(self._target_pool)
+        except Exception as ex:
+            cl.error("Exception occured: {}".format(ex))
+            raise
+
+        # the namespace is part of the IO context, so operations in different
+        # namespaces that are in flight at the same time need one each; the
+        # ones used last are kept open, most recently used last
+        self._namespace_ioctxs = collections.OrderedDict()
+        self._max_namespace_ioctxs = 16
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._blocking_workers)
+
+        # reading the index means many blocking calls in a row, they get
+        # threads of their own so downloads do not have to queue behind them
+        self._bulk_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._blocking_workers)
+
+    async def _queue_reader_coro(self):
+        """
+        Take tasks from the scheduler and work on them.
+
+        The most important task that is waiting is taken whenever there is a
+        free slot, whichever class it is of. Classes that have used up their
+        slots (see _task_class_slots) are left to the other connections.
+
+        """
+        task_slots = asyncio.Semaphore(self._max_concurrent_tasks)
+        running_tasks = set()
+        running_by_class = collections.Counter()
+
+        def task_done(task_class, _):
+            running_by_class[task_class] -= 1
+            task_slots.release()
+            self._report_load(len(running_tasks))
+
+        while not self._event_shutdown_process.is_set():
+            await task_slots.acquire()
+
+            task_classes = [
+                task_class
+                for task_class in self._task_scheduler.task_classes
+                if (running_by_class[task_class] <
+                    self._task_class_slots.get(
+                        task_class, self._max_concurrent_tasks))
+            ]
+
+            # a class at its limit is allowed again once one of its tasks is
+            # done, so look again soon
+            if len(task_classes) < len(self._task_scheduler.task_classes):
+                timeout = self._task_poll_time_limited
             else:
+                timeout = self._task_poll_time
 
-                if (task == "read_object_value"):
-                    cl.debug("Reading object value, task_info = {}".format(task_info))
-                    object_value_dict = self.read_everything_for_object(task_info)
-                    self._queue_object_data.put(object_value_dict)
+            scheduled = await self._loop.run_in_executor(
+                None, self._task_scheduler.get, task_classes, timeout)
 
-                if (task == "read_object_hash"):
-                    cl.debug("Reading object hash, task_info = {}".format(task_info))
-                    object_value_dict = self.read_hash_for_object(task_info)
-                    self._queue_object_hash.put(object_value_dict)
+            if scheduled is None:
+                task_slots.release()
+                continue
 
-                if (task == "read_object_tags"):
-                    cl.debug("Reading object tags, task_info = {}".format(task_info))
-                    object_value_dict = self.read_tags_for_object(task_info)
-                    self._queue_object_tags.put(object_value_dict)
+            task_class, new_task = scheduled
+            running_by_class[task_class] += 1
 
-                if (task == "read_namespace_index"):
-                    cl.debug("Reading namespace index, task_info = {}".format(task_info))
-                    namespace_index_dict = self.read_index_for_namespace(task_info)
-                    self._queue_namespace_index.put(namespace_index_dict)
+            running_task = self._loop.create_task(self._run_task(new_task))
+            running_tasks.add(running_task)
+            running_task.add_done_callback(running_tasks.discard)
+            running_task.add_done_callback(
+                functools.partial(task_done, task_class))
+            self._report_load(len(running_tasks))
 
-                if (task == "read_index"):
-                    cl.debug("Reading index, task_info = {}".format(task_info))
-                    index_dict = self.read_index(task_info)
-                    self._queue_index.put(index_dict)
+        cl.debug("Ceph connection shutdown event is set")
 
-                    # empty the index request queue, we just finished updating
-                    # and dont need to do it for a while
-                    while True:
-                        try:
-                            self._queue_ceph_task_index.get()
-                        except queue.Empty:
-                            break
+        # return None when we want to stop, after finishing what we started
+        if running_tasks:
+            await asyncio.wait(running_tasks, timeout=5)
 
+        return None
 
-    def _queue_reader_executor(self, pattern=None):
+    def _report_load(self, running):
         """
-        Read the queue in a separate executor.
+        Tell the autoscaler how busy this connection is.
 
         """
-        while True:
+        if self._autoscaler is not None:
+            self._autoscaler.report(
+                self._autoscaler_slot, running, self._rados_latency)
 
-            if self._event_shutdown_process.is_set():
-                cl.debug("Ceph connection shutdown event is set")
-                return None
+    async def _run_task(self, new_task):
+        """
+        Work on a task and put the result into its return queue.
+
+        """
+        try:
+            task = new_task["task"]
+            task_info = new_task["task_info"]
 
-            # default pattern, not recommended but if nothing is provided we do this
-            if not pattern:
-                pattern = [
-                    {"queue": self._queue_ceph_task_data, "blocking_time": 1e-1},
-                    {"queue": self._queue_ceph_task_hashes, "blocking_time": 0},
-                    {"queue": self._queue_ceph_task_index_namespace, "blocking_time": 0},
-                    {"queue": self._queue_ceph_task_index, "blocking_time": 0}
-                ]
+        except KeyError:
+            cl.warning("Could not read task dictionary {}".format(new_task))
+            return
 
-            override_blocking = False
+        try:
 
-            for i, q in enumerate(pattern):
+            if (task == "read_object_value"):
+                cl.debug("Reading object value, task_info = {}".format(task_info))
                 try:
-                    if override_blocking or q["blocking_time"] == 0:
-                        new_ceph_task = q["queue"].get(False)
+                    if "range" in task_info:
+                        object_value_dict = await self.read_range_of_object(
+                            task_info)
+                        self._queue_object_data.put(object_value_dict)
                     else:
-                        new_ceph_task = q["queue"].get(True, q["blocking_time"])
+                        # large objects are put into the queue in several
+                        # pieces
+                        await self.read_everything_for_object(
+                            task_info, self._queue_object_data.put)
+                except Exception as e:
+                    cl.error("Could not read object {}/{}: {}".format(
+                        task_info["namespace"], task_info["object"], e))
+                    # the downloads waiting for the object fail right away
+                    object_value_dict = {
+                        "namespace": task_info["namespace"],
+                        "object": task_info["object"],
+                        "error": True
+                    }
+                    if "range" in task_info:
+                        object_value_dict["range"] = task_info["range"]
+                    self._queue_object_data.put(object_value_dict)
 
-                except queue.Empty:
-                    # block on the first queue if we have gotten nothing from all queues
-                    if pattern[i] == pattern[-1]:
-                        # cl.verbose("override_blocking = False")
-                        override_blocking = False
+            if (task == "read_object_hash"):
+                cl.debug("Reading object hash, task_info = {}".format(task_info))
+                object_value_dict = await self.read_hash_for_object(task_info)
+                self._queue_object_hash.put(object_value_dict)
+
+            if (task == "read_object_tags"):
+                cl.debug("Reading object tags, task_info = {}".format(task_info))
+                object_value_dict = await self.read_tags_for_object(task_info)
+                self._queue_object_tags.put(object_value_dict)
+
+            if (task == "read_namespace_index"):
+                cl.debug("Reading namespace index, task_info = {}".format(task_info))
+                # the ceph manager hands the task to another connection if
+                # this one dies; the announcement travels ahead of the result
+                self._queue_namespace_index.put({
+                    "namespace": task_info["namespace"],
+                    "started": new_task,
+                    "slot": self._autoscaler_slot
+                })
+                try:
+                    namespace_index_dict = await self.read_index_for_namespace(task_info)
+                except Exception as e:
+                    cl.error("Could not read index for namespace {}: {}".format(
+                        task_info["namespace"], e))
+                    # the ceph manager waits for every namespace of the index
+                    namespace_index_dict = {
+                        "namespace": task_info["namespace"],
+                        "index": None,
+                        "partial": task_info.get("partial", False)
+                    }
+                namespace_index_dict["slot"] = self._autoscaler_slot
+                self._queue_namespace_index.put(namespace_index_dict)
+
+            if (task == "read_index"):
+                cl.debug("Reading index, task_info = {}".format(task_info))
+                self._queue_index.put(
+                    {"started": new_task, "slot": self._autoscaler_slot})
+                try:
+                    index_dict = await self.read_index(task_info)
+                except Exception as e:
+                    cl.error("Could not read index: {}".format(e))
+                    # the ceph manager waits for the list of namespaces
+                    index_dict = {"namespaces": None}
+                index_dict["slot"] = self._autoscaler_slot
+                self._queue_index.put(index_dict)
 
-                else:
-                    # if we got something from a non priority queue we could speed through this a bit faster
-                    if (i >= 1):
-                        cl.verbose("override_blocking = True")
-                        override_blocking = True
+        except Exception as e:
+            # one failing object must not take down the other tasks of this
+            # connection
+            cl.error("Task {} failed: {}".format(new_task, e))
 
-                    return new_ceph_task
 
     def __del__(self):
         """
@@ -316,10 +332,18 @@ class CephConnection(object):
         """
         try:
             self._ioctx.close()
+            for entry in self._namespace_ioctxs.values():
+                entry["ioctx"].close()
             cl.debug("Ceph IO context closed")
         except:
             cl.debug("Could not close ceph IO context")
 
+        try:
+            self._executor.shutdown(wait=False)
+            self._bulk_executor.shutdown(wait=False)
+        except:
+            pass
+
         try:
             self._cluster.shutdown()
             cl.debug("Cluster access shut down")
@@ -340,72 +364,304 @@ class CephConnection(object):
         """
         self._ioctx.set_namespace("")
 
-    def _get_index(self):
+    @contextlib.contextmanager
+    def _namespace_ioctx(self, namespace):
+        """
+        Use the IO context for a namespace.
+
+        Only the _max_namespace_ioctxs IO contexts used last are kept open. The
+        others are closed once no operation uses them anymore.
+
+        """
+        try:
+            entry = self._namespace_ioctxs[namespace]
+            self._namespace_ioctxs.move_to_end(namespace)
+        except KeyError:
+            ioctx = self._cluster.open_ioctx(self._target_pool)
+            ioctx.set_namespace(namespace)
+            entry = {"ioctx": ioctx, "users": 0}
+            self._namespace_ioctxs[namespace] = entry
+
+        while len(self._namespace_ioctxs) > self._max_namespace_ioctxs:
+            _, evicted = self._namespace_ioctxs.popitem(last=False)
+            if evicted["users"] == 0:
+                evicted["ioctx"].close()
+
+        entry["users"] += 1
+        try:
+            yield entry["ioctx"]
+        finally:
+            entry["users"] -= 1
+            evicted = self._namespace_ioctxs.get(namespace) is not entry
+            if evicted and entry["users"] == 0:
+                entry["ioctx"].close()
+
+    def _aio(self, aio_function, *args):
+        """
+        Start an asynchronous librados operation.
+
+        Returns a future for the results that are passed to the completion
+        callback (without the completion itself). The callback is called in a
+        librados thread, the future is resolved in the event loop.
+
+        """
+        future = self._loop.create_future()
+        start_time = self._loop.time()
+
+        def oncomplete(completion, *results):
+            self._loop.call_soon_threadsafe(
+                self._complete_aio, future, completion.get_return_value(),
+                results, start_time)
+
+        aio_function(*args, oncomplete=oncomplete)
+
+        return future
+
+    def _complete_aio(self, future, return_value, results, start_time):
+        """
+        Resolve the future of an asynchronous librados operation.
+
+        """
+        self._rados_latency += self._rados_latency_weight * (
+            self._loop.time() - start_time - self._rados_latency)
+
+        if future.done():
+            return      # nobody is waiting anymore
+
+        if return_value < 0:
+            if return_value == -errno.ENOENT:
+                future.set_exception(rados.ObjectNotFound(
+                    "Object not found"))
+            else:
+                future.set_exception(rados.Error(
+                    "Asynchronous operation failed with {}".format(
+                        return_value)))
+        else:
+            future.set_result(results)
+
+    async def _blocking(self, function, *args, bulk=False):
+        """
+        Run a blocking librados call in one of the threads of the connection.
+
+        Calls that are part of reading the index are marked as bulk and run
+        in separate threads.
+
+        """
+        if bulk:
+            executor = self._bulk_executor
+        else:
+            executor = self._executor
+
+        return await self._loop.run_in_executor(
+            executor, functools.partial(function, *args))
+
+    async def _get_objsize(self, ioctx, objname):
+        """
+        Get the size of an object.
+
+        """
+        obj_size, _ = await self._aio(ioctx.aio_stat, objname)
+        return obj_size
+
+    def _get_xattrs(self, ioctx, objname):
+        """
+        Get the xattrs of an object as a dictionary. This blocks.
+
+        """
+        obj_dict = dict()
+        for xattr_key, xattr_val in ioctx.get_xattrs(objname):
+            obj_dict[xattr_key] = xattr_val.decode()
+        return obj_dict
+
+    async def _get_index(self, ioctx, objects=None):
         """
         Read all the object names and tags.
 
+        If a list of object names is given only the tags of these objects are
+        read, otherwise the objects of the namespace are listed first. The tags
+        of all objects are read at the same time.
+
         """
-        index = dict()
+        if objects is None:
+            objects = await self._blocking(
+                lambda: [rados_obj.key for rados_obj in ioctx.list_objects()],
+                bulk=True)
 
-        obj_iter = self._ioctx.list_objects()
+        async def read_tags(obj_name):
+            try:
+                return await self._blocking(
+                    self._get_xattrs, ioctx, obj_name, bulk=True)
+            except rados.ObjectNotFound:
+                # removed since the namespace has been listed
+                return None
 
-        for rados_obj in obj_iter:
-            obj_name = rados_obj.key
+        all_tags = await asyncio.gather(
+            *[read_tags(obj_name) for obj_name in objects])
 
-            index[obj_name] = {}
-            obj_dict = index[obj_name]
+        index = dict()
 
-            obj_xattrs = self._ioctx.get_xattrs(obj_name)
-            for xattr_key, xattr_val in obj_xattrs:
-                obj_dict[xattr_key] = xattr_val.decode()
+        for obj_name, obj_dict in zip(objects, all_tags):
+            if obj_dict is not None:
+                index[obj_name] = obj_dict
 
         return index
 
-    def _get_objval(self, objname):
+    async def _get_objval(self, ioctx, objname, hasher=None):
         """
         Get the value of an object.
 
         """
-        obj_size = self._ioctx.stat(objname)[0]
-        objval = self._ioctx.read(objname, length=obj_size)
+        obj_size = await self._get_objsize(ioctx, objname)
 
-        return objval
+        chunks = list()
+        await self._read_chunks(
+            ioctx, objname, 0, obj_size,
+            lambda offset, chunk: chunks.append(chunk), hasher)
 
-    def _get_objtags(self, objname):
+        return b"".join(chunks)
+
+    async def _read_chunks(
+            self, ioctx, objname, offset, length, consume, hasher=None):
         """
-        Get the tags for an object.
+        Read length bytes of an object starting at offset.
+
+        Calls consume(offset, data) for every chunk in order. Up to
+        _parallel_chunk_reads chunks are requested from the cluster at the same
+        time. Stops early if the object ends before offset + length. Returns
+        the offset after the last byte that has been read.
+
+        If a hasher (e.g. hashlib.sha1()) is given it is updated with every
+        chunk, while the next chunks are still being read.
 
         """
-        tags_dict = {}
+        end = offset + length
+        next_offset = offset
 
-        obj_xattrs = self._ioctx.get_xattrs(objname)
-        for xattr_key, xattr_val in obj_xattrs:
-            tags_dict[xattr_key] = xattr_val.decode()
+        pending = collections.deque()
 
-        # if the sha1sum is not calculated we generate it
         try:
-            sha1sum = tags_dict["sha1sum"]
-        except KeyError:
-            sha1sum = self._calc_and_write_objhash(objname)
-        else:
-            if sha1sum == "":
-                sha1sum = self._calc_and_write_objhash(objname)
+            while pending or next_offset < end:
+
+                # keep the pipeline filled
+                while (next_offset < end and
+                       len(pending) < self._parallel_chunk_reads):
+                    chunk_length = min(self._read_chunk_size, end - next_offset)
+                    pending.append((
+                        next_offset, chunk_length,
+                        self._aio(ioctx.aio_read, objname, chunk_length,
+                                  next_offset)
+                    ))
+                    next_offset += chunk_length
+
+                chunk_offset, chunk_length, future = pending.popleft()
+                data, = await future
+
+                if data:
+                    if hasher is not None:
+                        hasher.update(data)
+                    consume(chunk_offset, data)
+
+                # the object ends here
+                if len(data) < chunk_length:
+                    return chunk_offset + len(data)
+
+        finally:
+            # nobody waits for the reads that are still in flight
+            for _, _, future in pending:
+                future.cancel()
+
+        return end
+
+    async def _read_objval_into_buffer(
+            self, ioctx, objname, obj_size, hasher=None):
+        """
+        Read the value of an object into a slot of the shared buffer pool.
+
+        The object is read in chunks that are copied into the slot, so it is
+        never held in memory as a whole. Returns the descriptor of the slot or
+        None if there is no slot for the object.
+
+        The slot belongs to this connection until the descriptor is handed on,
+        the ceph manager gives it back if the connection dies before.
+
+        """
+        if self._buffer_pool is None:
+            return None
+
+        shm_descriptor = self._buffer_pool.acquire(
+            obj_size, self._autoscaler_slot)
+        if shm_descriptor is None:
+            return None
+
+        try:
+            size = await self._read_chunks(
+                ioctx, objname, 0, obj_size,
+                functools.partial(self._buffer_pool.write, shm_descriptor),
+                hasher)
+        except:
+            self._buffer_pool.release(shm_descriptor)
+            raise
+
+        # the object might have shrunk in the meantime
+        shm_descriptor["size"] = size
+
+        return shm_descriptor
+
+    async def _get_objtags(self, ioctx, objname, calculate_hash=True):
+        """
+        Get the tags for an object.
+
+        If the object has no sha1sum yet it is calculated, unless
+        calculate_hash is False (because the caller reads the object anyway and
+        hashes it on the way); the sha1sum is an empty string then.
+
+        """
+        tags_dict = await self._blocking(self._get_xattrs, ioctx, objname)
+
+        # if the sha1sum is not calculated we generate it
+        sha1sum = tags_dict.get("sha1sum", "")
+        if sha1sum == "" and calculate_hash:
+            sha1sum = await self._calc_and_write_objhash(ioctx, objname)
 
         tags_dict["sha1sum"] = sha1sum
 
         return tags_dict
 
-    def _calc_and_write_objhash(self, objname):
+    async def _calc_and_write_objhash(self, ioctx, objname):
         """
         Calculate the objhash and write it to the obj tags on the cluster.
 
+        The object is hashed chunk by chunk while it is read, it is never held
+        in memory as a whole.
+
         """
         cl.debug("Calculating hash for {}".format(objname))
-        objval = self._get_objval(objname)
-        objhash = hashlib.sha1(objval).hexdigest()
+        obj_size = await self._get_objsize(ioctx, objname)
+
+        hasher = hashlib.sha1()
+        size = await self._read_chunks(
+            ioctx, objname, 0, obj_size, lambda offset, chunk: None, hasher)
+
+        return await self._write_objhash(
+            ioctx, objname, hasher, obj_size == size)
+
+    async def _write_objhash(self, ioctx, objname, hasher, read_completely):
+        """
+        Write the sha1sum of an object that has been read to the cluster.
+
+        If the object has changed its size while it was read the hash is of no
+        use, nothing is written and an empty string is returned then.
+
+        """
+        if not read_completely:
+            cl.warning("{} has changed while hashing it".format(objname))
+            return ""
+
+        objhash = hasher.hexdigest()
 
         try:
-            self._ioctx.set_xattr(objname, "sha1sum", objhash.encode())
+            await self._blocking(
+                ioctx.set_xattr, objname, "sha1sum", objhash.encode())
         except AttributeError:  # can't encode objhash
             pass
 
@@ -418,126 +674,224 @@ class CephConnection(object):
         """
         self._ioctx.rm_xattr(objname, "sha1sum")
 
-    def read_index(self, task_info):
+    def _list_objects_by_namespace(self):
         """
-        Return the complete index.
+        List the objects of all namespaces in a single pass over the pool.
 
-        """
-        ########
+        Returns a dictionary with a list of object names for every namespace.
+        Objects in the default namespace are not part of any simulation and
+        are skipped.
 
-        # # uncomment this section if you are debugging
-        # # it creates a snapshot of the current index and just loads that on
-        # # every fresh start
-        # # make sure to delete index.pickle once you are done
+        """
+        objects_by_namespace = dict()
 
-        # import pickle
+        self._set_namespace(rados.LIBRADOS_ALL_NSPACES)
 
-        # try:
-        #     with open("index.pickle", "rb") as idx:
-        #         index = pickle.load(idx)
-        #     print("INDEX LOADED")
+        try:
+            for rados_obj in self._ioctx.list_objects():
+                namespace = rados_obj.nspace
+                if not namespace:
+                    continue
+                try:
+                    objects_by_namespace[namespace].append(rados_obj.key)
+                except KeyError:
+                    objects_by_namespace[namespace] = [rados_obj.key]
+        finally:
+            self._unset_namespace()
 
-        # except FileNotFoundError:
+        cl.verbose("got {} namespaces".format(len(objects_by_namespace)))
 
-        #     namespaces = get_namespaces(
-        #         self._conffile, self._target_pool, self._rados_id)
-        #     expected_namespaces = namespaces.copy()
+        return objects_by_namespace
 
-        #     for namespace in namespaces:
-        #         task_dict = {
-        #             "task": "read_namespace_index",
-        #             "task_info": {
-        #                 "namespace": namespace
-        #             }
-        #         }
-        #         self._queue_ceph_task_index_namespace.put(task_dict)
+    async def read_index(self, task_info):
+        """
+        Start reading the complete index.
 
-        #     index = list()
+        The objects of all namespaces are listed here, the tags of the objects
+        are then read namespace by namespace by the other connections. Every
+        namespace index goes to the ceph manager on its own as soon as it is
+        read, so the list of namespaces is all that is returned here.
 
-        #     while not len(expected_namespaces) == 0:
-        #         namespace_index = self._queue_namespace_index.get()
-        #         index.append(namespace_index)
-        #         index_name = namespace_index["namespace"]
-        #         expected_namespaces.remove(index_name)
+        To refresh the index (task_info["refresh"]) only the names of the
+        objects are sent namespace by namespace, the local data copy asks for
+        the tags of the objects it does not know yet.
 
-        #     with open("index.pickle", "wb") as idx:
-        #         pickle.dump(index, idx)
+        """
+        objects_by_namespace = await self._blocking(
+            self._list_objects_by_namespace, bulk=True)
 
-        ########
+        refresh = task_info.get("refresh", False)
 
-        namespaces = get_namespaces(
-            self._conffile, self._target_pool, self._rados_id)
-        expected_namespaces = namespaces.copy()
+        for namespace, objects in objects_by_namespace.items():
+            if refresh:
+                self._queue_namespace_index.put(
+                    {"namespace": namespace, "listing": objects})
+                continue
 
-        for namespace in namespaces:
             task_dict = {
                 "task": "read_namespace_index",
                 "task_info": {
-                    "namespace": namespace
+                    "namespace": namespace,
+                    "objects": objects
                 }
             }
-            self._queue_ceph_task_index_namespace.put(task_dict)
-
-        index = list()
+            self._task_scheduler.put("index_namespaces", task_dict)
 
-        while not len(expected_namespaces) == 0:
-            namespace_index = self._queue_namespace_index.get()
-            index.append(namespace_index)
-            index_name = namespace_index["namespace"]
-            expected_namespaces.remove(index_name)
+        return {"namespaces": list(objects_by_namespace.keys())}
 
-        ########
-
-        return {"index": index}
-
-    def read_index_for_namespace(self, task_info):
+    async def read_index_for_namespace(self, task_info):
         """
         Generate the index for a namespace.
 
-        Returns a list of dictionaries with object attributes.
+        Returns a list of dictionaries with object attributes. If only some
+        objects of the namespace are asked for (task_info["partial"]) the
+        result is not a complete index of the namespace.
 
         """
         namespace = task_info["namespace"]
 
-        cl.verbose("Reading index for namespace {}".format(namespace))
+        # the object names might already be known from listing the pool
+        objects = task_info.get("objects", None)
 
-        self._set_namespace(namespace)
+        cl.verbose("Reading index for namespace {}".format(namespace))
 
-        index = self._get_index()
+        with self._namespace_ioctx(namespace) as ioctx:
+            index = await self._get_index(ioctx, objects)
 
         return_dict = dict()
         return_dict["namespace"] = namespace
         return_dict["index"] = index
-
-        self._unset_namespace()
+        return_dict["partial"] = task_info.get("partial", False)
 
         return return_dict
 
-    def read_everything_for_object(self, task_info):
+    async def read_everything_for_object(self, task_info, put):
         """
         Get the file itself and all the tags.
 
+        Calls put with a single dictionary for most objects. Objects that are
+        larger than _stream_threshold and do not fit into shared memory are put
+        in pieces while they are read. Every piece carries the "offset" of its
+        "value", the "size" of the whole object and whether it is the last
+        piece ("complete").
+
         """
         namespace = task_info["namespace"]
         obj_name = task_info["object"]
 
-        self._set_namespace(namespace)
+        with self._namespace_ioctx(namespace) as ioctx:
+            obj_size = await self._get_objsize(ioctx, obj_name)
 
-        objval = self._get_objval(obj_name)
+            # a missing sha1sum is calculated from the chunks we read anyway
+            tags_dict = await self._get_objtags(
+                ioctx, obj_name, calculate_hash=False)
+            if tags_dict["sha1sum"] == "":
+                hasher = hashlib.sha1()
+            else:
+                hasher = None
+
+            return_dict = dict()
+            return_dict["namespace"] = namespace
+            return_dict["object"] = obj_name
+            return_dict["tags"] = tags_dict
+
+            # put the value into shared memory if there is room for it, only
+            # the descriptor has to go through the queues then
+            shm_descriptor = await self._read_objval_into_buffer(
+                ioctx, obj_name, obj_size, hasher)
+
+            if shm_descriptor is not None:
+                if hasher is not None:
+                    try:
+                        tags_dict["sha1sum"] = await self._write_objhash(
+                            ioctx, obj_name, hasher,
+                            shm_descriptor["size"] == obj_size)
+                    except:
+                        self._buffer_pool.release(shm_descriptor)
+                        raise
+                return_dict["shm"] = shm_descriptor
+                # the backend manager gives the slot back from now on
+                self._buffer_pool.disown(shm_descriptor)
+                put(return_dict)
+
+            elif obj_size <= self._stream_threshold:
+                # read what is there, the size might have changed since the
+                # stat
+                chunks = list()
+                size = await self._read_chunks(
+                    ioctx, obj_name, 0, obj_size,
+                    lambda offset, chunk: chunks.append(chunk), hasher)
+                if hasher is not None:
+                    tags_dict["sha1sum"] = await self._write_objhash(
+                        ioctx, obj_name, hasher, size == obj_size)
+                return_dict["value"] = b"".join(chunks)
+                put(return_dict)
 
-        tags_dict = self._get_objtags(obj_name)
+            else:
+                # hold back one piece so the last one can be marked as
+                # complete, even if the object has shrunk in the meantime
+                pieces = list()
+
+                def put_piece(offset, chunk):
+                    if pieces:
+                        put(pieces.pop())
+                    piece = dict(return_dict)
+                    piece["size"] = obj_size
+                    piece["offset"] = offset
+                    piece["value"] = chunk
+                    piece["complete"] = False
+                    pieces.append(piece)
+
+                size = await self._read_chunks(
+                    ioctx, obj_name, 0, obj_size, put_piece, hasher)
 
-        self._unset_namespace()
+                if not pieces:
+                    put_piece(0, b"")
+                piece = pieces.pop()
+                piece["complete"] = True
+
+                # the earlier pieces are already on their way, only the last
+                # one carries the sha1sum that has been calculated on the way
+                if hasher is not None:
+                    piece["tags"] = dict(tags_dict)
+                    piece["tags"]["sha1sum"] = await self._write_objhash(
+                        ioctx, obj_name, hasher, size == obj_size)
+
+                put(piece)
+
+    async def read_range_of_object(self, task_info):
+        """
+        Get a range of bytes of a file and all the tags.
+
+        The range is given as a dictionary with "offset" and "length" in the
+        task_info and returned as is. The returned value is shorter than length
+        if the object ends before.
+
+        """
+        namespace = task_info["namespace"]
+        obj_name = task_info["object"]
+        byte_range = task_info["range"]
+
+        with self._namespace_ioctx(namespace) as ioctx:
+            # hashing the whole object would defeat reading only a range of it
+            tags_dict = await self._get_objtags(
+                ioctx, obj_name, calculate_hash=False)
+
+            chunks = list()
+            await self._read_chunks(
+                ioctx, obj_name, byte_range["offset"], byte_range["length"],
+                lambda offset, chunk: chunks.append(chunk))
 
         return_dict = dict()
         return_dict["namespace"] = namespace
         return_dict["object"] = obj_name
         return_dict["tags"] = tags_dict
-        return_dict["value"] = objval
+        return_dict["range"] = byte_range
+        return_dict["value"] = b"".join(chunks)
 
         return return_dict
 
-    def read_tags_for_object(self, task_info):
+    async def read_tags_for_object(self, task_info):
         """
         Get the tags for an object.
 
@@ -547,11 +901,8 @@ class CephConnection(object):
         namespace = task_info["namespace"]
         obj_name = task_info["object"]
 
-        self._set_namespace(namespace)
-
-        tags_dict = self._get_objtags(obj_name)
-
-        self._unset_namespace()
+        with self._namespace_ioctx(namespace) as ioctx:
+            tags_dict = await self._get_objtags(ioctx, obj_name)
 
         return_dict = dict()
         return_dict["namespace"] = namespace
@@ -560,7 +911,7 @@ class CephConnection(object):
 
         return return_dict
 
-    def read_hash_for_object(self, task_info):
+    async def read_hash_for_object(self, task_info):
         """
         This reads the sha1sum from the ceph cluster.
 
@@ -572,11 +923,8 @@ class CephConnection(object):
         namespace = task_info["namespace"]
         obj_name = task_info["object"]
 
-        self._set_namespace(namespace)
-
-        tags_dict = self._get_objtags(obj_name)
-
-        self._unset_namespace()
+        with self._namespace_ioctx(namespace) as ioctx:
+            tags_dict = await self._get_objtags(ioctx, obj_name)
 
         # tags_dict["sha1sum"] = sha1sum
 
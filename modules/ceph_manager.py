@@ -6,10 +6,14 @@ Manages requests from the ceph cluster.
 import time
 import queue
 import asyncio
+import threading
 import multiprocessing
 from contextlib import suppress
 
 import modules.ceph_connection as cc
+import modules.change_feed as cf
+from modules.task_scheduler import TaskScheduler
+from modules.connection_autoscaler import ConnectionAutoscaler
 
 from util.loggers import CoreLog as cl, BackendLog as bl, SimulationLog as sl
 
@@ -31,7 +35,14 @@ class CephManager(object):
                  event_datacopy_ceph_update_index,
                  queue_datacopy_ceph_filename_and_hash,
 
-                 lock_datacopy_ceph_filename_and_hash
+                 lock_datacopy_ceph_filename_and_hash,
+
+                 buffer_pool=None,
+
+                 min_connections=2,
+                 max_connections=12,
+
+                 change_feed_object=None
     ):
 
         self._ceph_conf = ceph_conf
@@ -59,14 +70,65 @@ class CephManager(object):
 
         self._lock_datacopy_ceph_filename_and_hash = lock_datacopy_ceph_filename_and_hash
 
+        # shared memory for object data, handed to the ceph connections
+        self._buffer_pool = buffer_pool
+
+        # time at which an object was handed to the ceph connections for
+        # reading, for every object that has not come back yet; requests for
+        # an object that is already being read are dropped and the one answer
+        # is delivered to all of them by the backend manager
+        self._object_data_requests_in_flight = dict()
+        # seconds after which a read is considered lost and can be requested
+        # again (e.g. because the ceph connection reading it died); shorter
+        # than the download timeout of the backend manager, so a request it
+        # sends again is never dropped
+        self._object_data_request_timeout = 5
+
+        # the input queues are read by blocking threads, which only wake up
+        # this often to notice the shutdown
+        self._dispatch_poll_time = 1
+        # at most this many items are taken from a queue in one go
+        self._dispatch_batch_size = 256
+
+        # time at which the index was requested from the ceph connections,
+        # None if it is not being read; further requests while it is being read
+        # are dropped, the index is fresh once it arrives
+        self._index_requested_at = None
+        # reading the index of a large cluster takes a while, after this many
+        # seconds it is considered lost and can be requested again
+        self._index_request_timeout = 60 * 60
+        # the index is handed to the data copy in messages of this many
+        # objects of a namespace
+        self._index_batch_size = 10000
+        # namespaces of the index that is being read which have not arrived
+        # yet, None until the list of namespaces is known; namespaces that
+        # arrive before the list are remembered in _index_namespaces_done
+        self._index_namespaces_pending = None
+        self._index_namespaces_done = set()
+        # index tasks (of the whole index and of namespaces) that the ceph
+        # connections are working on, by the slot of the connection; the tasks
+        # of a connection that stops (or dies) before it is done are handed to
+        # the others again, a task is given up after this many attempts
+        self._index_tasks_by_slot = dict()
+        self._index_task_attempts = 2
+
         # inter process communication between ceph manager and cepj connections
-        self._queue_ceph_process_new_task = multiprocessing.Queue()
-        self._queue_ceph_process_new_task_data = multiprocessing.Queue()
-        self._queue_ceph_process_new_task_hashes = multiprocessing.Queue()
-        self._queue_ceph_process_new_task_index_hashes = multiprocessing.Queue()
-        self._queue_ceph_process_new_task_index_namespaces = multiprocessing.Queue()
-        self._queue_ceph_process_new_task_index = multiprocessing.Queue()
-        self._event_ceph_process_shutdown = multiprocessing.Event()
+        #
+        # tasks for the ceph connections, from the most to the least important:
+        # downloads for the backend, hashes of new files, reading the index of
+        # a namespace and reading the whole index
+        self._task_scheduler = TaskScheduler(
+            ["data", "hashes", "index_namespaces", "index"])
+
+        # the number of ceph connections follows the load; every connection
+        # works on this many tasks at the same time (see
+        # CephConnection._max_concurrent_tasks)
+        self._autoscaler = ConnectionAutoscaler(
+            min_connections, max_connections, tasks_per_connection=32)
+        # seconds between two looks at the load
+        self._autoscale_interval = 5
+        # seconds a stopping connection gets to finish its tasks
+        self._connection_stop_timeout = 10
 
         self._queue_ceph_process_index = multiprocessing.Queue()  # gets a list of namespaces
         self._queue_ceph_process_namespace_index = multiprocessing.Queue()  # gets an index for a namespace
@@ -74,8 +136,15 @@ class CephManager(object):
         self._queue_ceph_process_object_data = multiprocessing.Queue()
         self._queue_ceph_process_object_hash = multiprocessing.Queue()
 
+        # changes that writers publish on this object of the cluster are
+        # followed by a process of its own, None if they are not
+        self._change_feed_object = change_feed_object
+        self._change_feed = None
+        self._queue_ceph_process_changes = multiprocessing.Queue()
+
         # start the ceph connections
         self._start_ceph_connections()
+        self._start_change_feed()
 
         self._loop = asyncio.get_event_loop()
 
@@ -111,195 +180,711 @@ class CephManager(object):
 
     def _start_ceph_connections(self):
         """
-        Start a list of ceph connections.
+        Start the smallest number of ceph connections.
 
         """
-        # number of concurrent connections to the ceph cluster; pool size
-        num_conns = 10          # at least 2
+        # running connections by their slot in the autoscaler, each with
+        # its own shutdown event
+        self._connections = dict()
+        # connections that have been asked to stop but are still finishing
+        # their tasks, with the time they have been asked
+        self._stopping_connections = dict()
 
-        assert(num_conns > 1)
+        for _ in range(self._autoscaler.min_connections):
+            self._start_ceph_connection()
 
-        self._conns = []
+        # give them some time to boot up
+        time.sleep(.1)
 
-        workers = [
-            {"pattern": "data", "count": 4},
-            {"pattern": "hashes", "count": 6},
-            {"pattern": "index_namespaces", "count": 8},
-            {"pattern": "index", "count": 1}
-        ]
+    def _start_ceph_connection(self):
+        """
+        Start a ceph connection in a free slot.
+
+        """
+        used_slots = (set(self._connections.keys()) |
+                      set(self._stopping_connections.keys()))
+        free_slots = [slot
+                      for slot in range(self._autoscaler.max_connections)
+                      if slot not in used_slots]
+        if not free_slots:
+            return
+
+        slot = free_slots[0]
+        self._autoscaler.reset(slot)
+
+        event_shutdown = multiprocessing.Event()
+
+        conn = multiprocessing.Process(
+            target=cc.CephConnection,
+            args=(
+                self._ceph_conf,
+                self._ceph_pool,
+                self._ceph_user,
+                self._task_scheduler,
+                event_shutdown,
+                self._queue_ceph_process_index,
+                self._queue_ceph_process_namespace_index,
+                self._queue_ceph_process_object_tags,
+                self._queue_ceph_process_object_data,
+                self._queue_ceph_process_object_hash,
+                self._buffer_pool,
+                self._autoscaler,
+                slot
+            )
+        )
+        conn.start()
 
-        for wrkr_type in workers:
-
-            # need at least 1 of each
-            assert(wrkr_type["count"] >= 1)
-
-            for _ in range(wrkr_type["count"]):
-
-                conn = multiprocessing.Process(
-                    target=cc.CephConnection,
-                    args=(
-                        self._ceph_conf,
-                        self._ceph_pool,
-                        self._ceph_user,
-                        wrkr_type["pattern"],
-                        self._queue_ceph_process_new_task,
-                        self._queue_ceph_process_new_task_data,
-                        self._queue_ceph_process_new_task_hashes,
-                        self._queue_ceph_process_new_task_index_namespaces,
-                        self._queue_ceph_process_new_task_index,
-                        self._event_ceph_process_shutdown,
-                        self._queue_ceph_process_index,
-                        self._queue_ceph_process_namespace_index,
-                        self._queue_ceph_process_object_tags,
-                        self._queue_ceph_process_object_data,
-                        self._queue_ceph_process_object_hash
-                    )
-                )
-                self._conns.append(conn)
-
-        if len(self._conns) < 2:
-            raise Exception("Need at least two concurrent connections to "
-                            "the cluster")
-
-        # start the connections
-        for conn in self._conns:
-            conn.start()
+        self._connections[slot] = {
+            "process": conn,
+            "shutdown": event_shutdown
+        }
 
-        # give them some time to boot up
+        cl.verbose("Started ceph connection {}".format(slot))
+
+    def _start_change_feed(self):
+        """
+        Start following the change feed, if it is used.
+
+        """
+        if self._change_feed_object is None:
+            return
+
+        event_shutdown = multiprocessing.Event()
+
+        feed = multiprocessing.Process(
+            target=cf.ChangeFeed,
+            args=(
+                self._ceph_conf,
+                self._ceph_pool,
+                self._ceph_user,
+                event_shutdown,
+                self._queue_ceph_process_changes,
+                self._change_feed_object
+            )
+        )
+        feed.start()
+
+        self._change_feed = {
+            "process": feed,
+            "shutdown": event_shutdown
+        }
+
+        cl.verbose("Following the change feed on {}".format(
+            self._change_feed_object))
+
+    def _stop_ceph_connection(self):
+        """
+        Ask an idle ceph connection to stop. Returns False if all of them are
+        busy.
+
+        """
+        idle_slots = [slot for slot in self._connections.keys()
+                      if self._autoscaler.running(slot) == 0]
+        if not idle_slots:
+            return False
+
+        slot = max(idle_slots)
+        connection = self._connections.pop(slot)
+        connection["shutdown"].set()
+        connection["stopping_since"] = time.time()
+        self._stopping_connections[slot] = connection
+
+        cl.verbose("Stopping ceph connection {}".format(slot))
+
+        return True
+
+    def _reap_ceph_connections(self):
+        """
+        Clean up after connections that have stopped (or died).
+
+        """
+        now = time.time()
+
+        for slot, connection in list(self._stopping_connections.items()):
+            if connection["process"].is_alive():
+                if (now - connection["stopping_since"] <=
+                    self._connection_stop_timeout):
+                    continue
+                connection["process"].terminate()
+            connection["process"].join()
+            del self._stopping_connections[slot]
+            self._autoscaler.reset(slot)
+            self._recover_index_tasks(slot)
+            self._release_buffers(slot)
+
+        for slot, connection in list(self._connections.items()):
+            if not connection["process"].is_alive():
+                cl.warning("Ceph connection {} has died".format(slot))
+                connection["process"].join()
+                del self._connections[slot]
+                self._autoscaler.reset(slot)
+                self._recover_index_tasks(slot)
+                self._release_buffers(slot)
+
+        if (self._change_feed is not None and
+                not self._change_feed["process"].is_alive()):
+            cl.warning("Change feed has died, starting it again")
+            self._change_feed["process"].join()
+            self._start_change_feed()
+
+    def _release_buffers(self, slot):
+        """
+        Give the shared buffers back that a connection was still reading into
+        when it stopped (e.g. it was terminated in the middle of a read).
+
+        """
+        if self._buffer_pool is None:
+            return
+
+        released = self._buffer_pool.release_owned_by(slot)
+        if released:
+            cl.warning("Released {} shared buffers of ceph connection "
+                       "{}".format(released, slot))
+
+    async def _autoscale_coro(self):
+        """
+        Adapt the number of ceph connections to the load periodically.
+
+        """
+        while True:
+            await asyncio.sleep(self._autoscale_interval)
+
+            try:
+                self._reap_ceph_connections()
+
+                backlog = sum(self._task_scheduler.backlog().values())
+                current = len(self._connections)
+                desired = self._autoscaler.desired_connections(
+                    list(self._connections.keys()), backlog)
+
+                if desired != current:
+                    cl.verbose("Scaling from {} to {} ceph connections ({} "
+                               "tasks waiting)".format(
+                                   current, desired, backlog))
+
+                for _ in range(desired - current):
+                    self._start_ceph_connection()
+
+                for _ in range(current - desired):
+                    if not self._stop_ceph_connection():
+                        break
+
+            except Exception as e:
+                cl.error("Could not scale the ceph connections: {}".format(e))
+
+    def _shutdown_ceph_connections(self):
+        """
+        Stop all ceph connections.
+
+        """
+        connections = (list(self._connections.values()) +
+                       list(self._stopping_connections.values()))
+        if self._change_feed is not None:
+            connections.append(self._change_feed)
+
+        for connection in connections:
+            connection["shutdown"].set()
         time.sleep(.1)
+        for connection in connections:
+            connection["process"].terminate()
+
+    def _object_data_request_key(self, namespace, key, byte_range=None):
+        """
+        Return the key for the requests in flight.
+
+        """
+        if byte_range is None:
+            return (namespace, key)
+        return (namespace, key, byte_range["offset"], byte_range["length"])
+
+    def _object_data_request_in_flight(self, namespace, key, byte_range=None):
+        """
+        Check if an object (or a range of it) is already being read and mark
+        it as being read if it is not.
+
+        """
+        request_key = self._object_data_request_key(namespace, key, byte_range)
+        now = time.time()
+
+        requested_at = self._object_data_requests_in_flight.get(
+            request_key, None)
+        if (requested_at is not None and
+            now - requested_at <= self._object_data_request_timeout):
+            return True
+
+        self._object_data_requests_in_flight[request_key] = now
+        return False
 
     async def _ceph_task_coro(self):
         """
-        Loop over all the possible task queues for ceph.
+        Dispatch the tasks for ceph and the results of the ceph connections.
+
+        Every input queue is watched by a thread that blocks until something
+        arrives and then hands everything that is waiting in the queue to the
+        event loop at once (see _queue_pump), so nothing is polled while the
+        queues are empty.
 
         """
+        stop_pumps = threading.Event()
+
+        inputs = [
+            (self._queue_datacopy_ceph_request_hash_for_new_file,
+             self._handle_hash_request),
+            (self._queue_backend_ceph_request_file,
+             self._handle_file_request),
+            (self._queue_ceph_process_index,
+             self._handle_index),
+            (self._queue_ceph_process_namespace_index,
+             self._handle_namespace_index),
+            (self._queue_ceph_process_object_hash,
+             self._handle_object_hash),
+            (self._queue_ceph_process_object_data,
+             self._handle_object_data),
+            (self._queue_ceph_process_changes,
+             self._handle_change)
+        ]
+
+        pumps = [
+            threading.Thread(
+                target=self._queue_pump,
+                args=(input_queue, handler, stop_pumps),
+                daemon=True)
+            for input_queue, handler in inputs
+        ]
+        pumps.append(
+            threading.Thread(
+                target=self._index_request_pump,
+                args=(stop_pumps, ),
+                daemon=True))
+
+        autoscale_task = self._loop.create_task(self._autoscale_coro())
+
         try:
+            for pump in pumps:
+                pump.start()
 
-            # seems sane.. 100 checks per second
-            # set to 0 if we need speed
-            loop_throttle_time = 1e-2
+            # wait for the shutdown, the pumps do the rest
+            while not await self._loop.run_in_executor(
+                    None, self._event_ceph_shutdown.wait,
+                    self._dispatch_poll_time):
+                pass
 
-            while True:
+        finally:
+            stop_pumps.set()
+            autoscale_task.cancel()
 
-                # check for ceph shutdown
-                if self._event_ceph_shutdown.is_set():
-                    break
+            # shut down the ceph connections
+            self._shutdown_ceph_connections()
 
-                ################################################################
+    def _queue_pump(self, input_queue, handler, stop):
+        """
+        Hand the contents of a queue to a handler in the event loop. This runs
+        in its own thread until stop is set.
 
-                # first go through all the tasks and give them to the processes
-                #
-                # index request
-                if self._event_datacopy_ceph_update_index.is_set():
-                    self._event_datacopy_ceph_update_index.clear()
-                    task = {
-                        "task": "read_index",
-                        "task_info": {}
-                    }
-                    self._queue_ceph_process_new_task_index.put(task)
+        Blocks until an item arrives, then takes up to _dispatch_batch_size
+        items that are waiting as well and dispatches them together.
 
-                # request for hash of file
-                try:
-                    hash_request = (
-                        self._queue_datacopy_ceph_request_hash_for_new_file.get(
-                            block=False))
-                    namespace = hash_request["namespace"]
-                    key = hash_request["key"]
-                    task = {
-                        "task": "read_object_hash",
-                        "task_info": {
-                            "namespace": namespace,
-                            "object": key
-                        }
-                    }
-                    self._queue_ceph_process_new_task_hashes.put(task)
-                    # self._queue_ceph_process_new_task.put(task)
-                except queue.Empty:
-                    pass
+        """
+        while not stop.is_set():
+            try:
+                batch = [input_queue.get(True, self._dispatch_poll_time)]
+            except queue.Empty:
+                continue
 
-                # request for everything of file
+            while len(batch) < self._dispatch_batch_size:
                 try:
-                    file_request = (
-                        self._queue_backend_ceph_request_file.get(block=False))
-                    namespace = file_request["namespace"]
-                    key = file_request["key"]
-                    task = {
-                        "task": "read_object_value",
-                        "task_info": {
-                            "namespace": namespace,
-                            "object": key
-                        }
-                    }
-                    self._queue_ceph_process_new_task_data.put(task)
+                    batch.append(input_queue.get(False))
                 except queue.Empty:
-                    pass
+                    break
 
-                ################################################################
+            self._loop.call_soon_threadsafe(
+                self._dispatch_batch, handler, batch)
 
-                # then go through everything that the processes have done and
-                # return that to the other managers
-                #
-                # get the index and dump it into the data copy
-                try:
-                    fresh_index = self._queue_ceph_process_index.get(block=False)["index"]
+    def _index_request_pump(self, stop):
+        """
+        Request the index when the local data copy asks for it. This runs in
+        its own thread until stop is set.
 
-                except queue.Empty:
-                    # turn rate throttling back on
-                    if not loop_throttle_time:
-                        cl.verbose("Throttling loop again (index is updated)")
-                        loop_throttle_time = 1e-2
+        """
+        while not stop.is_set():
+            if self._event_datacopy_ceph_update_index.wait(
+                    self._dispatch_poll_time):
+                self._event_datacopy_ceph_update_index.clear()
+                self._loop.call_soon_threadsafe(self._request_index)
 
+    def _dispatch_batch(self, handler, batch):
+        """
+        Call a handler for every item of a batch.
+
+        """
+        for item in batch:
+            try:
+                handler(item)
+            except Exception as e:
+                cl.error("Could not dispatch {}: {}".format(item, e))
+
+    def _request_index(self, refresh=False):
+        """
+        Ask the ceph connections for the index, unless it is being read
+        already.
+
+        For a refresh only the object names are listed, the local data copy
+        asks for the tags of the objects it does not know yet.
+
+        """
+        now = time.time()
+        if (self._index_requested_at is not None and
+            now - self._index_requested_at <= self._index_request_timeout):
+            cl.debug("The index is already being read")
+            return
+        self._index_requested_at = now
+        self._index_namespaces_pending = None
+        self._index_namespaces_done = set()
+
+        task = {
+            "task": "read_index",
+            "task_info": {"refresh": refresh}
+        }
+        self._task_scheduler.put("index", task)
+
+    def _track_index_task(self, slot, task):
+        """
+        Remember an index task a ceph connection has started.
+
+        """
+        self._index_tasks_by_slot.setdefault(slot, list()).append(task)
+
+    def _untrack_index_task(self, slot, task_name, namespace=None,
+                            partial=False):
+        """
+        Forget an index task a ceph connection is done with.
+
+        """
+        tasks = self._index_tasks_by_slot.get(slot, list())
+
+        for task in tasks:
+            task_info = task["task_info"]
+            if (task["task"] == task_name and
+                    task_info.get("namespace", None) == namespace and
+                    task_info.get("partial", False) == partial):
+                tasks.remove(task)
+                break
+
+        if not tasks:
+            self._index_tasks_by_slot.pop(slot, None)
+
+    def _recover_index_tasks(self, slot):
+        """
+        Hand the index tasks of a ceph connection that has stopped (or died)
+        to the other connections again, or give up on them.
+
+        """
+        for task in self._index_tasks_by_slot.pop(slot, list()):
+            task_info = task["task_info"]
+            attempt = task_info.get("attempt", 1)
+
+            if attempt < self._index_task_attempts:
+                cl.warning("Ceph connection {} has not finished {}, "
+                           "trying again".format(slot, task))
+                task_info["attempt"] = attempt + 1
+                if task["task"] == "read_index":
+                    self._index_requested_at = time.time()
+                    self._task_scheduler.put("index", task)
                 else:
-                    # disable rate throttling so we can get the whole index quickly
-                    cl.verbose("Unthrottling loop (updating index)")
-                    loop_throttle_time = 0
+                    self._task_scheduler.put("index_namespaces", task)
 
-                    with self._lock_datacopy_ceph_filename_and_hash:  # LOCK
+            elif task["task"] == "read_index":
+                self._fail_index()
 
-                        for namespace_index in fresh_index:
-                            namespace = namespace_index["namespace"]
+            else:
+                # the same as a namespace whose index could not be read
+                self._handle_namespace_index({
+                    "namespace": task_info["namespace"],
+                    "index": None,
+                    "partial": task_info.get("partial", False)
+                })
 
-                            for obj in namespace_index["index"].keys():
-                                tags = namespace_index["index"][obj]
+    def _fail_index(self):
+        """
+        Give up on the index that is being read, so it can be requested again
+        right away. The data copy stops waiting for it as well.
 
-                                try:
-                                    sha1sum = tags["sha1sum"]
-                                except KeyError:
-                                    sha1sum = ""
+        """
+        cl.warning("Could not read the index")
 
-                                ns_name_hash = {
-                                    "namespace": namespace,
-                                    "key": obj,
-                                    "sha1sum": sha1sum
-                                }
+        self._index_requested_at = None
+        self._index_namespaces_pending = None
+        self._index_namespaces_done = set()
 
-                                self._queue_datacopy_ceph_filename_and_hash.put(ns_name_hash)
+        self._queue_datacopy_ceph_filename_and_hash.put(
+            {"index_complete": True, "failed": True})
 
-                # get the hash for an object
-                try:
-                    obj_hash = self._queue_ceph_process_object_hash.get(block=False)
-                    new_file_dict = dict()
-                    new_file_dict["namespace"] = obj_hash["namespace"]
-                    new_file_dict["key"] = obj_hash["object"]
-                    new_file_dict["sha1sum"] = obj_hash["tags"]["sha1sum"]
-                    self._queue_datacopy_ceph_answer_hash_for_new_file.put(new_file_dict)
-                except queue.Empty:
-                    pass
+    def _handle_hash_request(self, hash_request):
+        """
+        Ask the ceph connections for the hash of a file.
 
-                # get everything for an object
-                try:
-                    obj_everything = self._queue_ceph_process_object_data.get(block=False)
-                    self._queue_backend_ceph_answer_file_name_contents_hash.put(obj_everything)
-                except queue.Empty:
-                    pass
+        The local data copy also asks for refreshing the index here, and for
+        the tags of the objects of a namespace that it found to be new during
+        a refresh.
 
-                ################################################################
+        """
+        if hash_request.get("refresh_index", False):
+            self._request_index(refresh=True)
+            return
+
+        if "keys" in hash_request:
+            task = {
+                "task": "read_namespace_index",
+                "task_info": {
+                    "namespace": hash_request["namespace"],
+                    "objects": hash_request["keys"],
+                    "partial": True
+                }
+            }
+            self._task_scheduler.put("index_namespaces", task)
+            return
+
+        task = {
+            "task": "read_object_hash",
+            "task_info": {
+                "namespace": hash_request["namespace"],
+                "object": hash_request["key"]
+            }
+        }
+        self._task_scheduler.put("hashes", task)
+
+    def _handle_file_request(self, file_request):
+        """
+        Ask the ceph connections for everything of a file (or a range of it),
+        unless it is already being read.
 
-                await asyncio.sleep(loop_throttle_time)    #  rate throttling
+        """
+        namespace = file_request["namespace"]
+        key = file_request["key"]
+        byte_range = file_request.get("range", None)
+
+        if self._object_data_request_in_flight(namespace, key, byte_range):
+            cl.debug("{}/{} is already being read".format(namespace, key))
+            return
+
+        task = {
+            "task": "read_object_value",
+            "task_info": {
+                "namespace": namespace,
+                "object": key
+            }
+        }
+        if byte_range is not None:
+            task["task_info"]["range"] = byte_range
+        self._task_scheduler.put("data", task)
+
+    def _handle_index(self, index_dict):
+        """
+        Tell the data copy which namespaces are in the index that is being
+        read.
 
-        finally:
-            # shut down the ceph connections
-            self._event_ceph_process_shutdown.set()
-            time.sleep(.1)
-            for conn in self._conns:
-                conn.terminate()
+        """
+        if "started" in index_dict:
+            self._track_index_task(index_dict["slot"], index_dict["started"])
+            return
+
+        self._untrack_index_task(index_dict.get("slot", None), "read_index")
+
+        namespaces = index_dict["namespaces"]
+        if namespaces is None:
+            self._fail_index()
+            return
+
+        cl.info("Reading the index of {} namespaces".format(len(namespaces)))
+
+        self._queue_datacopy_ceph_filename_and_hash.put(
+            {"index_namespaces": namespaces})
+
+        self._index_namespaces_pending = (
+            set(namespaces) - self._index_namespaces_done)
+        self._index_namespaces_done = set()
+
+        self._check_index_complete()
+
+    def _handle_namespace_index(self, namespace_index):
+        """
+        Dump the fresh index of a namespace into the data copy.
+
+        """
+        namespace = namespace_index["namespace"]
+
+        if "started" in namespace_index:
+            self._track_index_task(
+                namespace_index["slot"], namespace_index["started"])
+            return
+
+        if "slot" in namespace_index:
+            self._untrack_index_task(
+                namespace_index["slot"], "read_namespace_index", namespace,
+                namespace_index.get("partial", False))
+
+        # the tags of some objects that are new to the data copy, this is not
+        # part of the index that is being read
+        if namespace_index.get("partial", False):
+            self._handle_partial_namespace_index(namespace_index)
+            return
+
+        if "listing" in namespace_index:
+            # refreshing the index, the data copy compares the names
+            self._forward_namespace(
+                namespace,
+                {"listed_keys": namespace_index["listing"]},
+                {"namespace": namespace, "namespace_complete": True})
+        elif namespace_index["index"] is None:
+            cl.warning("Index for namespace {} is missing".format(namespace))
+            self._queue_datacopy_ceph_filename_and_hash.put({
+                "namespace": namespace,
+                "namespace_complete": True,
+                "failed": True
+            })
+        else:
+            keys, sha1sums = self._index_columns(namespace_index["index"])
+            self._forward_namespace(
+                namespace,
+                {"keys": keys, "sha1sums": sha1sums},
+                {"namespace": namespace, "namespace_complete": True})
+
+        if self._index_namespaces_pending is None:
+            self._index_namespaces_done.add(namespace)
+        else:
+            self._index_namespaces_pending.discard(namespace)
+
+        self._check_index_complete()
+
+    def _handle_partial_namespace_index(self, namespace_index):
+        """
+        Dump the tags of the objects the data copy has asked for into the data
+        copy.
+
+        """
+        namespace = namespace_index["namespace"]
+
+        if namespace_index["index"] is None:
+            cl.warning("Tags for new objects in namespace {} are "
+                       "missing".format(namespace))
+            self._queue_datacopy_ceph_filename_and_hash.put({
+                "namespace": namespace,
+                "namespace_refreshed": True,
+                "failed": True
+            })
+            return
+
+        keys, sha1sums = self._index_columns(namespace_index["index"])
+        self._forward_namespace(
+            namespace,
+            {"keys": keys, "sha1sums": sha1sums},
+            {"namespace": namespace, "namespace_refreshed": True})
+
+    def _index_columns(self, index):
+        """
+        Return the keys and the sha1sums of the objects in the index of a
+        namespace.
+
+        """
+        keys = list(index.keys())
+        sha1sums = [index[obj].get("sha1sum", "") for obj in keys]
+        return keys, sha1sums
+
+    def _forward_namespace(self, namespace, columns, last_message):
+        """
+        Put lists about the objects of a namespace into the queue for the data
+        copy, followed by last_message.
+
+        columns is a dictionary of lists of the same length that are sent in
+        messages of _index_batch_size objects.
+
+        """
+        length = len(next(iter(columns.values())))
+
+        with self._lock_datacopy_ceph_filename_and_hash:  # LOCK
+
+            # a namespace travels in a few large messages instead of one
+            # per object
+            for start in range(0, length, self._index_batch_size):
+                end = start + self._index_batch_size
+                batch = {"namespace": namespace}
+                for name, column in columns.items():
+                    batch[name] = column[start:end]
+                self._queue_datacopy_ceph_filename_and_hash.put(batch)
+
+            # the namespace can be used (and cleaned up) by the data copy
+            # right away
+            self._queue_datacopy_ceph_filename_and_hash.put(last_message)
+
+    def _check_index_complete(self):
+        """
+        Tell the data copy once every namespace of the index has arrived.
+
+        """
+        if (self._index_namespaces_pending is None or
+                self._index_namespaces_pending):
+            return
+
+        self._index_namespaces_pending = None
+        self._index_requested_at = None
+
+        # the local data copy can now drop the namespaces that are gone
+        self._queue_datacopy_ceph_filename_and_hash.put(
+            {"index_complete": True})
+
+        cl.info("Index is complete")
+
+    def _handle_object_hash(self, obj_hash):
+        """
+        Return the hash for an object to the data copy.
+
+        """
+        new_file_dict = dict()
+        new_file_dict["namespace"] = obj_hash["namespace"]
+        new_file_dict["key"] = obj_hash["object"]
+        new_file_dict["sha1sum"] = obj_hash["tags"]["sha1sum"]
+        self._queue_datacopy_ceph_answer_hash_for_new_file.put(new_file_dict)
+
+    def _handle_change(self, change):
+        """
+        Hand a change from the change feed to the data copy.
+
+        Removed files and new files with a sha1sum go to the data copy like the
+        hashes it asks for, the sha1sum of new files without one is read from
+        the cluster first.
+
+        """
+        new_file_dict = {
+            "namespace": change["namespace"],
+            "key": change["key"],
+            "sha1sum": change["sha1sum"]
+        }
+
+        if change["removed"]:
+            new_file_dict["removed"] = True
+            self._queue_datacopy_ceph_answer_hash_for_new_file.put(
+                new_file_dict)
+        elif change["sha1sum"]:
+            self._queue_datacopy_ceph_answer_hash_for_new_file.put(
+                new_file_dict)
+        else:
+            self._handle_hash_request(new_file_dict)
+
+    def _handle_object_data(self, obj_everything):
+        """
+        Return everything for an object to the backend manager.
+
+        A read that failed comes back with "error" instead of the contents.
+
+        """
+        # large objects arrive in pieces, the read is done with the last one
+        # (or with an error)
+        if obj_everything.get("complete", True):
+            self._object_data_requests_in_flight.pop(
+                self._object_data_request_key(
+                    obj_everything["namespace"],
+                    obj_everything["object"],
+                    obj_everything.get("range", None)),
+                None)
+        self._queue_backend_ceph_answer_file_name_contents_hash.put(
+            obj_everything)
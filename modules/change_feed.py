@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Follow the changes that writers publish on the ceph cluster.
+
+Writers (the simulation or a sidecar next to it) record every file they add or
+remove with publish_change as an omap entry of a control object in the default
+namespace of the pool. The change feed reads the new entries and hands them to
+the ceph manager, so the gateway learns about files without being told through
+the simulation port.
+
+The rados binding of this program has no watch/notify, so the control object is
+read every second. Bindings that do have it wake the change feed up right away.
+
+"""
+import json
+import time
+import uuid
+import asyncio
+import pathlib
+import threading
+
+from util.loggers import CoreLog as cl, BackendLog as bl, SimulationLog as sl
+
+from modules.ceph_connection import CephConnection, rados
+
+
+# object in the default namespace that keeps the changes
+CONTROL_OBJECT = "platt_gateway.changes"
+
+
+def change_entry_key(timestamp):
+    """
+    Return the omap key for a change at timestamp (seconds).
+
+    The keys sort by time, the random part keeps changes of different writers
+    apart.
+
+    """
+    return "{:020d}.{}".format(int(timestamp * 1e6), uuid.uuid4().hex)
+
+
+def change_entry_time(entry_key):
+    """
+    Return the time (seconds) of an omap key, None if it is not a change.
+
+    """
+    try:
+        return int(entry_key.split(".", 1)[0]) / 1e6
+    except ValueError:
+        return None
+
+
+def publish_change(
+        ioctx,
+        namespace,
+        key,
+        sha1sum="",
+        removed=False,
+        control_object=CONTROL_OBJECT
+):
+    """
+    Record that a file has been added (or removed) for the change feed.
+
+    ioctx has to be an IO context of the pool in the default namespace.
+
+    """
+    change = {
+        "namespace": namespace,
+        "key": key,
+        "sha1sum": sha1sum,
+        "removed": removed
+    }
+
+    with rados.WriteOpCtx() as write_op:
+        ioctx.set_omap(
+            write_op,
+            (change_entry_key(time.time()), ),
+            (json.dumps(change).encode(), ))
+        ioctx.operate_write_op(write_op, control_object)
+
+    # wake up change feeds that watch the control object
+    notify = getattr(ioctx, "notify", None)
+    if notify is not None:
+        try:
+            notify(control_object)
+        except rados.Error as e:
+            cl.debug("Could not notify {}: {}".format(control_object, e))
+
+
+class ChangeFeed(CephConnection):
+    """
+    Read the changes that are published on the control object and put them
+    into queue_changes.
+
+    Only changes that are published after the start are read, everything that
+    is older is part of the index. Changes that are older than retention
+    seconds are removed from the control object.
+
+    """
+    def __init__(
+            self,
+            ceph_config,
+            ceph_pool,
+            pool_user,
+            event_shutdown_process,  # when this event is set the feed stops
+            queue_changes,           # return queue for the changes
+            control_object=CONTROL_OBJECT,
+            retention=60 * 60
+    ):
+        """
+        Connect to the cluster and follow the changes.
+
+        """
+        self._conffile = str(pathlib.Path(ceph_config))
+        self._target_pool = ceph_pool
+        self._rados_id = pool_user
+
+        self._event_shutdown_process = event_shutdown_process
+        self._queue_changes = queue_changes
+
+        self._control_object = control_object
+        self._retention = retention
+
+        # seconds between reading the control object, and when a watch tells
+        # about new changes
+        self._poll_interval = 1
+        self._watch_poll_interval = 30
+
+        # the clocks of the writers are not exactly in sync, so the changes
+        # of the last few seconds are read again and the known ones skipped
+        self._clock_skew = 10
+
+        # changes read from the control object in one go
+        self._max_entries = 1000
+
+        # seconds between removing old changes
+        self._trim_interval = 60
+
+        self._blocking_workers = 2
+
+        self._rados_latency = 0
+        self._rados_latency_weight = 5e-2
+
+        # time of the newest change and the keys of the changes read in the
+        # last _clock_skew seconds before it
+        self._newest_change = time.time()
+        self._seen_changes = dict()
+
+        self._notified = threading.Event()
+        self._watch = None
+
+        self._connect()
+
+        try:
+            self._loop = asyncio.get_event_loop()
+            self._loop.run_until_complete(self._follow_coro())
+
+        except KeyboardInterrupt:
+            # Ctrl C passes quietly
+            pass
+
+        finally:
+            if self._watch is not None:
+                self._watch.close()
+            self.__del__()
+            cl.debug("Shutdown of change feed process complete")
+
+    def _start_watch(self):
+        """
+        Watch the control object if the rados binding can do it.
+
+        """
+        watch = getattr(self._ioctx, "watch", None)
+        if watch is None:
+            cl.verbose("Reading the change feed every {} seconds".format(
+                self._poll_interval))
+            return
+
+        try:
+            self._watch = watch(
+                self._control_object,
+                lambda *args: self._notified.set())
+        except rados.Error as e:
+            cl.warning("Could not watch {}: {}".format(
+                self._control_object, e))
+
+    async def _follow_coro(self):
+        """
+        Read the changes until the shutdown event is set.
+
+        """
+        self._start_watch()
+
+        if self._watch is None:
+            poll_interval = self._poll_interval
+        else:
+            poll_interval = self._watch_poll_interval
+
+        last_trim = 0
+
+        while not self._event_shutdown_process.is_set():
+
+            try:
+                changes = await self._blocking(self._read_changes)
+                for change in changes:
+                    self._queue_changes.put(change)
+
+                if time.time() - last_trim >= self._trim_interval:
+                    last_trim = time.time()
+                    await self._blocking(self._trim_changes)
+
+            except rados.Error as e:
+                cl.error("Could not read the change feed: {}".format(e))
+
+            # a notification cuts the wait short
+            await self._loop.run_in_executor(
+                None, self._notified.wait, poll_interval)
+            self._notified.clear()
+
+    def _read_changes(self):
+        """
+        Return the changes that have been published since the last call.
+
+        """
+        changes = list()
+
+        start_after = "{:020d}".format(
+            int((self._newest_change - self._clock_skew) * 1e6))
+
+        while True:
+            with rados.ReadOpCtx() as read_op:
+                entries, _ = self._ioctx.get_omap_vals(
+                    read_op, start_after, "", self._max_entries)
+                try:
+                    self._ioctx.operate_read_op(read_op, self._control_object)
+                except rados.ObjectNotFound:
+                    # nothing has been published yet
+                    return changes
+                entries = list(entries)
+
+            for entry_key, value in entries:
+                entry_time = change_entry_time(entry_key)
+                if entry_time is None or entry_key in self._seen_changes:
+                    continue
+                self._seen_changes[entry_key] = entry_time
+                # a writer whose clock is ahead must not hide the others
+                self._newest_change = max(
+                    self._newest_change, min(entry_time, time.time()))
+
+                try:
+                    change = json.loads(value.decode())
+                    changes.append({
+                        "namespace": change["namespace"],
+                        "key": change["key"],
+                        "sha1sum": change.get("sha1sum", ""),
+                        "removed": change.get("removed", False)
+                    })
+                except (ValueError, KeyError, TypeError):
+                    cl.warning("Can not read change {}".format(entry_key))
+
+            if len(entries) < self._max_entries:
+                break
+            start_after = entries[-1][0]
+
+        # the changes before the window are not read again
+        window_start = self._newest_change - self._clock_skew
+        for entry_key, entry_time in list(self._seen_changes.items()):
+            if entry_time < window_start:
+                del self._seen_changes[entry_key]
+
+        return changes
+
+    def _trim_changes(self):
+        """
+        Remove the changes that are older than the retention time.
+
+        """
+        cutoff = "{:020d}".format(int((time.time() - self._retention) * 1e6))
+
+        old_keys = list()
+        start_after = ""
+
+        while True:
+            with rados.ReadOpCtx() as read_op:
+                keys, _ = self._ioctx.get_omap_keys(
+                    read_op, start_after, self._max_entries)
+                try:
+                    self._ioctx.operate_read_op(read_op, self._control_object)
+                except rados.ObjectNotFound:
+                    return
+                keys = [key for key, _ in keys]
+
+            old_keys.extend(key for key in keys if key < cutoff)
+
+            if len(keys) < self._max_entries or keys[-1] >= cutoff:
+                break
+            start_after = keys[-1]
+
+        if not old_keys:
+            return
+
+        with rados.WriteOpCtx() as write_op:
+            self._ioctx.remove_omap_keys(write_op, tuple(old_keys))
+            self._ioctx.operate_write_op(write_op, self._control_object)
+
+        cl.verbose("Removed {} old changes from the change feed".format(
+            len(old_keys)))
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Decide how many connections to the ceph cluster are needed.
+
+The ceph connections report how many tasks they are working on and how long
+the cluster takes to answer, the ceph manager asks for the number of
+connections that fits the load.
+
+"""
+import math
+import time
+import ctypes
+import multiprocessing
+
+from util.loggers import CoreLog as cl, BackendLog as bl, SimulationLog as sl
+
+
+class ConnectionAutoscaler(object):
+    """
+    Size the pool of ceph connections between min_connections and
+    max_connections.
+
+    Every connection gets a slot (0 to max_connections - 1) in which it reports
+    the number of tasks it is running and the average latency of its rados
+    operations. Create the autoscaler before starting the connections and hand
+    it to every connection together with its slot.
+
+    Enough connections are kept to run all running and waiting tasks with
+    every connection using target_utilization of its tasks_per_connection. More
+    connections are only added while the cluster answers faster than
+    max_latency on average, a slow cluster does not get faster with more
+    sessions. Connections are removed one at a time and only after the load
+    has been low for scale_down_delay seconds.
+
+    """
+    def __init__(
+            self,
+            min_connections,
+            max_connections,
+            tasks_per_connection,
+            target_utilization=.75,
+            max_latency=.5,
+            scale_down_delay=30
+    ):
+        if not 1 <= min_connections <= max_connections:
+            raise ValueError("Need 1 <= min_connections <= max_connections")
+
+        self._min_connections = min_connections
+        self._max_connections = max_connections
+        self._tasks_per_connection = tasks_per_connection
+        self._target_utilization = target_utilization
+        self._max_latency = max_latency
+        self._scale_down_delay = scale_down_delay
+
+        # every slot is only written by its connection, no locks needed
+        self._running = multiprocessing.RawArray(ctypes.c_int, max_connections)
+        self._latency = multiprocessing.RawArray(
+            ctypes.c_double, max_connections)
+
+        # time since which fewer connections would do
+        self._low_load_since = None
+
+    @property
+    def min_connections(self):
+        return self._min_connections
+
+    @property
+    def max_connections(self):
+        return self._max_connections
+
+    def report(self, slot, running=None, latency=None):
+        """
+        Report the number of running tasks and the average latency of a
+        connection.
+
+        """
+        if running is not None:
+            self._running[slot] = running
+        if latency is not None:
+            self._latency[slot] = latency
+
+    def reset(self, slot):
+        """
+        Forget what a connection has reported, e.g. when it has stopped.
+
+        """
+        self._running[slot] = 0
+        self._latency[slot] = 0
+
+    def running(self, slot):
+        """
+        Return the number of tasks a connection is working on.
+
+        """
+        return self._running[slot]
+
+    def latency(self, slots):
+        """
+        Return the average latency of the connections in slots, connections
+        that have not reported any are left out.
+
+        """
+        latencies = [self._latency[slot] for slot in slots
+                     if self._latency[slot] > 0]
+        if not latencies:
+            return 0
+        return sum(latencies) / len(latencies)
+
+    def desired_connections(self, slots, backlog, now=None):
+        """
+        Return the number of connections needed for the load.
+
+        slots are the slots of the running connections and backlog is the
+        number of tasks that wait for a connection.
+
+        """
+        if now is None:
+            now = time.monotonic()
+
+        current = len(slots)
+
+        running = sum(self._running[slot] for slot in slots)
+        desired = math.ceil(
+            (running + backlog) /
+            (self._tasks_per_connection * self._target_utilization))
+        desired = max(self._min_connections,
+                      min(self._max_connections, desired))
+
+        if current < self._min_connections:
+            self._low_load_since = None
+            return desired
+
+        if desired > current:
+            self._low_load_since = None
+
+            latency = self.latency(slots)
+            if latency > self._max_latency:
+                cl.verbose("Cluster latency is {:.3f} s, not adding "
+                           "connections".format(latency))
+                return current
+
+            return desired
+
+        if desired < current:
+            if self._low_load_since is None:
+                self._low_load_since = now
+                return current
+
+            if now - self._low_load_since >= self._scale_down_delay:
+                # wait again before removing the next one
+                self._low_load_since = now
+                return current - 1
+
+            return current
+
+        self._low_load_since = None
+        return current
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+A cache for objects from the ceph cluster on the local disk.
+
+The objects are stored under their sha1sum, so a file with the same contents
+is only stored once and can be used again after a restart.
+
+"""
+import os
+import re
+import mmap
+import hashlib
+import pathlib
+import threading
+
+from util.loggers import CoreLog as cl, BackendLog as bl, SimulationLog as sl
+
+
+class DiskCache(object):
+    """
+    Content addressed cache in a local directory.
+
+    Every object is stored in a file named after its sha1sum. Files are handed
+    out as read only memory maps. If the files take up more than max_bytes the
+    least recently used ones are deleted.
+
+    All methods can be called from any thread.
+
+    """
+    def __init__(self, directory, max_bytes):
+        self._directory = pathlib.Path(directory)
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+        self._hits = 0
+        self._misses = 0
+        self._stores = 0
+
+        self._directory.mkdir(parents=True, exist_ok=True)
+
+        # find out how much is stored already and clean up unfinished writes
+        self._bytes = 0
+        for path in self._directory.glob("*/*"):
+            if path.suffix == ".tmp":
+                path.unlink()
+            else:
+                self._bytes += path.stat().st_size
+
+        bl.info("Disk cache in {} holds {:.1f} MiB".format(
+            self._directory, self._bytes / 1024 / 1024))
+
+    def _path(self, sha1sum):
+        """
+        Return the path of the file for a sha1sum or None if it is not one.
+
+        """
+        if not re.match(r"^[0-9a-f]{40}$", sha1sum):
+            return None
+        return self._directory / sha1sum[:2] / sha1sum
+
+    def open(self, sha1sum):
+        """
+        Return a read only memory map of the object with sha1sum or None if it
+        is not in the cache.
+
+        """
+        path = self._path(sha1sum)
+        if path is None:
+            return None
+
+        try:
+            with open(str(path), "rb") as cached_file:
+                if os.fstat(cached_file.fileno()).st_size == 0:
+                    contents = b""  # empty files can not be mapped
+                else:
+                    contents = mmap.mmap(
+                        cached_file.fileno(), 0, access=mmap.ACCESS_READ)
+            # remember the time of use for evicting the oldest files
+            os.utime(str(path))
+
+        except FileNotFoundError:
+            with self._lock:
+                self._misses += 1
+            return None
+
+        with self._lock:
+            self._hits += 1
+
+        return contents
+
+    def store(self, sha1sum, data, check_sha1sum=True):
+        """
+        Store an object under its sha1sum.
+
+        The object is only stored if data actually hashes to sha1sum. Callers
+        that already know the sha1sum of data (it came with the object from
+        the cluster) can skip hashing it again with check_sha1sum=False.
+        Returns True if the object is in the cache afterwards.
+
+        """
+        path = self._path(sha1sum)
+        if path is None:
+            return False
+
+        if path.exists():
+            return True
+
+        if len(data) > self._max_bytes:
+            return False
+
+        if check_sha1sum and hashlib.sha1(data).hexdigest() != sha1sum:
+            bl.warning("Contents do not match sha1sum {}, not storing them "
+                       "in the disk cache".format(sha1sum))
+            return False
+
+        path.parent.mkdir(exist_ok=True)
+
+        # write to a temporary file first so no one ever sees half a file
+        tmp_path = path.with_name("{}.{}.tmp".format(
+            sha1sum, threading.get_ident()))
+        with open(str(tmp_path), "wb") as tmp_file:
+            tmp_file.write(data)
+        os.replace(str(tmp_path), str(path))
+
+        with self._lock:
+            self._bytes += len(data)
+            self._stores += 1
+            evict = self._bytes > self._max_bytes
+
+        if evict:
+            self._evict()
+
+        return True
+
+    def _evict(self):
+        """
+        Delete the least recently used files until the cache is below 90 % of
+        its size again.
+
+        Deleted files that are still mapped stay readable until they are
+        unmapped.
+
+        """
+        files = list()
+        for path in self._directory.glob("*/*"):
+            if path.suffix == ".tmp":
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        files.sort()
+
+        total_bytes = sum(size for _, size, _ in files)
+        target_bytes = self._max_bytes * .9
+
+        for _, size, path in files:
+            if total_bytes <= target_bytes:
+                break
+            bl.debug("Removing {} from the disk cache".format(path.name))
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+        with self._lock:
+            self._bytes = total_bytes
+
+    def statistics(self):
+        """
+        Return a dictionary with the counters of the cache.
+
+        """
+        with self._lock:
+            return {
+                "bytes": self._bytes,
+                "max_bytes": self._max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "stores": self._stores
+            }
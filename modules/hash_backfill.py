@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Calculate the sha1sums of all objects on the ceph cluster that do not have one
+yet and write them to the objects.
+
+Otherwise objects without a sha1sum are hashed when they are requested for the
+first time, which puts reading the whole object in front of the download.
+
+"""
+import json
+import time
+import asyncio
+import hashlib
+import pathlib
+
+from util.loggers import CoreLog as cl, BackendLog as bl, SimulationLog as sl
+
+from modules.ceph_connection import CephConnection, rados
+
+
+class HashBackfill(CephConnection):
+    """
+    Scan the pool (or some namespaces of it) and backfill missing sha1sums.
+
+    Up to workers objects are hashed at the same time and reading them is
+    limited to max_rate bytes per second (0 for no limit). Every object that is
+    done is recorded in progress_file, so an interrupted backfill continues
+    where it stopped when it is started again. The file is removed once all
+    objects are done.
+
+    """
+    def __init__(
+            self,
+            ceph_config,
+            ceph_pool,
+            pool_user,
+            namespaces=None,        # only scan these namespaces
+            workers=8,              # number of objects hashed at the same time
+            max_rate=0,             # bytes per second, 0 for no limit
+            progress_file=None,     # file for resuming the backfill
+            restart=False           # ignore the progress of an earlier run
+    ):
+        """
+        Connect to the cluster and run the backfill.
+
+        """
+        self._conffile = str(pathlib.Path(ceph_config))
+        self._target_pool = ceph_pool
+        self._rados_id = pool_user
+
+        self._namespaces = namespaces
+
+        self._workers = workers
+        self._max_rate = max_rate
+
+        if progress_file is None:
+            self._progress_file = None
+        else:
+            self._progress_file = pathlib.Path(progress_file)
+
+        # same reading strategy as the gateway
+        self._read_chunk_size = 4 * 1024 * 1024  # 4 MiB
+        self._parallel_chunk_reads = 4
+        self._blocking_workers = workers
+
+        self._rados_latency = 0
+        self._rados_latency_weight = 5e-2
+
+        # seconds between two progress reports
+        self._progress_interval = 10
+
+        self._throttle_time = 0
+
+        self._statistics = {
+            "objects": 0,
+            "done": 0,
+            "present": 0,
+            "hashed": 0,
+            "failed": 0,
+            "bytes": 0
+        }
+
+        self._connect()
+
+        try:
+            self._loop = asyncio.get_event_loop()
+            self._loop.run_until_complete(self._backfill_coro(restart))
+
+        except KeyboardInterrupt:
+            cl.info("Backfill interrupted, start it again to continue")
+
+        finally:
+            self.__del__()
+
+    def _load_progress(self, restart):
+        """
+        Return the set of (namespace, object) pairs that have been done by an
+        earlier run.
+
+        """
+        done = set()
+
+        if self._progress_file is None:
+            return done
+
+        if restart:
+            try:
+                self._progress_file.unlink()
+            except FileNotFoundError:
+                pass
+            return done
+
+        try:
+            with self._progress_file.open("r") as progress:
+                for line in progress:
+                    try:
+                        namespace, obj_name = json.loads(line)
+                    except ValueError:
+                        continue    # the last line of an interrupted run
+                    done.add((namespace, obj_name))
+
+        except FileNotFoundError:
+            pass
+
+        if done:
+            cl.info("Skipping {} objects that have been done before".format(
+                len(done)))
+
+        return done
+
+    def _list_objects(self):
+        """
+        Return a dictionary with a list of object names for every namespace
+        that is backfilled.
+
+        """
+        if not self._namespaces:
+            return self._list_objects_by_namespace()
+
+        objects_by_namespace = dict()
+
+        for namespace in self._namespaces:
+            with self._namespace_ioctx(namespace) as ioctx:
+                objects_by_namespace[namespace] = [
+                    rados_obj.key for rados_obj in ioctx.list_objects()]
+
+        return objects_by_namespace
+
+    async def _throttle(self, length):
+        """
+        Wait until length more bytes may be read without exceeding max_rate.
+
+        """
+        if not self._max_rate:
+            return
+
+        now = self._loop.time()
+        start = max(now, self._throttle_time)
+        self._throttle_time = start + length / self._max_rate
+
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    async def _backfill_object(self, ioctx, obj_name):
+        """
+        Calculate and write the sha1sum of an object if it has none.
+
+        Returns True if the object had a sha1sum already.
+
+        """
+        tags_dict = await self._blocking(self._get_xattrs, ioctx, obj_name)
+        if tags_dict.get("sha1sum", ""):
+            return True
+
+        obj_size = await self._get_objsize(ioctx, obj_name)
+
+        # read in slices, so the throttle can spread out large objects
+        hasher = hashlib.sha1()
+        slice_size = self._read_chunk_size * self._parallel_chunk_reads
+        offset = 0
+
+        while offset < obj_size:
+            length = min(slice_size, obj_size - offset)
+            await self._throttle(length)
+            end = await self._read_chunks(
+                ioctx, obj_name, offset, length,
+                lambda chunk_offset, chunk: None, hasher)
+            self._statistics["bytes"] += end - offset
+            if end < offset + length:
+                break           # the object has shrunk
+            offset = end
+
+        sha1sum = await self._write_objhash(
+            ioctx, obj_name, hasher, offset == obj_size)
+        if not sha1sum:
+            raise rados.Error("Object has changed while hashing it")
+
+        return False
+
+    async def _worker_coro(self, objects, progress):
+        """
+        Backfill objects from a queue until it is empty.
+
+        """
+        while True:
+            try:
+                namespace, obj_name = objects.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+
+            try:
+                with self._namespace_ioctx(namespace) as ioctx:
+                    present = await self._backfill_object(ioctx, obj_name)
+
+            except rados.ObjectNotFound:
+                # removed since the pool has been listed, nothing to do
+                present = True
+
+            except Exception as e:
+                cl.warning("Could not backfill {}/{}: {}".format(
+                    namespace, obj_name, e))
+                self._statistics["failed"] += 1
+                continue
+
+            if present:
+                self._statistics["present"] += 1
+            else:
+                self._statistics["hashed"] += 1
+            self._statistics["done"] += 1
+
+            if progress is not None:
+                progress.write(json.dumps([namespace, obj_name]) + "\n")
+                progress.flush()
+
+    async def _progress_report_coro(self, start_time):
+        """
+        Report the progress periodically.
+
+        """
+        while True:
+            await asyncio.sleep(self._progress_interval)
+            self._report_progress(start_time)
+
+    def _report_progress(self, start_time):
+        """
+        Log how far the backfill is.
+
+        """
+        statistics = self._statistics
+        duration = max(time.time() - start_time, 1e-3)
+
+        cl.info(
+            "Backfill: {}/{} objects done ({} hashed, {} had a sha1sum, {} "
+            "failed), read {:.1f} MiB at {:.1f} MiB/s".format(
+                statistics["done"], statistics["objects"],
+                statistics["hashed"], statistics["present"],
+                statistics["failed"], statistics["bytes"] / 1024 / 1024,
+                statistics["bytes"] / 1024 / 1024 / duration))
+
+    async def _backfill_coro(self, restart):
+        """
+        List the objects and backfill them with a bounded number of workers.
+
+        """
+        done = self._load_progress(restart)
+
+        cl.info("Listing objects")
+        objects_by_namespace = await self._blocking(self._list_objects)
+
+        objects = asyncio.Queue()
+        for namespace, obj_names in objects_by_namespace.items():
+            for obj_name in obj_names:
+                if (namespace, obj_name) not in done:
+                    objects.put_nowait((namespace, obj_name))
+
+        self._statistics["objects"] = objects.qsize()
+        cl.info("Backfilling {} objects in {} namespaces".format(
+            objects.qsize(), len(objects_by_namespace)))
+
+        progress = None
+        if self._progress_file is not None:
+            self._progress_file.parent.mkdir(parents=True, exist_ok=True)
+            progress = self._progress_file.open("a")
+
+        start_time = time.time()
+        report_task = self._loop.create_task(
+            self._progress_report_coro(start_time))
+
+        try:
+            await asyncio.gather(*[
+                self._worker_coro(objects, progress)
+                for _ in range(self._workers)])
+
+        finally:
+            report_task.cancel()
+            if progress is not None:
+                progress.close()
+
+        self._report_progress(start_time)
+
+        if self._statistics["failed"]:
+            cl.warning("{} objects failed, start the backfill again to "
+                       "retry them".format(self._statistics["failed"]))
+
+        elif self._progress_file is not None:
+            # a later run has to look at every object again
+            self._progress_file.unlink()
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""
+A compact store for the index of the local data copy.
+
+Every file of a namespace is a row in a few columns: its object key, the
+sha1sum as 20 raw bytes and integer codes for the parts of its path in the
+index (timestep, simtype, usage and the rest of the path). The strings behind
+the codes are kept once for all namespaces. The nested dictionaries the backend
+expects are only built when they are asked for.
+
+"""
+import array
+import binascii
+
+from util.loggers import CoreLog as cl, BackendLog as bl, SimulationLog as sl
+
+from modules.key_parser import USAGE_GRAMMAR
+
+
+# a sha1sum takes this many bytes, a row without one has only zeros
+SHA1SUM_SIZE = 20
+NO_SHA1SUM = bytes(SHA1SUM_SIZE)
+
+# codes per row: timestep, simtype, usage and the rest of the path
+PATH_CODES = 4
+
+
+def encode_sha1sum(sha1sum):
+    """
+    Return the 20 bytes of a sha1sum in hex, None if it is something else.
+
+    """
+    if len(sha1sum) != 2 * SHA1SUM_SIZE:
+        return None
+
+    try:
+        raw = binascii.unhexlify(sha1sum)
+    except (binascii.Error, ValueError):
+        return None
+
+    # only what turns back into the same string
+    if raw == NO_SHA1SUM or binascii.hexlify(raw).decode() != sha1sum:
+        return None
+
+    return raw
+
+
+def timestep_in_range(timestep, timesteps):
+    """
+    Check if a timestep lies in the range (first, last) of numbers, either end
+    can be None.
+
+    """
+    first, last = timesteps
+    try:
+        value = float(timestep)
+    except ValueError:
+        return False
+    return (
+        (first is None or value >= first) and
+        (last is None or value <= last))
+
+
+class _NamespaceColumns(object):
+    """
+    The rows of the files of a namespace.
+
+    """
+    __slots__ = ("keys", "rows", "sha1sums", "odd_sha1sums", "paths")
+
+    def __init__(self):
+        self.keys = list()                  # row -> object key
+        self.rows = dict()                  # object key -> row
+        self.sha1sums = bytearray()         # SHA1SUM_SIZE bytes per row
+        self.odd_sha1sums = dict()          # row -> sha1sum that is not hex
+        self.paths = array.array("I")       # PATH_CODES codes per row
+
+
+class IndexStore(object):
+    """
+    The files of all namespaces of the local copy with their sha1sums and
+    their paths in the index.
+
+    A path is a list of strings like [timestep, simtype, usage, ...], every
+    file is a leaf {"object_key": ..., "sha1sum": ...} at the end of its path
+    in the nested view.
+
+    """
+    def __init__(self):
+        # strings (and tuples of strings for the end of the paths) behind the
+        # codes, for all namespaces
+        self._components = list()
+        self._component_codes = dict()
+
+        self._namespaces = dict()
+
+    def __getstate__(self):
+        """
+        Leave out the lookup tables for pickling, they are rebuilt on loading.
+
+        """
+        return {
+            "components": self._components,
+            "namespaces": {
+                namespace: (
+                    columns.keys,
+                    bytes(columns.sha1sums),
+                    columns.odd_sha1sums,
+                    columns.paths.tobytes()
+                )
+                for namespace, columns in self._namespaces.items()
+            }
+        }
+
+    def copy(self):
+        """
+        Return a copy that does not change with this store.
+
+        Only the columns are copied, which is a lot faster than pickling the
+        store, so the copy can be pickled in another thread.
+
+        """
+        store = IndexStore()
+        store._components = list(self._components)
+        store._component_codes = dict(self._component_codes)
+
+        for namespace, columns in self._namespaces.items():
+            copied = _NamespaceColumns()
+            copied.keys = list(columns.keys)
+            copied.rows = dict(columns.rows)
+            copied.sha1sums = bytearray(columns.sha1sums)
+            copied.odd_sha1sums = dict(columns.odd_sha1sums)
+            copied.paths = array.array("I", columns.paths)
+            store._namespaces[namespace] = copied
+
+        return store
+
+    def __setstate__(self, state):
+        """
+        Restore a pickled store.
+
+        """
+        self._components = state["components"]
+        self._component_codes = {
+            component: code
+            for code, component in enumerate(self._components)}
+
+        self._namespaces = dict()
+        for namespace, (keys, sha1sums, odd_sha1sums, paths) in (
+                state["namespaces"].items()):
+            columns = _NamespaceColumns()
+            columns.keys = keys
+            columns.rows = {key: row for row, key in enumerate(keys)}
+            columns.sha1sums = bytearray(sha1sums)
+            columns.odd_sha1sums = odd_sha1sums
+            columns.paths.frombytes(paths)
+            self._namespaces[namespace] = columns
+
+    def _code(self, component):
+        """
+        Return the code of a component of a path.
+
+        """
+        try:
+            return self._component_codes[component]
+        except KeyError:
+            code = len(self._components)
+            self._components.append(component)
+            self._component_codes[component] = code
+            return code
+
+    def _set_sha1sum(self, columns, row, sha1sum):
+        """
+        Store the sha1sum of a row.
+
+        """
+        start = row * SHA1SUM_SIZE
+
+        raw = encode_sha1sum(sha1sum) if sha1sum else NO_SHA1SUM
+        if raw is None:
+            # e.g. made up sha1sums, kept as they are
+            columns.sha1sums[start:start + SHA1SUM_SIZE] = NO_SHA1SUM
+            columns.odd_sha1sums[row] = sha1sum
+        else:
+            columns.sha1sums[start:start + SHA1SUM_SIZE] = raw
+            columns.odd_sha1sums.pop(row, None)
+
+    def _sha1sum(self, columns, row):
+        """
+        Return the sha1sum of a row.
+
+        """
+        try:
+            return columns.odd_sha1sums[row]
+        except KeyError:
+            pass
+
+        start = row * SHA1SUM_SIZE
+        raw = bytes(columns.sha1sums[start:start + SHA1SUM_SIZE])
+        if raw == NO_SHA1SUM:
+            return ""
+        return binascii.hexlify(raw).decode()
+
+    def _path(self, columns, row):
+        """
+        Return the path of a row.
+
+        """
+        start = row * PATH_CODES
+        timestep, simtype, usage, rest = (
+            self._components[code]
+            for code in columns.paths[start:start + PATH_CODES])
+        return [timestep, simtype, usage] + list(rest)
+
+    def add(self, namespace, key, path, sha1sum):
+        """
+        Add a file that is not in the store yet.
+
+        """
+        columns = self._namespaces.get(namespace, None)
+        if columns is None:
+            columns = self._namespaces[namespace] = _NamespaceColumns()
+
+        row = len(columns.keys)
+        columns.keys.append(key)
+        columns.rows[key] = row
+
+        columns.sha1sums.extend(NO_SHA1SUM)
+        self._set_sha1sum(columns, row, sha1sum)
+
+        columns.paths.extend((
+            self._code(path[0]),
+            self._code(path[1]),
+            self._code(path[2]),
+            self._code(tuple(path[3:]))))
+
+    def set_sha1sum(self, namespace, key, sha1sum):
+        """
+        Change the sha1sum of a file in the store.
+
+        """
+        columns = self._namespaces[namespace]
+        self._set_sha1sum(columns, columns.rows[key], sha1sum)
+
+    def get_sha1sum(self, namespace, key):
+        """
+        Return the sha1sum of a file ("" if it is not known), None if the file
+        is not in the store.
+
+        """
+        columns = self._namespaces.get(namespace, None)
+        if columns is None:
+            return None
+
+        row = columns.rows.get(key, None)
+        if row is None:
+            return None
+
+        return self._sha1sum(columns, row)
+
+    def contains(self, namespace, key):
+        """
+        Check if a file is in the store.
+
+        """
+        columns = self._namespaces.get(namespace, None)
+        return columns is not None and key in columns.rows
+
+    def remove(self, namespace, key):
+        """
+        Remove a file from the store. Returns False if it was not there.
+
+        The last row takes the place of the removed one.
+
+        """
+        columns = self._namespaces.get(namespace, None)
+        if columns is None:
+            return False
+
+        row = columns.rows.pop(key, None)
+        if row is None:
+            return False
+
+        columns.odd_sha1sums.pop(row, None)
+
+        last = len(columns.keys) - 1
+        if row != last:
+            moved_key = columns.keys[last]
+            columns.keys[row] = moved_key
+            columns.rows[moved_key] = row
+
+            start, last_start = row * SHA1SUM_SIZE, last * SHA1SUM_SIZE
+            columns.sha1sums[start:start + SHA1SUM_SIZE] = (
+                columns.sha1sums[last_start:last_start + SHA1SUM_SIZE])
+
+            start, last_start = row * PATH_CODES, last * PATH_CODES
+            columns.paths[start:start + PATH_CODES] = (
+                columns.paths[last_start:last_start + PATH_CODES])
+
+            odd_sha1sum = columns.odd_sha1sums.pop(last, None)
+            if odd_sha1sum is not None:
+                columns.odd_sha1sums[row] = odd_sha1sum
+
+        columns.keys.pop()
+        del columns.sha1sums[-SHA1SUM_SIZE:]
+        del columns.paths[-PATH_CODES:]
+
+        if not columns.keys:
+            del self._namespaces[namespace]
+
+        return True
+
+    def namespaces(self):
+        """
+        Return a list of the namespaces with files.
+
+        """
+        return list(self._namespaces.keys())
+
+    def has_namespace(self, namespace):
+        """
+        Check if a namespace has files.
+
+        """
+        return namespace in self._namespaces
+
+    def count(self, namespace=None):
+        """
+        Return the number of files in a namespace (or in all of them).
+
+        """
+        if namespace is not None:
+            columns = self._namespaces.get(namespace, None)
+            return 0 if columns is None else len(columns.keys)
+
+        return sum(len(columns.keys) for columns in self._namespaces.values())
+
+    def keys(self, namespace):
+        """
+        Return a list of the object keys of the files in a namespace.
+
+        """
+        columns = self._namespaces.get(namespace, None)
+        if columns is None:
+            return list()
+        return list(columns.keys)
+
+    def entries(self, namespace):
+        """
+        Yield (object_key, sha1sum) for every file in a namespace.
+
+        """
+        columns = self._namespaces.get(namespace, None)
+        if columns is None:
+            return
+
+        for row, key in enumerate(columns.keys):
+            yield key, self._sha1sum(columns, row)
+
+    def _fieldname_position(self, usage):
+        """
+        Return the position of the fieldname in the rest of the path of a
+        usage, None if it has no fieldname.
+
+        """
+        grammar = USAGE_GRAMMAR.get(usage, None)
+        if grammar is None or "fieldname" not in grammar.path:
+            return None
+        return grammar.path.index("fieldname")
+
+    def _row_selector(self, timesteps, simtype, usage, fieldname):
+        """
+        Return a function that checks if the codes of a row match, None if no
+        row can match.
+
+        """
+        wanted = list()
+        for position, component in ((1, simtype), (2, usage)):
+            if component is None:
+                continue
+            code = self._component_codes.get(component, None)
+            if code is None:
+                return None
+            wanted.append((position, code))
+
+        # what has been decided for the codes of the timesteps and the rest of
+        # the paths
+        timestep_matches = dict()
+        rest_matches = dict()
+
+        def select(codes):
+            for position, code in wanted:
+                if codes[position] != code:
+                    return False
+
+            if timesteps is not None:
+                matches = timestep_matches.get(codes[0], None)
+                if matches is None:
+                    matches = timestep_matches[codes[0]] = (
+                        timestep_in_range(
+                            self._components[codes[0]], timesteps))
+                if not matches:
+                    return False
+
+            if fieldname is not None:
+                matches = rest_matches.get((codes[2], codes[3]), None)
+                if matches is None:
+                    position = self._fieldname_position(
+                        self._components[codes[2]])
+                    rest = self._components[codes[3]]
+                    matches = rest_matches[(codes[2], codes[3])] = (
+                        position is not None and
+                        position < len(rest) and
+                        rest[position] == fieldname)
+                if not matches:
+                    return False
+
+            return True
+
+        return select
+
+    def nested(
+            self,
+            namespace,
+            timesteps=None,
+            simtype=None,
+            usage=None,
+            fieldname=None
+    ):
+        """
+        Return the nested dictionaries of the files in a namespace.
+
+        Only the files that match are included: timesteps is a range (first,
+        last) of numbers (either end can be None), the others have to match
+        the parts of the paths. The fieldname is the one of fields and sets.
+
+        """
+        view = dict()
+
+        columns = self._namespaces.get(namespace, None)
+        if columns is None:
+            return view
+
+        if (
+                timesteps is None and simtype is None and
+                usage is None and fieldname is None
+        ):
+            select = None
+        else:
+            select = self._row_selector(timesteps, simtype, usage, fieldname)
+            if select is None:
+                return view
+
+        for row, key in enumerate(columns.keys):
+            if select is not None:
+                start = row * PATH_CODES
+                if not select(columns.paths[start:start + PATH_CODES]):
+                    continue
+
+            i_entry = view
+            for path_key in self._path(columns, row):
+                i_entry = i_entry.setdefault(path_key, {})
+            i_entry['object_key'] = key
+            i_entry['sha1sum'] = self._sha1sum(columns, row)
+
+        return view
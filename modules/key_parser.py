@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Parse the object keys of the simulation files.
+
+A key looks like "universe.fo.SIMTYPE.USAGE[.PART[.PART]]@TIMESTEP", e.g.
+"universe.fo.ta.skin.outer.c3d8@0000000001.000000". Which parts follow the
+usage is given by a table. Only the timestep differs between the files of a
+mesh or field, so the part before the @ is parsed once and the result is kept
+for the following keys.
+
+"""
+import collections
+
+from util.loggers import CoreLog as cl, BackendLog as bl, SimulationLog as sl
+
+
+KEY_PREFIX = "universe.fo."
+
+# the simtypes of the supported file formats
+SIMTYPES = frozenset(["ta", "ma"])
+
+
+ParsedKey = collections.namedtuple(
+    "ParsedKey",
+    ["timestep", "simtype", "usage", "fieldname", "elemtype", "skintype"])
+
+
+# minimum number of parts (simtype and usage included), position of the
+# fieldname, elemtype and skintype in the parts (None if there is none) and
+# the names of the parts that go into the path of the index
+_Grammar = collections.namedtuple(
+    "_Grammar",
+    ["length", "fieldname", "elemtype", "skintype", "path"])
+
+USAGE_GRAMMAR = {
+    # fields
+    "nodal": _Grammar(3, 2, 3, None, ("fieldname", )),
+    "elemental": _Grammar(3, 2, 3, None, ("fieldname", "elemtype")),
+    # meshes
+    "nodes": _Grammar(2, None, None, None, ()),
+    "elements": _Grammar(3, None, 2, None, ("elemtype", )),
+    "skin": _Grammar(4, None, 3, 2, ("skintype", "elemtype")),
+    "elementactivationbitmap": _Grammar(3, None, 2, None, ("elemtype", )),
+    "elset": _Grammar(4, 2, 3, None, ("fieldname", "elemtype")),
+    "nset": _Grammar(3, 2, None, None, ("fieldname", )),
+    "boundingbox": _Grammar(2, None, None, None, ())
+}
+
+# parts that are not there (e.g. the optional elemtype of fields) are None
+_PADDING = (None, ) * 4
+
+# the parsed objects (the part of a key between the prefix and the @) with
+# the fields of the ParsedKey after the timestep and the path after the
+# timestep, None for objects that can not be parsed
+_parsed_objects = dict()
+_max_parsed_objects = 1 << 16
+
+
+def _parse_objects(objects):
+    """
+    Parse the part of a key between the prefix and the @.
+
+    Returns a tuple with the fields of the ParsedKey after the timestep and
+    the path after the timestep, None if it can not be parsed.
+
+    """
+    parts = objects.split(".")
+
+    if len(parts) < 2 or parts[0] not in SIMTYPES:
+        return None
+
+    grammar = USAGE_GRAMMAR.get(parts[1], None)
+    if grammar is None or len(parts) < grammar.length:
+        return None
+
+    parts.extend(_PADDING)
+
+    fields = (
+        parts[0],
+        parts[1],
+        None if grammar.fieldname is None else parts[grammar.fieldname],
+        None if grammar.elemtype is None else parts[grammar.elemtype],
+        None if grammar.skintype is None else parts[grammar.skintype])
+
+    named_fields = dict(zip(ParsedKey._fields[1:], fields))
+    path = [parts[0], parts[1]]
+    path.extend(named_fields[name] for name in grammar.path)
+
+    return fields, path
+
+
+def _split_key(key):
+    """
+    Return the timestep of a key and its parsed objects, None if the key can
+    not be parsed.
+
+    """
+    # the key ends at a second prefix
+    split_key = key.split(KEY_PREFIX, 2)
+    if len(split_key) < 2:
+        return None
+
+    objects, found, timestep = split_key[1].partition("@")
+    if not found or "@" in timestep:
+        return None
+
+    try:
+        parsed_objects = _parsed_objects[objects]
+    except KeyError:
+        if len(_parsed_objects) >= _max_parsed_objects:
+            _parsed_objects.clear()
+        parsed_objects = _parsed_objects[objects] = _parse_objects(objects)
+
+    if parsed_objects is None:
+        return None
+
+    return timestep, parsed_objects
+
+
+def parse_key(key):
+    """
+    Return the ParsedKey of an object key, None if it can not be parsed.
+
+    """
+    split_key = _split_key(key)
+    if split_key is None:
+        return None
+
+    timestep, (fields, _) = split_key
+    return ParsedKey(timestep, *fields)
+
+
+def index_path(key):
+    """
+    Return the path of an object key in the index, None if the key can not
+    be parsed.
+
+    The path is [timestep, simtype, usage, ...] with the parts of the usage
+    (see USAGE_GRAMMAR).
+
+    """
+    split_key = _split_key(key)
+    if split_key is None:
+        return None
+
+    timestep, (_, path) = split_key
+    return [timestep] + path
@@ -3,21 +3,80 @@
 Manages the local copy of the data on the ceph cluster.
 
 """
+import os
+import time
+import uuid
 import queue
+import pickle
 import asyncio
+import pathlib
+import collections
 import multiprocessing
+import concurrent.futures
 
 from util.loggers import CoreLog as cl, BackendLog as bl, SimulationLog as sl
 
+from modules import key_parser
+from modules.index_store import IndexStore, timestep_in_range
+from modules.presence_filter import PresenceFilter
+
 class LocalDataManager(object):
     """
     A local copy of the data on the ceph cluster.
 
     """
     _instance = None
-    _hashset = set()
-    _local_copy = dict()
+    _index_store = IndexStore()
     _file_queue = None
+    _queue_backend_datacopy_index_query = None
+
+    # bumped every time something in a namespace changes
+    _namespace_versions = dict()
+
+    # bumped with every change of the local copy; the last changes are kept
+    # as (version, namespace, key) for answering the backend with the changes
+    # since a version, the index id tells the runs apart
+    _index_version = 0
+    _index_id = uuid.uuid4().hex
+    _index_change_log_size = 100000
+    _index_changes = collections.deque(maxlen=_index_change_log_size)
+
+    # persisting the local copy between runs
+    _index_snapshot_file = None
+    _index_snapshot_format = 2
+    _index_snapshot_interval = 60  # seconds
+    _index_dirty = False
+    # the snapshot is pickled and written in a thread of its own from a copy
+    # of the local copy, while the event loop goes on
+    _index_snapshot_executor = None
+    _loop = None
+    # filter of the names in the local copy that is written next to the
+    # snapshot, with the version of the index it has been updated to; it is
+    # only touched while the snapshot is written
+    _presence_filter = None
+    _presence_filter_version = None
+
+    # refreshing the index only reads the tags of new objects, 0 disables it
+    _index_refresh_interval = 300  # seconds
+
+    # how far every namespace is: "stale" (from the snapshot, not read from
+    # the cluster yet), "indexing", "ready" or "failed" (could not be read,
+    # the old entries are kept)
+    _namespace_states = dict()
+
+    # names that have been seen by namespace while a fresh index is coming in,
+    # None if no index is being read
+    _reindex_seen = None
+    # the namespaces of the fresh index, None until they are known
+    _reindex_listed = None
+    # the namespaces of the fresh index that have been read completely
+    _reindex_done = None
+    # only the names are listed to refresh the index
+    _reindex_refresh = False
+    # time at which the fresh index has been requested, after
+    # _reindex_timeout seconds it is considered lost
+    _reindex_started = None
+    _reindex_timeout = 60 * 60
 
     def __new__(cls,
                 queue_sim_datacopy_new_file,
@@ -29,7 +88,10 @@ class LocalDataManager(object):
                 event_datacopy_ceph_update_index,
                 queue_datacopy_ceph_filename_and_hash,
                 event_data_manager_shutdown,
-                lock_datacopy_ceph_filename_and_hash
+                lock_datacopy_ceph_filename_and_hash,
+                index_snapshot_file=None,
+                index_refresh_interval=300,
+                queue_backend_datacopy_index_query=None
     ):
         cl.info("Starting LocalDataManager")
         if not cls._instance:
@@ -44,7 +106,10 @@ class LocalDataManager(object):
                          event_datacopy_ceph_update_index,
                          queue_datacopy_ceph_filename_and_hash,
                          event_data_manager_shutdown,
-                         lock_datacopy_ceph_filename_and_hash
+                         lock_datacopy_ceph_filename_and_hash,
+                         index_snapshot_file,
+                         index_refresh_interval,
+                         queue_backend_datacopy_index_query
             )
         return cls._instance
 
@@ -58,7 +123,10 @@ class LocalDataManager(object):
                  event_datacopy_ceph_update_index,
                  queue_datacopy_ceph_filename_and_hash,
                  event_data_manager_shutdown,
-                 lock_datacopy_ceph_filename_and_hash
+                 lock_datacopy_ceph_filename_and_hash,
+                 index_snapshot_file=None,
+                 index_refresh_interval=300,
+                 queue_backend_datacopy_index_query=None
     ):
 
         # receive new file information from the simulation
@@ -74,6 +142,8 @@ class LocalDataManager(object):
         # serve index requests from the backend
         cls._event_datacopy_backend_get_index = event_datacopy_backend_get_index
         cls._queue_datacopy_backend_index_data = queue_datacopy_backend_index_data
+        # queries for parts of the index (optional)
+        cls._queue_backend_datacopy_index_query = queue_backend_datacopy_index_query
 
         # request the index from the ceph cluster
         cls._event_datacopy_ceph_update_index = event_datacopy_ceph_update_index
@@ -85,6 +155,17 @@ class LocalDataManager(object):
         # index queue lock
         cls._lock_datacopy_ceph_filename_and_hash = lock_datacopy_ceph_filename_and_hash
 
+        cls._index_refresh_interval = index_refresh_interval
+
+        # start from the snapshot of the last run, the backend can be served
+        # from it right away while the index is read from the cluster
+        if index_snapshot_file:
+            cls._index_snapshot_file = pathlib.Path(index_snapshot_file)
+            cls.load_index_snapshot()
+
+        cls._index_snapshot_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1)
+
         try:
             #
             # asyncio: watch the queue and the shutdown event
@@ -101,10 +182,15 @@ class LocalDataManager(object):
             cls._periodic_index_update_task = cls._loop.create_task(
                 cls._periodic_index_update_coro(cls))
 
+            # task for periodically writing the index snapshot
+            cls._periodic_index_snapshot_task = cls._loop.create_task(
+                cls._periodic_index_snapshot_coro(cls))
+
             tasks = [
                 cls._queue_reader_task,
                 cls._index_updater_task,
-                cls._periodic_index_update_task
+                cls._periodic_index_update_task,
+                cls._periodic_index_snapshot_task
             ]
             cls._loop.run_until_complete(asyncio.wait(tasks))
 
@@ -142,16 +228,7 @@ class LocalDataManager(object):
                 # try to read the queue for the attempt to get the hash from ceph
                 try:
                     new_file_dict = cls._queue_datacopy_ceph_answer_hash_for_new_file.get(block=False)
-
-                    # forward to backend
-                    cls._queue_datacopy_backend_new_file_and_hash.put(new_file_dict)
-
-                    # add file to index
-                    namespace = new_file_dict["namespace"]
-                    key = new_file_dict["key"]
-                    sha1sum = new_file_dict["sha1sum"]
-                    # sha1sum might still be not set but what can we do now
-                    cls.add_file(namespace, key, sha1sum)
+                    cls._handle_new_file(new_file_dict)
 
                 except queue.Empty:
                     pass
@@ -159,14 +236,49 @@ class LocalDataManager(object):
                 # try serving the index
                 if cls._event_datacopy_backend_get_index.is_set():
                     cls._event_datacopy_backend_get_index.clear()
-                    index = cls.get_index()
-                    cls._queue_datacopy_backend_index_data.put(index)
+                    cls._queue_datacopy_backend_index_data.put(
+                        cls.query_index())
+
+                # try serving queries for parts of the index
+                if cls._queue_backend_datacopy_index_query is not None:
+                    try:
+                        index_query = cls._queue_backend_datacopy_index_query.get(block=False)
+                    except queue.Empty:
+                        pass
+                    else:
+                        cls._queue_datacopy_backend_index_data.put(
+                            cls.query_index(
+                                index_query.get("query", None),
+                                index_query.get("since", None),
+                                index_query.get("index_id", None)))
 
             except KeyboardInterrupt:
                 return
 
             await asyncio.sleep(1e-2)
 
+    @classmethod
+    def _handle_new_file(cls, new_file_dict):
+        """
+        Put a file the ceph manager tells about into the local copy and
+        forward it to the backend.
+
+        The change feed also tells about removed files, the backend drops them
+        from its caches.
+
+        """
+        # forward to backend
+        cls._queue_datacopy_backend_new_file_and_hash.put(new_file_dict)
+
+        namespace = new_file_dict["namespace"]
+        key = new_file_dict["key"]
+
+        if new_file_dict.get("removed", False):
+            cls.remove_file(namespace, key)
+        else:
+            # sha1sum might still be not set but what can we do now
+            cls.add_file(namespace, key, new_file_dict["sha1sum"])
+
     async def _periodic_index_update_coro(cls):
         """
         Update the index periodically.
@@ -174,19 +286,61 @@ class LocalDataManager(object):
         """
         await asyncio.sleep(5)  # wait for other processes to get their stuff together
 
-        # this messes with the tracking of datasets
-
-        # while True:
-        #     cl.info("Updating index")
-        #     cls._event_datacopy_ceph_update_index.set()
-        #     await asyncio.sleep(600)  #  wait 10 minutes
-
         cl.info("Updating index")
+        cls._begin_reindex()
         cls._event_datacopy_ceph_update_index.set()
 
+        if not cls._index_refresh_interval:
+            return
+
+        # afterwards only the names are compared, the files that did not
+        # change are left alone
+        while True:
+            await asyncio.sleep(cls._index_refresh_interval)
+            cls.refresh_index()
+
+    async def _periodic_index_snapshot_coro(cls):
+        """
+        Write the index snapshot periodically if the index has changed.
+
+        """
+        if not cls._index_snapshot_file:
+            return
+
+        while True:
+            await asyncio.sleep(cls._index_snapshot_interval)
+
+            if cls._index_dirty:
+                await cls._write_index_snapshot_coro(cls)
+
+    async def _write_index_snapshot_coro(cls):
+        """
+        Write the index snapshot in the snapshot executor.
+
+        Returns True if the snapshot was written.
+
+        """
+        snapshot_job = cls._take_index_snapshot()
+        if snapshot_job is None:
+            return False
+
+        return await cls._loop.run_in_executor(
+            cls._index_snapshot_executor,
+            cls._write_index_snapshot_files, snapshot_job)
+
     async def _index_updater_coro(cls):
         """
-        Read the queue for new things to do.
+        Add the index that comes from the ceph cluster to the local copy.
+
+        The index starts with a message with the "index_namespaces" that are
+        being read. Every namespace arrives in messages with lists of "keys" and
+        "sha1sums", followed by a message with "namespace_complete" after which
+        the namespace is ready. A message with "index_complete" ends the index,
+        it is "failed" if the index could not be read.
+
+        When the index is refreshed the namespaces arrive as "listed_keys"
+        instead. The "keys" and "sha1sums" of the new files in a namespace
+        follow later and end with "namespace_refreshed".
 
         """
         while True:
@@ -206,15 +360,46 @@ class LocalDataManager(object):
                             new_files.append(new_file_dict)
 
             if len(new_files) > 0:
-                cl.verbose("Got {} files from queue".format(len(new_files)))
+                cl.verbose("Got {} messages from queue".format(len(new_files)))
 
                 for new_file_dict in new_files:
 
+                    if "index_namespaces" in new_file_dict:
+                        cls._set_index_namespaces(
+                            new_file_dict["index_namespaces"])
+                        continue
+
+                    # the ceph manager marks the end of a complete index
+                    if new_file_dict.get("index_complete", False):
+                        cls._reconcile_index(
+                            new_file_dict.get("failed", False))
+                        continue
+
                     namespace = new_file_dict["namespace"]
-                    key = new_file_dict["key"]
-                    sha1sum = new_file_dict["sha1sum"]
 
-                    cls.add_file(namespace, key, sha1sum)
+                    if new_file_dict.get("namespace_complete", False):
+                        cls._reconcile_namespace(
+                            namespace, new_file_dict.get("failed", False))
+                    elif new_file_dict.get("namespace_refreshed", False):
+                        cls._namespace_refreshed(
+                            namespace, new_file_dict.get("failed", False))
+                    elif "listed_keys" in new_file_dict:
+                        cls.add_listed_files(
+                            namespace, new_file_dict["listed_keys"])
+                    elif "keys" in new_file_dict:
+                        cls.add_files(
+                            namespace,
+                            new_file_dict["keys"],
+                            new_file_dict["sha1sums"])
+                    else:
+                        cls.add_file(
+                            namespace,
+                            new_file_dict["key"],
+                            new_file_dict["sha1sum"])
+
+                    # let the other tasks (e.g. serving the backend) run in
+                    # between
+                    await asyncio.sleep(0)
 
                 cl.verbose("Done adding files to index")
 
@@ -228,160 +413,769 @@ class LocalDataManager(object):
         """
         cl.debug("Resetting LocalDataManager")
         cls._instance = None
-        cls._hashset = set()
-        cls._local_copy = dict()
+        cls._index_store = IndexStore()
+        cls._presence_filter = None
+        cls._presence_filter_version = None
+        cls._namespace_versions = dict()
+        cls._index_version = 0
+        cls._index_id = uuid.uuid4().hex
+        cls._index_changes = collections.deque(
+            maxlen=cls._index_change_log_size)
+        cls._namespace_states = dict()
+        cls._index_snapshot_file = None
+        cls._index_dirty = False
+        cls._reindex_seen = None
+        cls._reindex_listed = None
+        cls._reindex_done = None
+        cls._reindex_refresh = False
+        cls._reindex_started = None
         del cls
 
+    @classmethod
+    def _begin_reindex(cls, refresh=False):
+        """
+        Start keeping track of what is seen in a fresh index.
+
+        """
+        cls._reindex_seen = dict()
+        cls._reindex_listed = None
+        cls._reindex_done = set()
+        cls._reindex_refresh = refresh
+        cls._reindex_started = time.time()
+
+    @classmethod
+    def refresh_index(cls):
+        """
+        Ask the ceph manager to refresh the index.
+
+        Only the object names are listed. Files that are gone are removed and
+        the tags are only read for files that are new or have no sha1sum yet.
+        Returns False if an index is being read already.
+
+        """
+        if (cls._reindex_seen is not None and
+                time.time() - cls._reindex_started <= cls._reindex_timeout):
+            cl.debug("The index is being read, not refreshing it")
+            return False
+
+        cl.verbose("Refreshing index")
+        cls._begin_reindex(refresh=True)
+        cls._queue_datacopy_ceph_request_hash_for_new_file.put(
+            {"refresh_index": True})
+
+        return True
+
+    @classmethod
+    def _set_index_namespaces(cls, namespaces):
+        """
+        Mark the namespaces of a fresh index as being read.
+
+        """
+        if cls._reindex_seen is None:
+            cls._begin_reindex()
+
+        cls._reindex_listed = set(namespaces)
+
+        for namespace in namespaces:
+            # small namespaces might be done before the list arrives
+            if namespace in cls._reindex_done:
+                continue
+            # refreshing does not keep the known namespaces from being used
+            if cls._reindex_refresh and namespace in cls._namespace_states:
+                continue
+            cls._namespace_states[namespace] = "indexing"
+
+    @classmethod
+    def _reconcile_namespace(cls, namespace, failed=False):
+        """
+        Remove everything from a namespace that has not been seen in its fresh
+        index and mark the namespace as ready.
+
+        If the namespace could not be read, its files are kept as they are.
+        When the index is refreshed the tags of the files that are new or have
+        no sha1sum yet are requested from the ceph manager, a new namespace is
+        ready once they have arrived.
+
+        """
+        state = cls._namespace_states.get(namespace, None)
+
+        if failed:
+            cls._namespace_states[namespace] = "failed"
+        else:
+            cls._namespace_states[namespace] = "ready"
+
+        if cls._reindex_seen is None:
+            return
+
+        cls._reindex_done.add(namespace)
+        seen = cls._reindex_seen.pop(namespace, set())
+
+        if failed:
+            return
+
+        known = set()
+        missing = set()
+        removed = 0
+        for key, sha1sum in list(cls.iter_index_entries(namespace)):
+            if key not in seen:
+                cls.remove_file(namespace, key)
+                removed += 1
+            elif sha1sum:
+                known.add(key)
+
+        if cls._reindex_refresh:
+            # objects that are not part of a simulation are never added
+            missing = set(
+                key for key in seen - known
+                if cls._index_path(key) is not None)
+
+        if missing:
+            if state != "ready":
+                cls._namespace_states[namespace] = "indexing"
+            cls._queue_datacopy_ceph_request_hash_for_new_file.put(
+                {"namespace": namespace, "keys": list(missing)})
+
+        cl.verbose("Namespace {} is ready ({} files removed, {} files "
+                   "requested)".format(namespace, removed, len(missing)))
+
+    @classmethod
+    def _namespace_refreshed(cls, namespace, failed=False):
+        """
+        Mark a namespace as ready once the tags of its new files have arrived.
+
+        """
+        if failed:
+            cls._namespace_states[namespace] = "failed"
+        else:
+            cls._namespace_states[namespace] = "ready"
+
+    @classmethod
+    def _reconcile_index(cls, failed=False):
+        """
+        Remove the namespaces that are not part of the fresh index.
+
+        Called once a complete index has been read from the cluster. Namespaces
+        that were known before (e.g. from the snapshot) but are not on the
+        cluster anymore are removed from the local copy, the others have been
+        cleaned up when their index arrived.
+
+        If the index could not be read nothing is removed, the namespaces that
+        are still being read have failed. The index can be read again right
+        away.
+
+        """
+        if cls._reindex_seen is None:
+            return
+
+        listed = cls._reindex_listed
+        seen = cls._reindex_seen
+        done = cls._reindex_done
+        cls._reindex_seen = None
+        cls._reindex_listed = None
+        cls._reindex_done = None
+        cls._reindex_refresh = False
+        cls._reindex_started = None
+
+        if failed:
+            for namespace in (listed or set()) - done:
+                if cls._namespace_states.get(namespace, None) == "indexing":
+                    cls._namespace_states[namespace] = "failed"
+            cl.warning("Could not read the index, keeping the local copy")
+            return
+
+        if listed is None:
+            cl.warning("Index is complete but its namespaces are unknown")
+            return
+
+        removed = 0
+        for namespace in cls._index_store.namespaces():
+            # new files might have arrived for new namespaces in the meantime
+            if namespace in listed or namespace in seen:
+                continue
+            for key, _ in list(cls.iter_index_entries(namespace)):
+                cls.remove_file(namespace, key)
+                removed += 1
+
+        for namespace in list(cls._namespace_states.keys()):
+            if namespace not in listed and namespace not in seen:
+                del cls._namespace_states[namespace]
+
+        cl.info("Index is up to date ({} files removed)".format(removed))
+
+        if cls._index_snapshot_file:
+            cls._schedule_index_snapshot()
+
+    @classmethod
+    def _schedule_index_snapshot(cls):
+        """
+        Write the index snapshot, in the background while the event loop is
+        running.
+
+        """
+        if cls._loop is not None and cls._loop.is_running():
+            cls._loop.create_task(cls._write_index_snapshot_coro(cls))
+        else:
+            cls.write_index_snapshot()
+
+    @classmethod
+    def _index_path(cls, key):
+        """
+        Parse an object key into the path of its entry in the local copy.
+
+        Returns a list of dictionary keys below the namespace or None if the
+        key can not be parsed.
+
+        """
+        return key_parser.index_path(key)
+
     @classmethod
     def name_is_present(cls, namespace, name):
         """
         Check if a name is already present in the local copy.
 
         """
-        hashed_name = hash(str("{}\t{}".format(namespace, name)))
-        if hashed_name in cls._hashset:
-            return True
-        else:
-            return False
+        return cls._index_store.contains(namespace, name)
 
     @classmethod
     def add_file(cls, namespace, key, sha1sum):
+        """
+        Add a file to the local copy or update its sha1sum.
 
+        Returns True if the local copy changed.
+
+        """
         # # this can take on the order of microseconds
         # cl.debug("Adding file {}/{}/{}".format(namespace, key, sha1sum))
 
-        hashed_key = hash(str("{}\t{}".format(namespace, key)))
+        if cls._reindex_seen is not None:
+            cls._reindex_seen.setdefault(namespace, set()).add(key)
 
-        if hashed_key not in cls._hashset:
+        known_sha1sum = cls._index_store.get_sha1sum(namespace, key)
 
-            simtype = None
+        if known_sha1sum is not None:
+            # nothing to update without a (new) sha1sum
+            if not sha1sum or sha1sum == known_sha1sum:
+                return False
+            cls._index_store.set_sha1sum(namespace, key, sha1sum)
 
-            to_parse = None
+        else:
+            path = cls._index_path(key)
+            if path is None:
+                cl.debug_warning(
+                    "Can not add file {}/{}".format(namespace, key))
+                return False
+            cls._index_store.add(namespace, key, path, sha1sum)
 
-            field_type = None
+        # new namespaces from the simulation are ready right away
+        cls._namespace_states.setdefault(namespace, "ready")
 
-            fieldname = None
+        cls._namespace_changed(namespace, key)
 
-            skintype = None
+        return True
 
-            elemtype = None
+    @classmethod
+    def add_listed_files(cls, namespace, keys):
+        """
+        Remember the names of files that have been listed on the cluster while
+        the index is refreshed.
 
-            try:
+        """
+        if cls._reindex_seen is not None:
+            cls._reindex_seen.setdefault(namespace, set()).update(keys)
+
+    @classmethod
+    def add_files(cls, namespace, keys, sha1sums):
+        """
+        Add several files of a namespace to the local copy.
 
-                string = key.split("universe.fo.")[1]
-                objects, timestep = string.split("@")
+        Returns the number of files that changed the local copy.
 
-                objects_definition = objects.split(".")
+        """
+        changed = 0
+        for key, sha1sum in zip(keys, sha1sums):
+            if cls.add_file(namespace, key, sha1sum):
+                changed += 1
+        return changed
 
-                simtype = objects_definition[0]
+    @classmethod
+    def remove_file(cls, namespace, key):
+        """
+        Remove a file from the local copy.
 
-                # if the simtype is not ta or ma the file format is not supported
-                if simtype not in ["ta", "ma"]:
-                    raise ValueError
+        Returns True if the local copy changed.
 
-                # parse mesh or field, only field has field_type
-                if objects_definition[1] in ["nodal", "elemental"]:
-                    to_parse = "field"
+        """
+        if not cls._index_store.remove(namespace, key):
+            return False
+
+        cls._namespace_changed(namespace, key)
+
+        if not cls._index_store.has_namespace(namespace):
+            cls._namespace_versions.pop(namespace, None)
+
+        return True
+
+    @classmethod
+    def _update_presence_filter(cls, index_store, changes, index_version):
+        """
+        Bring the presence filter up to a copy of the local copy.
+
+        Only the files in changes are added, the filter is built anew from the
+        copy if the changes are not known (None) or too many files are gone.
+        Runs while the snapshot is written, so it never holds up the event
+        loop.
+
+        """
+        presence_filter = cls._presence_filter
+
+        if presence_filter is not None and changes is not None:
+            for namespace, key in changes:
+                if index_store.contains(namespace, key):
+                    presence_filter.add(namespace, key)
                 else:
-                    to_parse = "mesh"
+                    presence_filter.discard(namespace, key)
 
-                if to_parse == "field":
-                    usage = objects_definition[1]
-                    fieldname = objects_definition[2]
-                    try:
-                        elemtype = objects_definition[3]
-                    except IndexError:
-                        pass
+        if (presence_filter is None or changes is None or
+                presence_filter.needs_rebuild()):
+            presence_filter = PresenceFilter.build(
+                (
+                    (namespace, key)
+                    for namespace in index_store.namespaces()
+                    for key in index_store.keys(namespace)
+                ),
+                index_store.count())
 
-                elif to_parse == "mesh":
-                    usage = objects_definition[1]
+        cls._presence_filter = presence_filter
+        cls._presence_filter_version = index_version
 
-                    if usage == "nodes":
-                        pass
+    @classmethod
+    def get_presence_file(cls):
+        """
+        Return the path of the presence filter that is written next to the
+        index snapshot, None without a snapshot. The filter is as fresh as the
+        snapshot.
 
-                    elif usage == "elements":
-                        elemtype = objects_definition[2]
+        Other processes can open it read-only with PresenceFilter.open.
 
-                    elif usage == "skin":
-                        skintype = objects_definition[2]
-                        elemtype = objects_definition[3]
+        """
+        if not cls._index_snapshot_file:
+            return None
+        return cls._index_snapshot_file.with_suffix(".presence")
 
-                    elif usage == "elementactivationbitmap":
-                        elemtype = objects_definition[2]
+    @classmethod
+    def _namespace_changed(cls, namespace, key):
+        """
+        Bump the version of a namespace and of the index and remember which
+        file changed.
 
-                    elif usage == "elset":
-                        fieldname = objects_definition[2]
-                        elemtype = objects_definition[3]
+        """
+        cls._namespace_versions[namespace] = (
+            cls._namespace_versions.get(namespace, 0) + 1)
+        cls._index_version += 1
+        cls._index_changes.append((cls._index_version, namespace, key))
+        cls._index_dirty = True
 
-                    elif usage == "nset":
-                        fieldname = objects_definition[2]
+    @classmethod
+    def get_index_version(cls):
+        """
+        Return the id of the index and its current version.
 
-                    elif usage == "boundingbox":
-                        pass
+        """
+        return cls._index_id, cls._index_version
 
-                else:
-                    cl.debug_warning("Can not add file {}/{}".format(namespace, key))
-                    return
+    @classmethod
+    def iter_index_entries(cls, namespace):
+        """
+        Yield (object_key, sha1sum) for every file in a namespace.
 
-            except:
-                # YOU SHALL NOT PARSE
-                cl.debug_warning("Can not add file {}/{}".format(namespace, key))
-                return
+        """
+        return cls._index_store.entries(namespace)
+
+    @classmethod
+    def get_namespace_versions(cls):
+        """
+        Return the current version of every namespace.
+
+        """
+        return dict(cls._namespace_versions)
+
+    @classmethod
+    def get_namespace_states(cls):
+        """
+        Return the readiness of every namespace.
+
+        """
+        return dict(cls._namespace_states)
 
+    @classmethod
+    def write_index_snapshot(cls):
+        """
+        Write the local copy to the snapshot file right away.
+
+        Returns True if the snapshot was written.
+
+        """
+        snapshot_job = cls._take_index_snapshot()
+        if snapshot_job is None:
+            return False
+
+        return cls._write_index_snapshot_files(snapshot_job)
+
+    @classmethod
+    def _take_index_snapshot(cls):
+        """
+        Return a copy of the local copy for the snapshot and the files that
+        have changed for the presence filter, None without a snapshot file.
+
+        """
+        if not cls._index_snapshot_file:
+            return None
+
+        snapshot = {
+            "format": cls._index_snapshot_format,
+            "timestamp": time.time(),
+            "namespace_versions": dict(cls._namespace_versions),
+            "index_store": cls._index_store.copy()
+        }
+
+        # the presence filter only needs the files that have changed since it
+        # was updated, these do not go into the snapshot file
+        if cls._presence_filter is None:
+            presence_changes = None
+        else:
+            presence_changes = cls._changed_files_since(
+                cls._presence_filter_version)
+        snapshot_job = {
+            "snapshot": snapshot,
+            "index_version": cls._index_version,
+            "presence_changes": presence_changes
+        }
+
+        # changes from now on go into the next snapshot
+        cls._index_dirty = False
+
+        return snapshot_job
+
+    @classmethod
+    def _write_index_snapshot_files(cls, snapshot_job):
+        """
+        Write a copy of the local copy to the snapshot file, and the presence
+        filter next to it.
+
+        The file is written next to the old snapshot and then moved over it, so
+        there is always a complete snapshot on disk. Does blocking file I/O,
+        run it in the snapshot executor.
+
+        """
+        snapshot = snapshot_job["snapshot"]
+        snapshot_file = cls._index_snapshot_file
+        tmp_file = snapshot_file.with_name(snapshot_file.name + ".tmp")
+
+        start = time.time()
+
+        cls._update_presence_filter(
+            snapshot["index_store"], snapshot_job["presence_changes"],
+            snapshot_job["index_version"])
+
+        try:
+            snapshot_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(str(tmp_file), "wb") as sf:
+                pickle.dump(snapshot, sf, pickle.HIGHEST_PROTOCOL)
+            os.replace(str(tmp_file), str(snapshot_file))
+            cls._presence_filter.write(cls.get_presence_file())
+        except OSError as e:
+            cl.warning("Could not write index snapshot {}: {}".format(
+                snapshot_file, e))
+            # try again with the next snapshot
+            cls._index_dirty = True
+            return False
+
+        cl.verbose("Wrote index snapshot {} in {:.2f} seconds".format(
+            snapshot_file, time.time() - start))
+
+        return True
+
+    @classmethod
+    def load_index_snapshot(cls):
+        """
+        Load the local copy from the snapshot file.
+
+        Returns True if a snapshot was loaded.
+
+        """
+        if not cls._index_snapshot_file:
+            return False
+
+        snapshot_file = cls._index_snapshot_file
+
+        start = time.time()
+
+        try:
+            with open(str(snapshot_file), "rb") as sf:
+                snapshot = pickle.load(sf)
+        except FileNotFoundError:
+            cl.info("No index snapshot found at {}".format(snapshot_file))
+            return False
+        except Exception as e:
+            cl.warning("Could not read index snapshot {}: {}".format(
+                snapshot_file, e))
+            return False
+
+        snapshot_format = snapshot.get("format", None)
+
+        if snapshot_format == cls._index_snapshot_format:
+            cls._index_store = snapshot["index_store"]
+
+        elif snapshot_format == 1:
+            # the nested dictionaries of older versions
+            cls._index_store = cls._index_store_from_nested(
+                snapshot["local_copy"])
+
+        else:
+            cl.warning("Index snapshot {} has an unknown format, "
+                       "ignoring it".format(snapshot_file))
+            return False
+
+        cls._namespace_versions = snapshot["namespace_versions"]
+
+        # the changes before do not lead to this index
+        cls._index_version += 1
+        cls._index_changes.clear()
+
+        # usable, but not checked against the cluster yet
+        cls._namespace_states = {
+            namespace: "stale"
+            for namespace in cls._index_store.namespaces()}
+
+        cls._index_dirty = False
+
+        cl.info("Loaded index snapshot with {} files in {} namespaces "
+                "({:.2f} seconds)".format(
+                    cls._index_store.count(),
+                    len(cls._index_store.namespaces()),
+                    time.time() - start))
+
+        return True
+
+    @classmethod
+    def _index_store_from_nested(cls, local_copy):
+        """
+        Return an index store with the files of a nested local copy.
+
+        """
+        index_store = IndexStore()
+
+        for namespace, nested in local_copy.items():
+            to_visit = [nested]
+            while to_visit:
+                i_entry = to_visit.pop()
+                if 'object_key' not in i_entry:
+                    to_visit.extend(i_entry.values())
+                    continue
+                key = i_entry['object_key']
+                path = cls._index_path(key)
+                if path is not None and not index_store.contains(
+                        namespace, key):
+                    index_store.add(namespace, key, path, i_entry['sha1sum'])
+
+        return index_store
+
+    @classmethod
+    def _parse_index_query(cls, query):
+        """
+        Check an index query and return the arguments for the index store.
+
+        Raises ValueError if the query is not understood.
+
+        """
+        if not isinstance(query, dict):
+            raise ValueError("the query is not a dictionary")
+
+        unknown = set(query.keys()) - set(
+            ["namespace", "timesteps", "simtype", "usage", "fieldname"])
+        if unknown:
+            raise ValueError("unknown query fields {}".format(
+                ", ".join(sorted(unknown))))
+
+        for field in ["namespace", "simtype", "usage", "fieldname"]:
+            if query.get(field, None) is not None and (
+                    not isinstance(query[field], str)):
+                raise ValueError("{} is not a string".format(field))
+
+        timesteps = query.get("timesteps", None)
+        if timesteps is not None:
             try:
-                cls._hashset.add(hashed_key)
+                first, last = timesteps
+                timesteps = (
+                    None if first is None else float(first),
+                    None if last is None else float(last))
+            except (TypeError, ValueError):
+                raise ValueError(
+                    "timesteps is not a range [first, last] of numbers")
+
+        return {
+            "timesteps": timesteps,
+            "simtype": query.get("simtype", None),
+            "usage": query.get("usage", None),
+            "fieldname": query.get("fieldname", None)
+        }
+
+    @classmethod
+    def _change_matches(cls, namespace, key, query, store_query):
+        """
+        Check if a changed file matches an index query.
 
-                # Create the dictionary
-                if namespace not in cls._local_copy:
-                    cls._local_copy[namespace] = {}
+        """
+        if query.get("namespace", None) not in [None, namespace]:
+            return False
 
-                if timestep not in cls._local_copy[namespace]:
-                    cls._local_copy[namespace][timestep] = {}
+        parsed_key = key_parser.parse_key(key)
+        if parsed_key is None:
+            return False
 
-                if simtype not in cls._local_copy[namespace][timestep]:
-                    cls._local_copy[namespace][timestep][simtype] = {}
+        for field in ["simtype", "usage", "fieldname"]:
+            if (
+                    store_query[field] is not None and
+                    getattr(parsed_key, field) != store_query[field]
+            ):
+                return False
 
-                if usage not in cls._local_copy[namespace][timestep][simtype]:
-                    cls._local_copy[namespace][timestep][simtype][usage] = {}
+        return (
+            store_query["timesteps"] is None or
+            timestep_in_range(parsed_key.timestep, store_query["timesteps"]))
 
-                if usage in ["nodes", "boundingbox"]:
-                    i_entry = cls._local_copy[namespace][timestep][simtype][usage]
+    @classmethod
+    def _changed_files_since(cls, since):
+        """
+        Return the set of (namespace, key) of the files that have changed since
+        a version of the index, None if the changes are not known anymore.
 
-                if usage in ["elements", "elementactivationbitmap"]:
-                    if elemtype not in cls._local_copy[namespace][timestep][simtype][usage]:
-                        cls._local_copy[namespace][timestep][simtype][usage][elemtype] = {}
-                    i_entry = cls._local_copy[namespace][timestep][simtype][usage][elemtype]
+        """
+        if not isinstance(since, int) or since > cls._index_version:
+            return None
 
-                if usage == "skin":
-                    if skintype not in cls._local_copy[namespace][timestep][simtype][usage]:
-                        cls._local_copy[namespace][timestep][simtype][usage][skintype] = {}
-                    if elemtype not in cls._local_copy[namespace][timestep][simtype][usage][skintype]:
-                        cls._local_copy[namespace][timestep][simtype][usage][skintype][elemtype] = {}
-                    i_entry = cls._local_copy[namespace][timestep][simtype][usage][skintype][elemtype]
+        # a change log that does not reach back to since is missing changes
+        if since < cls._index_version and (
+                not cls._index_changes or cls._index_changes[0][0] > since + 1):
+            return None
 
-                if usage in ["elemental", "elset"]:
-                    if fieldname not in cls._local_copy[namespace][timestep][simtype][usage]:
-                        cls._local_copy[namespace][timestep][simtype][usage][fieldname] = {}
-                    if elemtype not in cls._local_copy[namespace][timestep][simtype][usage][fieldname]:
-                        cls._local_copy[namespace][timestep][simtype][usage][fieldname][elemtype] = {}
-                    i_entry = cls._local_copy[namespace][timestep][simtype][usage][fieldname][elemtype]
+        changed = set()
+        for version, namespace, key in reversed(cls._index_changes):
+            if version <= since:
+                break
+            changed.add((namespace, key))
 
-                if usage in ["nodal", "nset"]:
-                    if fieldname not in cls._local_copy[namespace][timestep][simtype][usage]:
-                        cls._local_copy[namespace][timestep][simtype][usage][fieldname] = {}
-                    i_entry = cls._local_copy[namespace][timestep][simtype][usage][fieldname]
+        return changed
 
-                i_entry['object_key'] = key
-                i_entry['sha1sum'] = sha1sum
+    @classmethod
+    def _index_changes_since(cls, since, query=None, store_query=None):
+        """
+        Return the files that have been added (or changed) and removed since
+        a version of the index, None if the changes are not known anymore.
 
-            except:
-                pass
+        """
+        changed = cls._changed_files_since(since)
+        if changed is None:
+            return None
+
+        added = list()
+        removed = list()
+        for namespace, key in changed:
+            if query is not None and not cls._change_matches(
+                    namespace, key, query, store_query):
+                continue
+
+            change = {
+                "namespace": namespace,
+                "object_key": key,
+                "path": cls._index_path(key)
+            }
+            sha1sum = cls._index_store.get_sha1sum(namespace, key)
+            if sha1sum is None:
+                removed.append(change)
+            else:
+                change["sha1sum"] = sha1sum
+                added.append(change)
+
+        return {"added": added, "removed": removed}
+
+    @classmethod
+    def query_index(cls, query=None, since=None, index_id=None):
+        """
+        Return the part of the index that matches a query together with the
+        namespace states and the version of the index.
+
+        The query is a dictionary with the optional fields "namespace",
+        "timesteps" (a range [first, last], either end can be null), "simtype",
+        "usage" and "fieldname". Without a query the whole index is returned.
+        A query that is not understood is answered with an empty index and an
+        "error".
+
+        If the version since and the index_id of an earlier answer are given,
+        only the "changes" since then are returned instead of the "index",
+        unless they are not known anymore.
+
+        """
+        answer = {"index_id": cls._index_id, "version": cls._index_version}
+
+        store_query = None
+        if query is not None:
+            try:
+                store_query = cls._parse_index_query(query)
+            except ValueError as e:
+                cl.warning("Can not answer index query {}: {}".format(
+                    query, e))
+                answer.update(
+                    {"index": {}, "namespace_states": {}, "error": str(e)})
+                return answer
+
+        namespace_states = cls.get_namespace_states()
+        if query is not None and query.get("namespace", None) is not None:
+            namespace_states = {
+                namespace: state
+                for namespace, state in namespace_states.items()
+                if namespace == query["namespace"]}
+        answer["namespace_states"] = namespace_states
+
+        if since is not None and index_id == cls._index_id:
+            changes = cls._index_changes_since(since, query, store_query)
+            if changes is not None:
+                answer["changes"] = changes
+                return answer
+
+        if query is None:
+            answer["index"] = cls.get_index()
+            return answer
+
+        namespace = query.get("namespace", None)
+        if namespace is None:
+            namespaces = cls._index_store.namespaces()
+        elif cls._index_store.has_namespace(namespace):
+            namespaces = [namespace]
+        else:
+            namespaces = []
+
+        index = dict()
+        for namespace in namespaces:
+            namespace_index = cls._index_store.nested(namespace, **store_query)
+            if namespace_index:
+                index[namespace] = namespace_index
+
+        answer["index"] = index
+        return answer
 
     @classmethod
     def get_index(cls, namespace=None):
+        """
+        Return the nested dictionaries of the local copy, for one namespace
+        or for all of them.
+
+        The dictionaries are built for every call, changing them does not
+        change the local copy.
+
+        """
         if namespace:
-            try:
-                return cls._local_copy[namespace]
-            except KeyError:
-                return dict()   # basically None
-        return cls._local_copy
+            return cls._index_store.nested(namespace)
+        return {
+            namespace: cls._index_store.nested(namespace)
+            for namespace in cls._index_store.namespaces()}
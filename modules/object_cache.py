@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+A cache for objects from the ceph cluster that is bounded by the size of the
+objects in it.
+
+"""
+import threading
+import collections
+
+from util.loggers import CoreLog as cl, BackendLog as bl, SimulationLog as sl
+
+
+class ObjectCache(object):
+    """
+    Least recently used cache for objects read from the ceph cluster.
+
+    The objects are kept under a namespace/key descriptor until their combined
+    size exceeds max_bytes, then the least recently used ones are evicted.
+
+    An entry is a dictionary with the "request_dict" as it came from the ceph
+    manager, its "size" and "sha1sum". Every entry handed out by get() or put()
+    is pinned and has to be given back with unpin() when it is not used
+    anymore. Evicted entries that are still pinned stay valid until the last
+    user unpins them, then release_callback is called with their request_dict
+    (e.g. to give shared memory back).
+
+    All methods can be called from any thread.
+
+    """
+    def __init__(self, max_bytes, release_callback=None):
+        self._max_bytes = max_bytes
+        self._release_callback = release_callback
+
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _object_size(self, request_dict):
+        """
+        Return the size of the contents of an object.
+
+        """
+        shm_descriptor = request_dict.get("shm", None)
+        if shm_descriptor is not None:
+            return shm_descriptor["size"]
+        return len(request_dict["value"])
+
+    def get(self, key, sha1sum=None):
+        """
+        Return the pinned entry for key or None if it is not cached.
+
+        If sha1sum is given an entry with a different sha1sum is dropped and
+        counted as a miss.
+
+        """
+        released = list()
+
+        with self._lock:
+            entry = self._entries.get(key, None)
+
+            if (entry is not None and sha1sum and
+                entry["sha1sum"] != sha1sum):
+                bl.debug("Cached {} is outdated".format(key))
+                self._remove(key, released)
+                entry = None
+
+            if entry is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._entries.move_to_end(key)
+                entry["in_use"] += 1
+
+        self._release(released)
+
+        return entry
+
+    def _new_entry(self, request_dict, pins):
+        """
+        Return a new entry for an object.
+
+        """
+        sha1sum = request_dict.get("tags", dict()).get("sha1sum", "")
+        return {
+            "request_dict": request_dict,
+            "size": self._object_size(request_dict),
+            "sha1sum": sha1sum,
+            "in_use": pins,
+            "retired": False
+        }
+
+    def put(self, key, request_dict, pins=0):
+        """
+        Store an object under key and return its entry.
+
+        The entry is pinned pins times. An object that is larger than the whole
+        cache is not stored but still handed out.
+
+        """
+        entry = self._new_entry(request_dict, pins)
+
+        released = list()
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key, released)
+
+            if entry["size"] > self._max_bytes:
+                bl.debug("{} is too large for the cache".format(key))
+                self._retire(entry, released)
+
+            else:
+                self._entries[key] = entry
+                self._bytes += entry["size"]
+
+                # evict until we are within the budget again
+                while self._bytes > self._max_bytes:
+                    evicted_key = next(iter(self._entries))
+                    bl.debug("Evicting {} from the cache".format(evicted_key))
+                    self._remove(evicted_key, released)
+                    self._evictions += 1
+
+        self._release(released)
+
+        return entry
+
+    def uncached(self, request_dict, pins=0):
+        """
+        Return an entry for an object that is not stored in the cache (e.g.
+        only a range of it).
+
+        The entry is pinned pins times and released when it is unpinned for
+        the last time.
+
+        """
+        entry = self._new_entry(request_dict, pins)
+        entry["retired"] = True
+        return entry
+
+    def unpin(self, entry):
+        """
+        Give back an entry obtained from get() or put().
+
+        """
+        with self._lock:
+            entry["in_use"] -= 1
+            release = (entry["retired"] and entry["in_use"] == 0)
+
+        if release:
+            self._release([entry])
+
+    def invalidate(self, key, sha1sum=None, request_dict=None):
+        """
+        Drop the entry for key.
+
+        If sha1sum is given the entry is only dropped if its sha1sum differs.
+        If request_dict is given the entry is only dropped if it holds this
+        request_dict.
+
+        """
+        released = list()
+
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if (entry is not None and
+                (not sha1sum or entry["sha1sum"] != sha1sum) and
+                (request_dict is None or entry["request_dict"] is request_dict)):
+                self._remove(key, released)
+
+        self._release(released)
+
+    def clear(self):
+        """
+        Drop all entries.
+
+        """
+        released = list()
+
+        with self._lock:
+            for key in list(self._entries.keys()):
+                self._remove(key, released)
+
+        self._release(released)
+
+    def statistics(self):
+        """
+        Return a dictionary with the counters of the cache.
+
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self._max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions
+            }
+
+    def _remove(self, key, released):
+        """
+        Remove an entry. Call with the lock held.
+
+        """
+        entry = self._entries.pop(key)
+        self._bytes -= entry["size"]
+        self._retire(entry, released)
+
+    def _retire(self, entry, released):
+        """
+        Mark an entry that is not in the cache anymore. Call with the lock held.
+
+        Entries that can be released right away are appended to released.
+
+        """
+        entry["retired"] = True
+        if entry["in_use"] == 0:
+            released.append(entry)
+
+    def _release(self, released):
+        """
+        Call the release callback for entries. Call without the lock held.
+
+        """
+        if self._release_callback is None:
+            return
+
+        for entry in released:
+            self._release_callback(entry["request_dict"])
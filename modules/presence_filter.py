@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+A Bloom filter of the files in the local copy.
+
+The positions of a file in the filter are derived from the sha1 of
+"namespace\\tkey", so they are the same in every process and every run. The
+filter is written to a file next to the index snapshot that other processes
+open read-only (the pages are shared through mmap).
+
+A file that is not in the filter is certainly not in the local copy, a file
+that is in the filter has to be looked up in the index to be sure.
+
+"""
+import os
+import math
+import mmap
+import struct
+import hashlib
+
+from util.loggers import CoreLog as cl, BackendLog as bl, SimulationLog as sl
+
+
+FILE_MAGIC = b"PLTBLOOM"
+# magic, number of hashes, number of bits
+FILE_HEADER = struct.Struct("<8sIQ")
+
+
+def filter_positions(namespace, key, hash_count, bit_count):
+    """
+    Return the bit positions of a file.
+
+    """
+    digest = hashlib.sha1(
+        "{}\t{}".format(namespace, key).encode("utf-8", "surrogateescape")
+    ).digest()
+    first = int.from_bytes(digest[:8], "little")
+    second = int.from_bytes(digest[8:16], "little") | 1
+    return [(first + i * second) % bit_count for i in range(hash_count)]
+
+
+class PresenceFilter(object):
+    """
+    A Bloom filter for capacity files with a rate of false positives of
+    about error_rate.
+
+    Files can not be removed, the filter is built anew when too many files
+    are gone (see needs_rebuild).
+
+    """
+    def __init__(self, capacity=1 << 16, error_rate=1e-2):
+        """
+        Allocate the bits.
+
+        """
+        capacity = max(int(capacity), 1)
+
+        bit_count = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._bit_count = max(8 * ((bit_count + 7) // 8), 8)
+        self._hash_count = max(
+            int(round(self._bit_count / capacity * math.log(2))), 1)
+
+        self._bits = bytearray(self._bit_count // 8)
+
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # files added and removed since the filter was built
+        self.added = 0
+        self.removed = 0
+
+    @classmethod
+    def build(cls, files, count, error_rate=1e-2):
+        """
+        Return a filter for the (namespace, key) pairs in files, with room
+        for twice count files.
+
+        """
+        presence_filter = cls(capacity=max(2 * count, 1 << 16),
+                              error_rate=error_rate)
+        for namespace, key in files:
+            presence_filter.add(namespace, key)
+        return presence_filter
+
+    @classmethod
+    def open(cls, path):
+        """
+        Open a filter file read-only.
+
+        """
+        with open(str(path), "rb") as filter_file:
+            bits = mmap.mmap(filter_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, hash_count, bit_count = FILE_HEADER.unpack_from(bits)
+        if (
+                magic != FILE_MAGIC or
+                len(bits) != FILE_HEADER.size + bit_count // 8
+        ):
+            bits.close()
+            raise ValueError("{} is not a presence filter".format(path))
+
+        presence_filter = cls.__new__(cls)
+        presence_filter._bit_count = bit_count
+        presence_filter._hash_count = hash_count
+        presence_filter._bits = memoryview(bits)[FILE_HEADER.size:]
+        presence_filter.capacity = None
+        presence_filter.error_rate = None
+        presence_filter.added = 0
+        presence_filter.removed = 0
+        return presence_filter
+
+    def write(self, path):
+        """
+        Write the filter to a file for other processes.
+
+        The file is written next to the old one and then moved over it, so
+        processes that have the old one open keep reading it.
+
+        """
+        path = str(path)
+        tmp_path = path + ".tmp"
+
+        with open(tmp_path, "wb") as filter_file:
+            filter_file.write(FILE_HEADER.pack(
+                FILE_MAGIC, self._hash_count, self._bit_count))
+            filter_file.write(self._bits)
+        os.replace(tmp_path, path)
+
+    def add(self, namespace, key):
+        """
+        Add a file.
+
+        """
+        bits = self._bits
+        for position in filter_positions(
+                namespace, key, self._hash_count, self._bit_count):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.added += 1
+
+    def discard(self, namespace, key):
+        """
+        Count a removed file. Its bits stay set.
+
+        """
+        self.removed += 1
+
+    def might_contain(self, namespace, key):
+        """
+        Check if a file might be in the local copy.
+
+        """
+        bits = self._bits
+        for position in filter_positions(
+                namespace, key, self._hash_count, self._bit_count):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def needs_rebuild(self):
+        """
+        Check if the filter is too full or has too many removed files.
+
+        """
+        return (
+            self.added > self.capacity or
+            self.removed > max(self.added // 4, 1024)
+        )
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+A pool of buffers in shared memory.
+
+Object contents are written into a slot of the pool by the ceph connections and
+read from there by the backend manager, so only a small descriptor has to travel
+through the queues in between.
+
+"""
+import ctypes
+import multiprocessing
+
+from util.loggers import CoreLog as cl, BackendLog as bl, SimulationLog as sl
+
+
+# owner of the slots that are free or have been handed on
+NO_OWNER = -1
+
+
+class SharedBufferPool(object):
+    """
+    A fixed number of equally sized slots in shared memory.
+
+    Create the pool before starting the processes and hand it to every process
+    that reads or writes object contents. A slot is taken with store() and has
+    to be given back with release() by whoever is done with the contents last.
+
+    A descriptor is a small dictionary with the number of the slot and the
+    size of the contents in it.
+
+    A slot can be taken for an owner (e.g. the ceph connection writing into
+    it), whose slots can be given back all at once if the owner dies before it
+    hands the descriptor on.
+
+    """
+    def __init__(self, slot_count, slot_size):
+        if slot_count < 1 or slot_size < 1:
+            raise ValueError("Need at least one slot with a size of at least "
+                             "one byte")
+
+        self._slot_count = slot_count
+        self._slot_size = slot_size
+
+        # the memory is shared with every process this pool is handed to
+        self._buffer = multiprocessing.RawArray(
+            ctypes.c_ubyte, slot_count * slot_size)
+
+        # one flag per slot that is set while the slot is in use; comes with a
+        # lock shared between the processes
+        self._slots_in_use = multiprocessing.Array(ctypes.c_bool, slot_count)
+        # owner of every slot in use, NO_OWNER once the descriptor has been
+        # handed on (guarded by the lock of the flags)
+        self._slot_owners = multiprocessing.RawArray(ctypes.c_int, slot_count)
+
+        # created on first use in every process
+        self._view = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_view"] = None   # memoryviews can not be pickled
+        return state
+
+    @property
+    def slot_size(self):
+        return self._slot_size
+
+    def _buffer_view(self):
+        """
+        Return a memoryview of the complete shared buffer.
+
+        """
+        if self._view is None:
+            self._view = memoryview(self._buffer).cast("B")
+        return self._view
+
+    def acquire(self, size, owner=None):
+        """
+        Take a free slot for contents of the given size, for an owner (a
+        number) if one is given.
+
+        Returns a descriptor or None if the contents do not fit into a slot or
+        if there is no free slot.
+
+        """
+        if size > self._slot_size:
+            return None
+
+        with self._slots_in_use.get_lock():
+            for slot in range(self._slot_count):
+                if not self._slots_in_use[slot]:
+                    self._slots_in_use[slot] = True
+                    self._slot_owners[slot] = (
+                        NO_OWNER if owner is None else owner)
+                    return {"slot": slot, "size": size}
+
+        cl.debug("No free slot in the shared buffer pool")
+        return None
+
+    def store(self, data):
+        """
+        Copy data into a free slot.
+
+        Returns a descriptor or None if the data could not be stored.
+
+        """
+        descriptor = self.acquire(len(data))
+        if descriptor is None:
+            return None
+
+        self.write(descriptor, 0, data)
+
+        return descriptor
+
+    def write(self, descriptor, offset, data):
+        """
+        Copy data into the slot of a descriptor, starting at offset.
+
+        """
+        start = descriptor["slot"] * self._slot_size + offset
+        self._buffer_view()[start:start + len(data)] = data
+
+    def view(self, descriptor):
+        """
+        Return a memoryview of the contents of a descriptor.
+
+        The view is only valid until the slot is released.
+
+        """
+        start = descriptor["slot"] * self._slot_size
+        return self._buffer_view()[start:start + descriptor["size"]]
+
+    def release(self, descriptor):
+        """
+        Give the slot of a descriptor back to the pool.
+
+        """
+        with self._slots_in_use.get_lock():
+            self._slots_in_use[descriptor["slot"]] = False
+            self._slot_owners[descriptor["slot"]] = NO_OWNER
+
+    def disown(self, descriptor):
+        """
+        Hand the slot of a descriptor on, it is not given back with the slots
+        of its owner anymore.
+
+        """
+        with self._slots_in_use.get_lock():
+            self._slot_owners[descriptor["slot"]] = NO_OWNER
+
+    def release_owned_by(self, owner):
+        """
+        Give every slot an owner still holds back to the pool. Returns the
+        number of slots.
+
+        Only call this once the owner is gone, it must not write into the
+        slots anymore.
+
+        """
+        released = 0
+        with self._slots_in_use.get_lock():
+            for slot in range(self._slot_count):
+                if (self._slots_in_use[slot] and
+                        self._slot_owners[slot] == owner):
+                    self._slots_in_use[slot] = False
+                    self._slot_owners[slot] = NO_OWNER
+                    released += 1
+        return released
@@ -17,6 +17,9 @@ from modules.local_data_manager import LocalDataManager
 from modules.backend_manager import BackendManager
 from modules.simulation_manager import SimulationManager
 from modules.ceph_manager import CephManager
+from modules.shared_buffer_pool import SharedBufferPool
+from modules.hash_backfill import HashBackfill
+from modules.change_feed import publish_change, rados
 
 
 def start_tasks(args):
@@ -34,6 +37,11 @@ def start_tasks(args):
     simulation_port = args.simulation_port
     backend_port = args.backend_port
 
+    if args.no_index_snapshot:
+        index_snapshot_file = None
+    else:
+        index_snapshot_file = pathlib.Path(args.index_snapshot)
+
     # create all necessary queues, pipes and events for inter process
     # communication
     #
@@ -72,6 +80,9 @@ def start_tasks(args):
     #
     # a queue for returning the requested index
     queue_datacopy_backend_index_data = multiprocessing.Queue()
+    #
+    # a queue for requesting parts of the index from the data copy
+    queue_backend_datacopy_index_query = multiprocessing.Queue()
 
 
     # inter process communication for requesting the index for the data manager
@@ -86,6 +97,33 @@ def start_tasks(args):
     # a lock for queue_datacopy_ceph_filename_and_hash
     lock_datacopy_ceph_filename_and_hash = multiprocessing.Lock()
 
+    # shared memory for transferring object data from the ceph connections to
+    # the backend manager
+    if args.shm_slots > 0 and args.shm_slot_size > 0:
+        buffer_pool = SharedBufferPool(
+            args.shm_slots, args.shm_slot_size * 1024 * 1024)
+    else:
+        buffer_pool = None
+
+    # upper limit for the objects cached by the backend manager
+    cache_size = args.cache_size * 1024 * 1024
+
+    if args.no_disk_cache:
+        disk_cache_directory = None
+    else:
+        disk_cache_directory = pathlib.Path(args.disk_cache)
+    disk_cache_size = args.disk_cache_size * 1024 * 1024
+
+    # the number of connections to the ceph cluster follows the load
+    min_connections = max(args.min_connections, 1)
+    max_connections = max(args.max_connections, min_connections)
+
+    # changes published on the cluster are followed if asked for
+    if args.change_feed:
+        change_feed_object = args.change_feed_object
+    else:
+        change_feed_object = None
+
     # inter process communication for shutting down processes
     #
     # an event for shutting down the backend manager
@@ -112,7 +150,10 @@ def start_tasks(args):
             event_datacopy_ceph_update_index,
             queue_datacopy_ceph_filename_and_hash,
             event_data_manager_shutdown,
-            lock_datacopy_ceph_filename_and_hash
+            lock_datacopy_ceph_filename_and_hash,
+            index_snapshot_file,
+            args.index_refresh_interval,
+            queue_backend_datacopy_index_query
         )
     )
     simulation_manager = multiprocessing.Process(
@@ -133,7 +174,12 @@ def start_tasks(args):
             queue_datacopy_backend_index_data,
             queue_backend_ceph_request_file,
             queue_backend_ceph_answer_file_name_contents_hash,
-            event_backend_manager_shutdown
+            event_backend_manager_shutdown,
+            buffer_pool,
+            cache_size,
+            disk_cache_directory,
+            disk_cache_size,
+            queue_backend_datacopy_index_query
         )
     )
     ceph_manager = multiprocessing.Process(
@@ -149,7 +195,11 @@ def start_tasks(args):
             queue_backend_ceph_answer_file_name_contents_hash,
             event_datacopy_ceph_update_index,
             queue_datacopy_ceph_filename_and_hash,
-            lock_datacopy_ceph_filename_and_hash
+            lock_datacopy_ceph_filename_and_hash,
+            buffer_pool,
+            min_connections,
+            max_connections,
+            change_feed_object
         )
     )
 
@@ -178,3 +228,53 @@ def start_tasks(args):
         backend_manager.terminate()
         simulation_manager.terminate()
         ceph_manager.terminate()
+
+
+def start_backfill(args):
+    """
+    Calculate and write the missing sha1sums on the cluster.
+
+    """
+    cl.debug("Starting sha1sum backfill")
+
+    HashBackfill(
+        pathlib.Path(args.config),
+        args.pool,
+        args.user,
+        namespaces=args.namespace,
+        workers=max(args.workers, 1),
+        max_rate=args.max_rate * 1024 * 1024,
+        progress_file=pathlib.Path(args.progress_file),
+        restart=args.restart
+    )
+
+
+def start_publish(args):
+    """
+    Publish a new or removed file to the change feed.
+
+    """
+    cluster = rados.Rados(
+        conffile=str(pathlib.Path(args.config)),
+        rados_id=args.user
+    )
+    cluster.connect()
+
+    try:
+        ioctx = cluster.open_ioctx(args.pool)
+        try:
+            publish_change(
+                ioctx,
+                args.namespace,
+                args.key,
+                sha1sum=args.sha1sum,
+                removed=args.removed,
+                control_object=args.change_feed_object
+            )
+        finally:
+            ioctx.close()
+
+    finally:
+        cluster.shutdown()
+
+    cl.info("Published {}/{}".format(args.namespace, args.key))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+A priority queue for the tasks of the ceph connections that is shared between
+processes.
+
+Tasks belong to classes (e.g. downloads, hashes, index scans) that are ordered
+by priority. Every ceph connection takes the most important task that is
+waiting, so no connection idles while there is work of any class.
+
+"""
+import time
+import multiprocessing
+
+from util.loggers import CoreLog as cl, BackendLog as bl, SimulationLog as sl
+
+
+class TaskScheduler(object):
+    """
+    Task queues for a list of classes, the first class is the most important.
+
+    Create the scheduler before starting the processes and hand it to every
+    process that puts or gets tasks.
+
+    Every class has its own queue and a semaphore that counts the tasks in it.
+    A task is only taken from a queue after its semaphore has been acquired,
+    so a consumer that got the semaphore is guaranteed a task (it might still
+    be on its way through the queue). Consumers that find nothing to do wait
+    on a condition that is notified for every new task.
+
+    """
+    def __init__(self, task_classes):
+        if not task_classes:
+            raise ValueError("Need at least one class of tasks")
+
+        self._task_classes = list(task_classes)
+
+        self._queues = dict()
+        self._counters = dict()
+        for task_class in self._task_classes:
+            self._queues[task_class] = multiprocessing.Queue()
+            self._counters[task_class] = multiprocessing.Semaphore(0)
+
+        self._work_available = multiprocessing.Condition()
+
+    @property
+    def task_classes(self):
+        return list(self._task_classes)
+
+    def put(self, task_class, task):
+        """
+        Add a task of a class.
+
+        """
+        self._queues[task_class].put(task)
+        self._counters[task_class].release()
+
+        with self._work_available:
+            self._work_available.notify_all()
+
+    def get(self, task_classes=None, timeout=None):
+        """
+        Return the most important waiting task as a tuple (task_class, task).
+
+        Only tasks of task_classes (default: all) are considered. Blocks until
+        there is a task or timeout seconds have passed, then None is returned.
+
+        """
+        if task_classes is None:
+            task_classes = self._task_classes
+
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        with self._work_available:
+            while True:
+                task_class = self._claim(task_classes)
+                if task_class is not None:
+                    break
+
+                if timeout is None:
+                    self._work_available.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    self._work_available.wait(remaining)
+
+        # the task is ours, but the producer might still be writing it
+        return task_class, self._queues[task_class].get()
+
+    def _claim(self, task_classes):
+        """
+        Take the counter of the most important class with a waiting task and
+        return that class, or None if there is nothing to do.
+
+        """
+        for task_class in self._task_classes:
+            if (task_class in task_classes and
+                self._counters[task_class].acquire(False)):
+                return task_class
+        return None
+
+    def backlog(self):
+        """
+        Return a dictionary with the number of waiting tasks for every class.
+
+        """
+        return {
+            task_class: self._counters[task_class].get_value()
+            for task_class in self._task_classes
+        }
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Measure how fast object keys are parsed and added to the local copy.
+
+Run with `python benchmark_key_parser.py [-n NUMBER_OF_KEYS]`.
+
+"""
+import time
+import argparse
+
+try:
+    from modules import key_parser
+    from modules.local_data_manager import LocalDataManager
+except ImportError:
+    import sys
+    sys.path.append('../../..')
+    from modules import key_parser
+    from modules.local_data_manager import LocalDataManager
+
+
+# the objects of one timestep of a typical simulation
+OBJECTS = [
+    "universe.fo.ta.nodes",
+    "universe.fo.ta.boundingbox",
+    "universe.fo.ta.elements.c3d6",
+    "universe.fo.ta.elements.c3d8",
+    "universe.fo.ta.skin.outer.c3d6",
+    "universe.fo.ta.skin.outer.c3d8",
+    "universe.fo.ta.elset.top.c3d8",
+    "universe.fo.ta.nset.top",
+    "universe.fo.ta.nodal.NT11",
+    "universe.fo.ma.nodal.U",
+    "universe.fo.ma.elemental.S.c3d6",
+    "universe.fo.ma.elemental.S.c3d8"
+]
+
+
+def make_keys(number_of_keys):
+    """
+    Return the keys of number_of_keys objects over as many timesteps as
+    needed.
+
+    """
+    keys = list()
+    timestep = 0
+    while len(keys) < number_of_keys:
+        for objects in OBJECTS:
+            keys.append("{}@{:010d}.000000".format(objects, timestep))
+        timestep += 1
+    return keys[:number_of_keys]
+
+
+def measure(name, function, keys):
+    """
+    Call function for every key and print the rate.
+
+    """
+    start = time.perf_counter()
+    for key in keys:
+        function(key)
+    duration = time.perf_counter() - start
+
+    print("{:<24} {:>12.0f} keys/s {:>8.2f} us/key".format(
+        name, len(keys) / duration, 1e6 * duration / len(keys)))
+
+
+def measure_ingest(keys):
+    """
+    Add all keys to an empty local copy and print the rate.
+
+    """
+    LocalDataManager._reset()
+
+    start = time.perf_counter()
+    LocalDataManager.add_files("namespace", keys, [""] * len(keys))
+    duration = time.perf_counter() - start
+
+    print("{:<24} {:>12.0f} keys/s {:>8.2f} us/key".format(
+        "ingest (add_files)", len(keys) / duration,
+        1e6 * duration / len(keys)))
+
+    LocalDataManager._reset()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-n", "--number_of_keys", type=int, default=200000,
+        help="Number of keys to parse")
+    args = parser.parse_args()
+
+    keys = make_keys(args.number_of_keys)
+
+    measure("index_path", key_parser.index_path, keys)
+    measure("parse_key", key_parser.parse_key, keys)
+    measure_ingest(keys)
+
+
+if __name__ == "__main__":
+    main()
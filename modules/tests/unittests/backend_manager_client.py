@@ -17,6 +17,7 @@ import multiprocessing
 import base64
 import logging
 import queue
+import collections
 from contextlib import suppress
 
 from util.loggers import CoreLog as cl, BackendLog as bl, SimulationLog as sl
@@ -651,3 +652,167 @@ class Client(object):
         """
         writer.write("nack".encode())
         await writer.drain()
+
+
+class SingleConnection(object):
+    """
+    A single connection to the server.
+
+    Unlike the Client this does not run in a process of its own, the test
+    drives it from its own event loop. Use open() to connect.
+
+    If the handshake asks for "framing": "pipelined" every following message
+    is a length prefixed frame without ACKs, with an "ack_window" an ACK
+    frame is exchanged after that many messages in each direction.
+
+    """
+    pipelined_length_format = "!Q"
+    pipelined_ack = "ack".encode()
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+
+        self._pipelined = False
+        self._ack_window = 0
+        self._sent = 0
+        self._received = 0
+        self._acks = 0
+        self._pending = collections.deque()
+
+    @classmethod
+    async def open(cls, host, port, handshake):
+        """
+        Connect to the server and perform the handshake.
+
+        """
+        reader, writer = await asyncio.open_connection(host, port)
+        connection = cls(reader, writer)
+        if not await connection.send(handshake):
+            writer.close()
+            raise ConnectionError("Handshake {} refused".format(handshake))
+
+        if handshake.get("framing", "legacy") == "pipelined":
+            connection._pipelined = True
+            connection._ack_window = handshake.get("ack_window", 0)
+
+        return connection
+
+    def close(self):
+        self._writer.close()
+
+    async def send(self, dictionary):
+        """
+        Send a dictionary, return True if it was acknowledged.
+
+        On pipelined connections this only waits for the ACK frame at the end
+        of an ack window.
+
+        """
+        binary_dictionary = json.dumps(dictionary).encode()
+
+        if self._pipelined:
+            self._write_frame(binary_dictionary)
+            await self._writer.drain()
+
+            self._sent += 1
+            if self._ack_window and self._sent % self._ack_window == 0:
+                return await self.check_window_ack()
+            return True
+
+        self._writer.write(struct.pack("L", len(binary_dictionary)))
+        await self._writer.drain()
+        if not await self.check_ack():
+            return False
+
+        self._writer.write(binary_dictionary)
+        await self._writer.drain()
+        return await self.check_ack()
+
+    async def read(self):
+        """
+        Read a dictionary and acknowledge it, None if the connection is
+        closed.
+
+        """
+        if self._pipelined:
+            if self._pending:
+                return self._pending.popleft()
+            while True:
+                res = await self._read_frame()
+                if res is not self.pipelined_ack:
+                    return res
+
+        try:
+            length_b = await self._reader.readexactly(struct.calcsize("L"))
+            await self.send_ack()
+            data = await self._reader.readexactly(
+                struct.unpack("L", length_b)[0])
+        except asyncio.IncompleteReadError:
+            return None
+
+        await self.send_ack()
+        return json.loads(data.decode("UTF-8"))
+
+    async def read_binary(self, size):
+        """
+        Read the raw contents of a file that follow a binary header and
+        acknowledge them (not on pipelined connections).
+
+        """
+        payload = await self._reader.readexactly(size)
+        if not self._pipelined:
+            await self.send_ack()
+        return payload
+
+    def _write_frame(self, data):
+        self._writer.write(struct.pack(self.pipelined_length_format, len(data)))
+        self._writer.write(data)
+
+    async def _read_frame(self):
+        """
+        Read a frame of a pipelined connection, the ACK data for ACK frames.
+
+        """
+        try:
+            length_b = await self._reader.readexactly(
+                struct.calcsize(self.pipelined_length_format))
+            data = await self._reader.readexactly(
+                struct.unpack(self.pipelined_length_format, length_b)[0])
+        except asyncio.IncompleteReadError:
+            return None
+
+        if data == self.pipelined_ack:
+            self._acks += 1
+            return self.pipelined_ack
+
+        self._received += 1
+        if self._ack_window and self._received % self._ack_window == 0:
+            self._write_frame(self.pipelined_ack)
+            await self._writer.drain()
+
+        return json.loads(data.decode("UTF-8"))
+
+    async def check_window_ack(self):
+        """
+        Wait for the ACK frame of an ack window, keep the messages that
+        arrive in the meantime.
+
+        """
+        while not self._acks:
+            res = await self._read_frame()
+            if res is None:
+                return False
+            if res is not self.pipelined_ack:
+                self._pending.append(res)
+
+        self._acks -= 1
+        return True
+
+    async def check_ack(self):
+        ck = await self._reader.read(8)
+        return ck.decode("UTF-8", "replace").lower() == "ack"
+
+    async def send_ack(self):
+        self._writer.write("ack".encode())
+        await self._writer.drain()
@@ -7,10 +7,12 @@ import unittest
 
 try:
     import modules.backend_manager as backend_manager
+    from modules.shared_buffer_pool import SharedBufferPool
 except ImportError:
     import sys
     sys.path.append('../../..')
     import modules.backend_manager as backend_manager
+    from modules.shared_buffer_pool import SharedBufferPool
 
 from util.loggers import CoreLog as cl, BackendLog as bl, SimulationLog as sl
 
@@ -22,6 +24,9 @@ import time
 import os
 import hashlib
 import queue
+import base64
+import pathlib
+import tempfile
 
 class Test_BackendManager(unittest.TestCase):
 
@@ -224,7 +229,12 @@ class Test_BackendManager(unittest.TestCase):
             "a": "mock",
             "index": True
         }
-        expected_index = {'todo': 'index', 'index': mock_index}
+        mock_states = {"some_namespace": "ready"}
+        expected_index = {
+            'todo': 'index',
+            'index': mock_index,
+            'namespace_states': mock_states
+        }
 
         # tell the client that it should tell the server to get the index
         self.get_index_client_event.set()
@@ -233,7 +243,8 @@ class Test_BackendManager(unittest.TestCase):
         if self.get_index_server_event.wait(1):
 
             # give the server a mock index to send out
-            self.queue_datacopy_backend_index_data.put(mock_index)
+            self.queue_datacopy_backend_index_data.put(
+                {"index": mock_index, "namespace_states": mock_states})
 
         index = self.queue_client_index_data.get(True, 10)
 
@@ -349,5 +360,808 @@ class Test_BackendManager(unittest.TestCase):
             res = self.file_contents_name_hash_client_queue.get(True, .1)
             self.assertIn(res["file_request"], list(transfer_this.values()))
 
+class SingleConnectionTestCase(unittest.TestCase):
+    """
+    Talk to the server over single connections that the test drives itself.
+
+    """
+    port = 9002
+    shm_slots = 2
+
+    def server_kwargs(self):
+        """
+        Return the keyword arguments of the server.
+
+        """
+        return {"buffer_pool": self.buffer_pool}
+
+    def setUp(self):
+
+        cl("debug")
+        bl("debug")
+        sl("debug")
+
+        self.new_file_server_queue = multiprocessing.Queue()
+        self.get_index_server_event = multiprocessing.Event()
+        self.queue_datacopy_backend_index_data = multiprocessing.Queue()
+        self.file_name_request_server_queue = multiprocessing.Queue()
+        self.file_contents_name_hash_server_queue = multiprocessing.Queue()
+        self.shutdown_backend_manager_event = multiprocessing.Event()
+        self.buffer_pool = SharedBufferPool(self.shm_slots, 1024 * 1024)
+
+        print()
+        self.server = multiprocessing.Process(
+            target=backend_manager.BackendManager,
+            args=(
+                "localhost", self.port,
+                self.new_file_server_queue,
+                self.get_index_server_event,
+                self.queue_datacopy_backend_index_data,
+                self.file_name_request_server_queue,
+                self.file_contents_name_hash_server_queue,
+                self.shutdown_backend_manager_event,
+            ),
+            kwargs=self.server_kwargs()
+        )
+        self.server.start()
+        time.sleep(.5)
+
+        # not set as the event loop of this process, the servers of the
+        # following tests are forked from it
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        self.shutdown_backend_manager_event.set()
+        time.sleep(.5)
+        try:
+            self.server.terminate()
+        except:
+            pass
+
+    async def answer_request(self, contents, sha1sum=""):
+        """
+        Answer the next request that reaches the ceph queue with contents.
+
+        """
+        request = await self.loop.run_in_executor(
+            None, self.file_name_request_server_queue.get, True, 5)
+        answer = {
+            "namespace": request["namespace"],
+            "object": request["key"],
+            "tags": {"sha1sum": sha1sum},
+            "value": contents
+        }
+        if "range" in request:
+            answer["range"] = request["range"]
+        self.file_contents_name_hash_server_queue.put(answer)
+        return request
+
+    async def concurrent_downloads(self, count, requested_file):
+        """
+        Open count connections and request the same file on all of them.
+
+        """
+        connections = list()
+        for _ in range(count):
+            connection = await client.SingleConnection.open(
+                "localhost", self.port, {"task": "file_download"})
+            connections.append(connection)
+        for connection in connections:
+            self.assertTrue(await connection.send(
+                {"requested_file": requested_file}))
+        # the server registers its waiters right after acknowledging
+        await asyncio.sleep(.2)
+        return connections
+
+    def put_pieces(self, request, contents, piece_size, tags, last_tags=None):
+        """
+        Answer a request with contents in pieces of piece_size bytes, the last
+        piece carries last_tags (or tags).
+
+        """
+        offsets = list(range(0, len(contents), piece_size))
+        for offset in offsets:
+            complete = (offset == offsets[-1])
+            self.file_contents_name_hash_server_queue.put({
+                "namespace": request["namespace"],
+                "object": request["key"],
+                "tags": (last_tags or tags) if complete else tags,
+                "size": len(contents),
+                "offset": offset,
+                "value": contents[offset:offset + piece_size],
+                "complete": complete
+            })
+            time.sleep(.05)
+
+    def assertNoMoreRequests(self):
+        with self.assertRaises(queue.Empty):
+            self.file_name_request_server_queue.get(True, .5)
+
+
+class Test_BackendManager_SingleConnection(SingleConnectionTestCase):
+
+    def test_binary_frames(self):
+        """the header announces the raw contents that follow it
+
+        """
+        namespace = "some_namespace"
+        key = "universe.fo.nodes@0000000001.000000"
+        # more than one chunk
+        contents = os.urandom(2 * 1024 * 1024 + 123)
+        sha1sum = hashlib.sha1(contents).hexdigest()
+
+        async def download():
+            connection = await client.SingleConnection.open(
+                "localhost", self.port,
+                {"task": "file_download", "binary_frames": True})
+            try:
+                self.assertTrue(await connection.send({
+                    "requested_file": {"namespace": namespace, "key": key}}))
+                await self.answer_request(contents, sha1sum)
+
+                header = await connection.read()
+                payload = await connection.read_binary(
+                    header["file_request"]["size"])
+            finally:
+                connection.close()
+            return header, payload
+
+        header, payload = self.loop.run_until_complete(download())
+
+        self.assertEqual(header["todo"], "file_request")
+        file_request = header["file_request"]
+        self.assertEqual(file_request["namespace"], namespace)
+        self.assertEqual(file_request["object"], key)
+        self.assertEqual(file_request["encoding"], "binary")
+        self.assertEqual(file_request["size"], len(contents))
+        self.assertEqual(file_request["chunk_size"], 1024 * 1024)
+        self.assertEqual(file_request["tags"], {"sha1sum": sha1sum})
+        self.assertNotIn("contents", file_request)
+        self.assertEqual(payload, contents)
+
+    def test_binary_frames_range(self):
+        """a range of a cached file is cut out of it
+
+        """
+        namespace = "some_namespace"
+        key = "universe.fo.nodes@0000000001.000000"
+        contents = os.urandom(4096)
+
+        async def download(byte_range):
+            connection = await client.SingleConnection.open(
+                "localhost", self.port,
+                {"task": "file_download", "binary_frames": True})
+            try:
+                requested_file = {"namespace": namespace, "key": key}
+                if byte_range is not None:
+                    requested_file["range"] = byte_range
+                self.assertTrue(await connection.send(
+                    {"requested_file": requested_file}))
+                if byte_range is None:
+                    await self.answer_request(contents)
+
+                header = await connection.read()
+                payload = await connection.read_binary(
+                    header["file_request"]["size"])
+            finally:
+                connection.close()
+            return header, payload
+
+        # the whole file is cached by the first download
+        header, payload = self.loop.run_until_complete(download(None))
+        self.assertEqual(payload, contents)
+
+        header, payload = self.loop.run_until_complete(
+            download({"offset": 4000, "length": 1000}))
+        self.assertEqual(
+            header["file_request"]["range"], {"offset": 4000, "length": 96})
+        self.assertEqual(header["file_request"]["size"], 96)
+        self.assertEqual(payload, contents[4000:])
+
+    def test_binary_frames_pipelined(self):
+        """the raw contents are not acknowledged on pipelined connections
+
+        """
+        namespace = "some_namespace"
+        key = "universe.fo.nodes@0000000001.000000"
+        contents = os.urandom(1024 * 1024 + 1)
+
+        async def download():
+            connection = await client.SingleConnection.open(
+                "localhost", self.port,
+                {"task": "file_download", "binary_frames": True,
+                 "framing": "pipelined"})
+            try:
+                self.assertTrue(await connection.send({
+                    "requested_file": {"namespace": namespace, "key": key}}))
+                await self.answer_request(contents)
+
+                header = await connection.read()
+                payload = await connection.read_binary(
+                    header["file_request"]["size"])
+                # the server does not wait for an ACK but closes the
+                # connection after the download
+                end = await asyncio.wait_for(connection.read(), 5)
+            finally:
+                connection.close()
+            return header, payload, end
+
+        header, payload, end = self.loop.run_until_complete(download())
+
+        self.assertEqual(header["file_request"]["encoding"], "binary")
+        self.assertEqual(header["file_request"]["size"], len(contents))
+        self.assertEqual(payload, contents)
+        self.assertIsNone(end)
+
+    def answer_index_requests(self, count):
+        """
+        Hand an index to the server for count index requests, the n-th index
+        has the namespace "namespace_n".
+
+        """
+        for number in range(count):
+            if not self.get_index_server_event.wait(5):
+                return
+            self.get_index_server_event.clear()
+            self.queue_datacopy_backend_index_data.put({
+                "index": {"namespace_{}".format(number): {}},
+                "namespace_states": {}
+            })
+
+    async def index_round_trips(self, handshake, count):
+        """
+        Send count index requests before reading any answer and return the
+        answers.
+
+        """
+        answering = self.loop.run_in_executor(
+            None, self.answer_index_requests, count)
+
+        connection = await client.SingleConnection.open(
+            "localhost", self.port, handshake)
+        try:
+            for _ in range(count):
+                self.assertTrue(await connection.send({"todo": "index"}))
+            answers = list()
+            for _ in range(count):
+                answers.append(await asyncio.wait_for(connection.read(), 10))
+        finally:
+            connection.close()
+
+        await answering
+        return answers
+
+    def test_framing_round_trips(self):
+        """pipelined messages with and without ack window and legacy messages
+        on the same server
+
+        """
+        expected = [
+            {"todo": "index", "index": {"namespace_{}".format(number): {}},
+             "namespace_states": {}}
+            for number in range(5)
+        ]
+
+        # several messages without any ACKs
+        answers = self.loop.run_until_complete(self.index_round_trips(
+            {"task": "index", "framing": "pipelined"}, 5))
+        self.assertEqual(answers, expected)
+
+        # an ACK frame after every second message in both directions, more
+        # requests are sent while answers are on their way
+        answers = self.loop.run_until_complete(self.index_round_trips(
+            {"task": "index", "framing": "pipelined", "ack_window": 2}, 5))
+        self.assertEqual(answers, expected)
+
+        # the legacy framing still works on the same server
+        answers = self.loop.run_until_complete(self.index_round_trips(
+            {"task": "index"}, 1))
+        self.assertEqual(answers, expected[:1])
+
+
+    def test_coalesced_downloads(self):
+        """concurrent downloads of the same file share one read
+
+        """
+        requested_file = {
+            "namespace": "some_namespace",
+            "key": "universe.fo.nodes@0000000001.000000"
+        }
+        contents = os.urandom(4096)
+        count = 5
+
+        async def download():
+            connections = await self.concurrent_downloads(
+                count, requested_file)
+            try:
+                request = await self.answer_request(contents)
+                self.assertNoMoreRequests()
+                answers = await asyncio.gather(
+                    *[asyncio.wait_for(connection.read(), 5)
+                      for connection in connections])
+            finally:
+                for connection in connections:
+                    connection.close()
+            return request, answers
+
+        request, answers = self.loop.run_until_complete(download())
+
+        self.assertEqual(request, requested_file)
+        self.assertEqual(len(answers), count)
+        for answer in answers:
+            self.assertEqual(
+                base64.b64decode(answer["file_request"]["contents"]),
+                contents)
+
+    def test_coalesced_downloads_timeout(self):
+        """downloads that share a read that never finishes give up together,
+        the next download reads again
+
+        """
+        requested_file = {
+            "namespace": "some_namespace",
+            "key": "universe.fo.nodes@0000000001.000000"
+        }
+        contents = os.urandom(4096)
+        count = 3
+
+        async def download():
+            connections = await self.concurrent_downloads(
+                count, requested_file)
+            try:
+                # the read fails, nothing comes back from the ceph manager
+                request = await self.loop.run_in_executor(
+                    None, self.file_name_request_server_queue.get, True, 5)
+                self.assertNoMoreRequests()
+                # the server closes the connections at the timeout
+                answers = await asyncio.gather(
+                    *[asyncio.wait_for(connection.read(), 15)
+                      for connection in connections])
+            finally:
+                for connection in connections:
+                    connection.close()
+
+            retry, = await self.concurrent_downloads(1, requested_file)
+            try:
+                retry_request = await self.answer_request(contents)
+                retry_answer = await asyncio.wait_for(retry.read(), 5)
+            finally:
+                retry.close()
+
+            return request, answers, retry_request, retry_answer
+
+        request, answers, retry_request, retry_answer = (
+            self.loop.run_until_complete(download()))
+
+        self.assertEqual(request, requested_file)
+        self.assertEqual(answers, [None] * count)
+        self.assertEqual(retry_request, requested_file)
+        self.assertEqual(
+            base64.b64decode(retry_answer["file_request"]["contents"]),
+            contents)
+
+    def test_coalesced_downloads_failed_read(self):
+        """downloads that share a read that failed give up right away, the
+        next download reads again
+
+        """
+        requested_file = {
+            "namespace": "some_namespace",
+            "key": "universe.fo.nodes@0000000001.000000"
+        }
+        contents = os.urandom(4096)
+        count = 3
+
+        async def download():
+            connections = await self.concurrent_downloads(
+                count, requested_file)
+            try:
+                request = await self.loop.run_in_executor(
+                    None, self.file_name_request_server_queue.get, True, 5)
+                self.file_contents_name_hash_server_queue.put({
+                    "namespace": request["namespace"],
+                    "object": request["key"],
+                    "error": True
+                })
+                # well before the download timeout
+                answers = await asyncio.gather(
+                    *[asyncio.wait_for(connection.read(), 3)
+                      for connection in connections])
+            finally:
+                for connection in connections:
+                    connection.close()
+
+            retry, = await self.concurrent_downloads(1, requested_file)
+            try:
+                retry_request = await self.answer_request(contents)
+                retry_answer = await asyncio.wait_for(retry.read(), 5)
+            finally:
+                retry.close()
+
+            return request, answers, retry_request, retry_answer
+
+        request, answers, retry_request, retry_answer = (
+            self.loop.run_until_complete(download()))
+
+        self.assertEqual(request, requested_file)
+        self.assertEqual(answers, [None] * count)
+        self.assertEqual(retry_request, requested_file)
+        self.assertEqual(
+            base64.b64decode(retry_answer["file_request"]["contents"]),
+            contents)
+
+
+    def test_cached_objects_release_shared_memory(self):
+        """objects in the cache do not keep their slots of the shared buffer
+        pool
+
+        """
+        namespace = "some_namespace"
+        keys = [
+            "universe.fo.nodes@{:010d}.000000".format(number)
+            for number in range(3 * self.shm_slots)
+        ]
+        contents = {key: os.urandom(1000 + number)
+                    for number, key in enumerate(keys)}
+
+        async def download(key, answer=True):
+            connection = await client.SingleConnection.open(
+                "localhost", self.port,
+                {"task": "file_download", "binary_frames": True})
+            try:
+                self.assertTrue(await connection.send({
+                    "requested_file": {"namespace": namespace, "key": key}}))
+
+                if answer:
+                    request = await self.loop.run_in_executor(
+                        None, self.file_name_request_server_queue.get, True, 5)
+                    # fails if the slots are still taken by the cache
+                    shm_descriptor = self.buffer_pool.store(contents[key])
+                    self.assertIsNotNone(shm_descriptor)
+                    self.file_contents_name_hash_server_queue.put({
+                        "namespace": request["namespace"],
+                        "object": request["key"],
+                        "tags": {"sha1sum": ""},
+                        "shm": shm_descriptor
+                    })
+
+                header = await connection.read()
+                return await connection.read_binary(
+                    header["file_request"]["size"])
+            finally:
+                connection.close()
+
+        for key in keys:
+            self.assertEqual(
+                self.loop.run_until_complete(download(key)), contents[key])
+
+        # every slot is free again
+        descriptors = [
+            self.buffer_pool.acquire(1) for _ in range(self.shm_slots)]
+        self.assertNotIn(None, descriptors)
+        for descriptor in descriptors:
+            self.buffer_pool.release(descriptor)
+
+        # and the objects are still served from the cache
+        self.assertEqual(
+            self.loop.run_until_complete(download(keys[0], answer=False)),
+            contents[keys[0]])
+        self.assertNoMoreRequests()
+
+    def test_streamed_pieces(self):
+        """an object that arrives in pieces is sent while it arrives and
+        cached once it is complete
+
+        """
+        requested_file = {
+            "namespace": "some_namespace",
+            "key": "universe.fo.nodes@0000000001.000000"
+        }
+        contents = os.urandom(3500)
+        sha1sum = hashlib.sha1(contents).hexdigest()
+
+        async def download():
+            connection = await client.SingleConnection.open(
+                "localhost", self.port,
+                {"task": "file_download", "binary_frames": True})
+            try:
+                self.assertTrue(await connection.send(
+                    {"requested_file": requested_file}))
+                request = await self.loop.run_in_executor(
+                    None, self.file_name_request_server_queue.get, True, 5)
+                answering = self.loop.run_in_executor(
+                    None, self.put_pieces, request, contents, 1000,
+                    {"sha1sum": ""}, {"sha1sum": sha1sum})
+
+                header = await asyncio.wait_for(connection.read(), 5)
+                payload = await asyncio.wait_for(
+                    connection.read_binary(header["file_request"]["size"]), 5)
+                await answering
+            finally:
+                connection.close()
+            return header, payload
+
+        header, payload = self.loop.run_until_complete(download())
+
+        self.assertEqual(header["file_request"]["size"], len(contents))
+        self.assertEqual(payload, contents)
+
+        # the complete object is in the cache under the sha1sum of the last
+        # piece
+        connection, = self.loop.run_until_complete(self.concurrent_downloads(
+            1, dict(requested_file, sha1sum=sha1sum)))
+        try:
+            answer = self.loop.run_until_complete(
+                asyncio.wait_for(connection.read(), 5))
+        finally:
+            connection.close()
+        self.assertNoMoreRequests()
+        self.assertEqual(
+            base64.b64decode(answer["file_request"]["contents"]), contents)
+        self.assertEqual(answer["file_request"]["tags"], {"sha1sum": sha1sum})
+
+    def test_streamed_pieces_failed_read(self):
+        """a download of an object that fails half way through gives up right
+        away
+
+        """
+        requested_file = {
+            "namespace": "some_namespace",
+            "key": "universe.fo.nodes@0000000001.000000"
+        }
+        contents = os.urandom(3500)
+
+        async def download():
+            connection = await client.SingleConnection.open(
+                "localhost", self.port,
+                {"task": "file_download", "binary_frames": True})
+            try:
+                self.assertTrue(await connection.send(
+                    {"requested_file": requested_file}))
+                request = await self.loop.run_in_executor(
+                    None, self.file_name_request_server_queue.get, True, 5)
+                self.file_contents_name_hash_server_queue.put({
+                    "namespace": request["namespace"],
+                    "object": request["key"],
+                    "tags": {"sha1sum": ""},
+                    "size": len(contents),
+                    "offset": 0,
+                    "value": contents[:1000],
+                    "complete": False
+                })
+                header = await asyncio.wait_for(connection.read(), 5)
+                self.file_contents_name_hash_server_queue.put({
+                    "namespace": request["namespace"],
+                    "object": request["key"],
+                    "error": True
+                })
+                # the server closes the connection well before the download
+                # timeout
+                with self.assertRaises(asyncio.IncompleteReadError):
+                    await asyncio.wait_for(
+                        connection.read_binary(
+                            header["file_request"]["size"]), 3)
+            finally:
+                connection.close()
+
+        self.loop.run_until_complete(download())
+
+        # the object is not in the cache, the next download reads again
+        connection, = self.loop.run_until_complete(
+            self.concurrent_downloads(1, requested_file))
+        try:
+            self.loop.run_until_complete(self.answer_request(contents))
+            answer = self.loop.run_until_complete(
+                asyncio.wait_for(connection.read(), 5))
+        finally:
+            connection.close()
+        self.assertEqual(
+            base64.b64decode(answer["file_request"]["contents"]), contents)
+
+
+
+class Test_BackendManager_DiskCache(SingleConnectionTestCase):
+    """
+    A server with a memory cache that only holds one of the test objects and
+    a disk cache.
+
+    """
+    port = 9003
+
+    def server_kwargs(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        return {
+            "buffer_pool": self.buffer_pool,
+            "cache_size": 6000,
+            "disk_cache_directory": self.tmp_dir.name
+        }
+
+    def tearDown(self):
+        super().tearDown()
+        self.tmp_dir.cleanup()
+
+    def test_evicted_objects_come_from_disk(self):
+        """objects that are evicted from memory are read from the disk cache
+
+        """
+        namespace = "some_namespace"
+        first_key = "universe.fo.nodes@0000000001.000000"
+        second_key = "universe.fo.nodes@0000000002.000000"
+        first = os.urandom(4000)
+        second = os.urandom(4000)
+        first_sha1sum = hashlib.sha1(first).hexdigest()
+        first_path = pathlib.Path(
+            self.tmp_dir.name, first_sha1sum[:2], first_sha1sum)
+
+        async def download(key, contents=None, sha1sum=""):
+            connection, = await self.concurrent_downloads(1, {
+                "namespace": namespace, "key": key, "sha1sum": sha1sum})
+            try:
+                if contents is not None:
+                    await self.answer_request(contents, sha1sum)
+                answer = await asyncio.wait_for(connection.read(), 5)
+            finally:
+                connection.close()
+            return base64.b64decode(answer["file_request"]["contents"])
+
+        self.assertEqual(
+            self.loop.run_until_complete(
+                download(first_key, first, first_sha1sum)),
+            first)
+
+        # written in the background
+        for _ in range(50):
+            if first_path.exists():
+                break
+            time.sleep(.1)
+        self.assertEqual(first_path.read_bytes(), first)
+
+        # evicts the first object from memory
+        self.assertEqual(
+            self.loop.run_until_complete(download(second_key, second)),
+            second)
+
+        self.assertEqual(
+            self.loop.run_until_complete(
+                download(first_key, sha1sum=first_sha1sum)),
+            first)
+        self.assertNoMoreRequests()
+
+    def test_sha1sum_mismatch(self):
+        """an object that does not match the sha1sum it came with is neither
+        stored on disk nor kept in memory
+
+        """
+        requested_file = {
+            "namespace": "some_namespace",
+            "key": "universe.fo.nodes@0000000001.000000"
+        }
+        contents = os.urandom(2000)
+        stale_sha1sum = hashlib.sha1(b"old contents").hexdigest()
+
+        async def download():
+            connection, = await self.concurrent_downloads(1, requested_file)
+            try:
+                await self.answer_request(contents, stale_sha1sum)
+                return await asyncio.wait_for(connection.read(), 5)
+            finally:
+                connection.close()
+
+        answer = self.loop.run_until_complete(download())
+        self.assertEqual(
+            base64.b64decode(answer["file_request"]["contents"]), contents)
+
+        # hashed in the background
+        time.sleep(1)
+        self.assertFalse(pathlib.Path(
+            self.tmp_dir.name, stale_sha1sum[:2], stale_sha1sum).exists())
+
+        # the next download reads the object again
+        connection, = self.loop.run_until_complete(self.concurrent_downloads(
+            1, dict(requested_file, sha1sum=stale_sha1sum)))
+        connection.close()
+        self.assertEqual(
+            self.file_name_request_server_queue.get(True, 5)["key"],
+            requested_file["key"])
+
+
+    def test_removed_objects(self):
+        """objects the change feed reports as removed are neither served from
+        memory nor from disk anymore
+
+        """
+        namespace = "some_namespace"
+        key = "universe.fo.nodes@0000000001.000000"
+        contents = os.urandom(1000)
+        sha1sum = hashlib.sha1(contents).hexdigest()
+        path = pathlib.Path(self.tmp_dir.name, sha1sum[:2], sha1sum)
+
+        async def download(answer_contents=None, answer_sha1sum=""):
+            connection, = await self.concurrent_downloads(1, {
+                "namespace": namespace, "key": key})
+            try:
+                if answer_contents is not None:
+                    await self.answer_request(answer_contents, answer_sha1sum)
+                answer = await asyncio.wait_for(connection.read(), 5)
+            finally:
+                connection.close()
+            return base64.b64decode(answer["file_request"]["contents"])
+
+        self.assertEqual(
+            self.loop.run_until_complete(download(contents, sha1sum)),
+            contents)
+        for _ in range(50):
+            if path.exists():
+                break
+            time.sleep(.1)
+        self.assertTrue(path.exists())
+
+        # cached
+        self.assertEqual(self.loop.run_until_complete(download()), contents)
+        self.assertNoMoreRequests()
+
+        self.new_file_server_queue.put({
+            "namespace": namespace,
+            "key": key,
+            "sha1sum": sha1sum,
+            "removed": True
+        })
+        time.sleep(.2)
+
+        # whatever the cluster answers now
+        self.assertEqual(
+            self.loop.run_until_complete(download(b"")), b"")
+
+    def test_streamed_pieces_sha1sum_mismatch(self):
+        """the sha1sum calculated while reading, which comes with the last
+        piece, wins over a different one of the first piece
+
+        """
+        requested_file = {
+            "namespace": "some_namespace",
+            "key": "universe.fo.nodes@0000000001.000000"
+        }
+        contents = os.urandom(2500)
+        sha1sum = hashlib.sha1(contents).hexdigest()
+        stale_sha1sum = hashlib.sha1(b"old contents").hexdigest()
+
+        async def download():
+            connection, = await self.concurrent_downloads(1, requested_file)
+            try:
+                request = await self.loop.run_in_executor(
+                    None, self.file_name_request_server_queue.get, True, 5)
+                await self.loop.run_in_executor(
+                    None, self.put_pieces, request, contents, 1000,
+                    {"sha1sum": stale_sha1sum}, {"sha1sum": sha1sum})
+                return await asyncio.wait_for(connection.read(), 5)
+            finally:
+                connection.close()
+
+        answer = self.loop.run_until_complete(download())
+        self.assertEqual(
+            base64.b64decode(answer["file_request"]["contents"]), contents)
+        self.assertEqual(answer["file_request"]["tags"], {"sha1sum": sha1sum})
+
+        # stored on disk under the sha1sum of the contents only
+        path = pathlib.Path(self.tmp_dir.name, sha1sum[:2], sha1sum)
+        for _ in range(50):
+            if path.exists():
+                break
+            time.sleep(.1)
+        self.assertEqual(path.read_bytes(), contents)
+        self.assertFalse(pathlib.Path(
+            self.tmp_dir.name, stale_sha1sum[:2], stale_sha1sum).exists())
+
+        # a download that asks for the stale sha1sum does not get the object
+        # from the cache
+        connection, = self.loop.run_until_complete(self.concurrent_downloads(
+            1, dict(requested_file, sha1sum=stale_sha1sum)))
+        connection.close()
+        self.assertEqual(
+            self.file_name_request_server_queue.get(True, 5)["key"],
+            requested_file["key"])
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -4,10 +4,13 @@ Test ceph_connection.py
 
 """
 import time
+import asyncio
 import unittest
 import pathlib
 import hashlib
+import collections
 import multiprocessing
+import concurrent.futures
 
 try:
     import modules.ceph_connection as cc
@@ -170,5 +173,216 @@ class Test_CephConnection(unittest.TestCase):
         data = self.queue_object_hash.get(True, 2)  # block for 2 seconds
 
 
+class FakeCompletion(object):
+    def get_return_value(self):
+        return 0
+
+
+class FakeIoctx(object):
+    """
+    Keeps objects and their xattrs in memory. Asynchronous operations complete
+    right away.
+
+    """
+    def __init__(self, objects=None, xattrs=None, stat_sizes=None):
+        self.objects = dict() if objects is None else objects
+        self.xattrs = dict() if xattrs is None else xattrs
+        # sizes reported by stat that differ from the objects
+        self.stat_sizes = dict() if stat_sizes is None else stat_sizes
+        self.namespace = ""
+        self.closed = False
+
+    def set_namespace(self, namespace):
+        self.namespace = namespace
+
+    def close(self):
+        self.closed = True
+
+    def aio_stat(self, objname, oncomplete):
+        size = self.stat_sizes.get(objname, len(self.objects[objname]))
+        oncomplete(FakeCompletion(), size, time.localtime())
+
+    def aio_read(self, objname, length, offset, oncomplete):
+        oncomplete(
+            FakeCompletion(), self.objects[objname][offset:offset + length])
+
+    def get_xattrs(self, objname):
+        return list(self.xattrs.get(objname, dict()).items())
+
+    def set_xattr(self, objname, key, value):
+        self.xattrs.setdefault(objname, dict())[key] = value
+
+
+class FakeCluster(object):
+    """
+    Opens IO contexts that share the objects of ioctx.
+
+    """
+    def __init__(self, ioctx):
+        self._ioctx = ioctx
+        self.opened = list()
+
+    def open_ioctx(self, pool):
+        ioctx = FakeIoctx(
+            self._ioctx.objects, self._ioctx.xattrs, self._ioctx.stat_sizes)
+        self.opened.append(ioctx)
+        return ioctx
+
+
+class Test_CephConnection_Reads(unittest.TestCase):
+    """
+    Read objects through a fake IO context, in chunks of 4 bytes. Objects of
+    more than 10 bytes are put in pieces.
+
+    """
+    def setUp(self):
+        self.ioctx = FakeIoctx()
+
+        # the parts under test do not need a connection to the cluster
+        self.connection = object.__new__(cc.CephConnection)
+        self.connection._loop = asyncio.new_event_loop()
+        self.connection._cluster = FakeCluster(self.ioctx)
+        self.connection._target_pool = "pool"
+        self.connection._namespace_ioctxs = collections.OrderedDict()
+        self.connection._max_namespace_ioctxs = 2
+        self.connection._buffer_pool = None
+        self.connection._read_chunk_size = 4
+        self.connection._parallel_chunk_reads = 2
+        self.connection._stream_threshold = 10
+        self.connection._rados_latency = 0
+        self.connection._rados_latency_weight = 5e-2
+        self.connection._executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.connection._bulk_executor = self.connection._executor
+
+    def tearDown(self):
+        self.connection._executor.shutdown()
+        self.connection._loop.close()
+
+    def read_everything(self, obj_name):
+        pieces = list()
+        self.connection._loop.run_until_complete(
+            self.connection.read_everything_for_object(
+                {"namespace": "namespace", "object": obj_name},
+                pieces.append))
+        return pieces
+
+    def test_range(self):
+        """only the range is read, cut short where the object ends
+
+        """
+        self.ioctx.objects["object"] = b"0123456789abcdef"
+        self.ioctx.xattrs["object"] = {"sha1sum": b"SOMEHASH"}
+
+        def read_range(offset, length):
+            return self.connection._loop.run_until_complete(
+                self.connection.read_range_of_object({
+                    "namespace": "namespace",
+                    "object": "object",
+                    "range": {"offset": offset, "length": length}
+                }))
+
+        answer = read_range(5, 6)
+        self.assertEqual(answer["value"], b"56789a")
+        self.assertEqual(answer["range"], {"offset": 5, "length": 6})
+        self.assertEqual(answer["tags"], {"sha1sum": "SOMEHASH"})
+
+        self.assertEqual(read_range(14, 100)["value"], b"ef")
+        self.assertEqual(read_range(20, 4)["value"], b"")
+
+    def test_small_object(self):
+        """small objects are put at once, with a sha1sum calculated on the way
+
+        """
+        contents = b"0123456789"
+        self.ioctx.objects["object"] = contents
+
+        pieces = self.read_everything("object")
+
+        self.assertEqual(len(pieces), 1)
+        self.assertEqual(pieces[0]["value"], contents)
+        self.assertEqual(
+            pieces[0]["tags"]["sha1sum"], hashlib.sha1(contents).hexdigest())
+        self.assertNotIn("offset", pieces[0])
+
+    def test_pieces(self):
+        """large objects are put in pieces, the last one carries the sha1sum
+
+        """
+        contents = bytes(range(25))
+        sha1sum = hashlib.sha1(contents).hexdigest()
+        self.ioctx.objects["object"] = contents
+
+        pieces = self.read_everything("object")
+
+        self.assertEqual(
+            [piece["offset"] for piece in pieces], [0, 4, 8, 12, 16, 20, 24])
+        self.assertEqual(
+            [piece["complete"] for piece in pieces], [False] * 6 + [True])
+        self.assertEqual({piece["size"] for piece in pieces}, {25})
+
+        reassembled = bytearray(25)
+        for piece in pieces:
+            end = piece["offset"] + len(piece["value"])
+            reassembled[piece["offset"]:end] = piece["value"]
+        self.assertEqual(bytes(reassembled), contents)
+
+        self.assertEqual(pieces[0]["tags"]["sha1sum"], "")
+        self.assertEqual(pieces[-1]["tags"]["sha1sum"], sha1sum)
+        self.assertEqual(
+            self.ioctx.xattrs["object"], {"sha1sum": sha1sum.encode()})
+
+    def test_pieces_sha1sum_mismatch(self):
+        """the hash of an object that shrinks while it is read is of no use,
+        the last piece has no sha1sum and none is written
+
+        """
+        self.ioctx.objects["object"] = bytes(range(22))
+        self.ioctx.stat_sizes["object"] = 25
+
+        pieces = self.read_everything("object")
+
+        self.assertTrue(pieces[-1]["complete"])
+        self.assertEqual(
+            pieces[-1]["offset"] + len(pieces[-1]["value"]), 22)
+        self.assertEqual(pieces[-1]["tags"]["sha1sum"], "")
+        self.assertNotIn("object", self.ioctx.xattrs)
+
+    def test_namespace_ioctxs(self):
+        """only the IO contexts of the namespaces used last stay open, one
+        that is still in use is closed when the operation is done
+
+        """
+        def use(namespace):
+            with self.connection._namespace_ioctx(namespace) as ioctx:
+                return ioctx
+
+        ioctx_a = use("a")
+        self.assertIs(use("a"), ioctx_a)
+        self.assertEqual(ioctx_a.namespace, "a")
+
+        ioctx_b = use("b")
+        use("a")
+        ioctx_c = use("c")
+
+        # b has been used least recently
+        self.assertTrue(ioctx_b.closed)
+        self.assertFalse(ioctx_a.closed)
+        self.assertFalse(ioctx_c.closed)
+        self.assertEqual(
+            list(self.connection._namespace_ioctxs), ["a", "c"])
+
+        with self.connection._namespace_ioctx("a") as ioctx:
+            use("d")
+            use("e")
+            self.assertNotIn("a", self.connection._namespace_ioctxs)
+            self.assertFalse(ioctx.closed)
+        self.assertTrue(ioctx.closed)
+
+        self.assertEqual(len(self.connection._cluster.opened), 5)
+        self.assertEqual(
+            [ioctx.closed for ioctx in self.connection._cluster.opened],
+            [True, True, True, False, False])
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -4,8 +4,10 @@ Test ceph_manager.py
 
 """
 import time
+import queue
 import unittest
 import pathlib
+import threading
 import multiprocessing
 
 try:
@@ -15,6 +17,9 @@ except ImportError:
     sys.path.append('../../..')
     import modules.ceph_manager as cm
 
+from modules.task_scheduler import TaskScheduler
+from modules.shared_buffer_pool import SharedBufferPool
+from modules.connection_autoscaler import ConnectionAutoscaler
 from util.loggers import CoreLog as cl, BackendLog as bl, SimulationLog as sl
 
 class Test_CephManager(unittest.TestCase):
@@ -186,6 +191,218 @@ class Test_CephManager(unittest.TestCase):
         ceph.terminate()
         time.sleep(.1)
 
+
+class FakeProcess(object):
+    def __init__(self):
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+    def join(self):
+        pass
+
+
+class Test_CephManager_IndexTasks(unittest.TestCase):
+    """
+    Index tasks of ceph connections that die before they are done.
+
+    """
+    def setUp(self):
+        # the parts under test do not need the ceph connections
+        self.manager = object.__new__(cm.CephManager)
+        self.manager._task_scheduler = TaskScheduler(
+            ["data", "hashes", "index_namespaces", "index"])
+        self.manager._autoscaler = ConnectionAutoscaler(
+            1, 4, tasks_per_connection=32)
+        self.manager._connections = dict()
+        self.manager._stopping_connections = dict()
+        self.manager._change_feed = None
+        self.manager._connection_stop_timeout = 10
+        self.manager._index_batch_size = 10000
+        self.manager._index_request_timeout = 60 * 60
+        self.manager._index_requested_at = time.time()
+        self.manager._index_namespaces_pending = None
+        self.manager._index_namespaces_done = set()
+        self.manager._index_tasks_by_slot = dict()
+        self.manager._index_task_attempts = 2
+        self.manager._buffer_pool = SharedBufferPool(2, 1024)
+        self.manager._queue_datacopy_ceph_filename_and_hash = queue.Queue()
+        self.manager._lock_datacopy_ceph_filename_and_hash = threading.Lock()
+
+        self.processes = dict()
+        for slot in range(2):
+            self.processes[slot] = FakeProcess()
+            self.manager._connections[slot] = {
+                "process": self.processes[slot]
+            }
+
+    def namespace_task(self, namespace):
+        return {
+            "task": "read_namespace_index",
+            "task_info": {"namespace": namespace, "objects": ["object"]}
+        }
+
+    def start(self, slot, task):
+        if task["task"] == "read_index":
+            self.manager._handle_index({"started": task, "slot": slot})
+        else:
+            self.manager._handle_namespace_index({
+                "namespace": task["task_info"]["namespace"],
+                "started": task,
+                "slot": slot
+            })
+
+    def die(self, slot):
+        self.processes[slot].alive = False
+        self.manager._reap_ceph_connections()
+
+    def datacopy_messages(self):
+        messages = list()
+        while True:
+            try:
+                messages.append(
+                    self.manager._queue_datacopy_ceph_filename_and_hash.get(
+                        False))
+            except queue.Empty:
+                return messages
+
+    def test_finished(self):
+        """tasks that are done are not handed out again
+
+        """
+        self.manager._handle_index({"namespaces": ["a", "b"], "slot": 0})
+        self.start(0, self.namespace_task("a"))
+        self.start(1, self.namespace_task("b"))
+        self.manager._handle_namespace_index(
+            {"namespace": "a", "index": {"object": {}}, "slot": 0})
+
+        self.die(0)
+
+        self.assertIsNone(self.manager._task_scheduler.get(timeout=0))
+        self.assertEqual(self.manager._index_tasks_by_slot, {
+            1: [self.namespace_task("b")]
+        })
+
+    def test_namespace(self):
+        """the namespace of a dead connection is read by another one, and
+        given up on when that dies as well
+
+        """
+        self.manager._handle_index({"namespaces": ["a", "b"], "slot": 0})
+        self.manager._handle_namespace_index(
+            {"namespace": "b", "index": {"object": {}}, "slot": 0})
+        self.datacopy_messages()
+
+        self.start(0, self.namespace_task("a"))
+        self.die(0)
+
+        task_class, task = self.manager._task_scheduler.get(timeout=1)
+        self.assertEqual(task_class, "index_namespaces")
+        self.assertEqual(task["task_info"]["namespace"], "a")
+        self.assertEqual(task["task_info"]["attempt"], 2)
+        self.assertIsNotNone(self.manager._index_requested_at)
+
+        self.start(1, task)
+        self.die(1)
+
+        self.assertIsNone(self.manager._task_scheduler.get(timeout=0))
+        self.assertEqual(self.datacopy_messages(), [
+            {"namespace": "a", "namespace_complete": True, "failed": True},
+            {"index_complete": True}
+        ])
+        self.assertIsNone(self.manager._index_requested_at)
+        self.assertEqual(self.manager._index_tasks_by_slot, dict())
+
+    def test_index(self):
+        """the index is requested again when the connection listing the
+        namespaces dies, and can be requested again once that dies as well
+
+        """
+        self.start(0, {"task": "read_index", "task_info": {}})
+        self.die(0)
+
+        task_class, task = self.manager._task_scheduler.get(timeout=1)
+        self.assertEqual(task_class, "index")
+        self.assertIsNotNone(self.manager._index_requested_at)
+
+        self.start(1, task)
+        self.die(1)
+
+        self.assertIsNone(self.manager._task_scheduler.get(timeout=0))
+        self.assertIsNone(self.manager._index_requested_at)
+        self.assertEqual(self.datacopy_messages(), [
+            {"index_complete": True, "failed": True}
+        ])
+
+    def test_buffers_released(self):
+        """shared buffers a connection was still reading into are given back
+        when it dies
+
+        """
+        self.manager._buffer_pool.acquire(10, 0)
+        self.manager._buffer_pool.acquire(10, 1)
+
+        self.die(0)
+
+        descriptor = self.manager._buffer_pool.acquire(10)
+        self.assertIsNotNone(descriptor)
+        self.assertEqual(descriptor["slot"], 0)
+        self.assertIsNone(self.manager._buffer_pool.acquire(10))
+
+    def test_index_failed(self):
+        """a failed listing of the namespaces ends the index that is being read
+
+        """
+        self.start(0, {"task": "read_index", "task_info": {}})
+        self.manager._handle_index({"namespaces": None, "slot": 0})
+
+        self.assertIsNone(self.manager._index_requested_at)
+        self.assertEqual(self.manager._index_tasks_by_slot, dict())
+        self.assertEqual(self.datacopy_messages(), [
+            {"index_complete": True, "failed": True}
+        ])
+
+
+class Test_CephManager_ObjectData(unittest.TestCase):
+    """
+    Reads of objects that are already in flight.
+
+    """
+    def setUp(self):
+        # the parts under test do not need the ceph connections
+        self.manager = object.__new__(cm.CephManager)
+        self.manager._task_scheduler = TaskScheduler(
+            ["data", "hashes", "index_namespaces", "index"])
+        self.manager._object_data_requests_in_flight = dict()
+        self.manager._object_data_request_timeout = 5
+        self.manager._queue_backend_ceph_answer_file_name_contents_hash = (
+            queue.Queue())
+
+    def test_failed_read(self):
+        """a read that failed can be requested again right away
+
+        """
+        file_request = {"namespace": "ns", "key": "object"}
+        failed = {"namespace": "ns", "object": "object", "error": True}
+
+        self.manager._handle_file_request(file_request)
+        self.manager._handle_file_request(file_request)
+        self.assertIsNotNone(self.manager._task_scheduler.get(timeout=0))
+        self.assertIsNone(self.manager._task_scheduler.get(timeout=0))
+
+        self.manager._handle_object_data(failed)
+        self.assertEqual(
+            self.manager._object_data_requests_in_flight, dict())
+        self.assertEqual(
+            self.manager._queue_backend_ceph_answer_file_name_contents_hash
+            .get(False),
+            failed)
+
+        self.manager._handle_file_request(file_request)
+        self.assertIsNotNone(self.manager._task_scheduler.get(timeout=0))
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
 
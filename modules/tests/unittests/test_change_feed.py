@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Test change_feed.py
+
+"""
+import json
+import time
+import unittest
+import unittest.mock
+
+try:
+    import modules.change_feed as change_feed
+except ImportError:
+    import sys
+    sys.path.append('../../..')
+    import modules.change_feed as change_feed
+
+
+class FakeObjectNotFound(Exception):
+    pass
+
+
+class FakeOpCtx(object):
+    """
+    Stands in for the read and write operations of rados.
+
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeRados(object):
+    """
+    The parts of the rados module the change feed uses.
+
+    """
+    Error = Exception
+    ObjectNotFound = FakeObjectNotFound
+    ReadOpCtx = FakeOpCtx
+    WriteOpCtx = FakeOpCtx
+
+
+class FakeIoctx(object):
+    """
+    Keeps the omap of objects in memory. Like in rados the results of a read
+    operation are only there once the operation has run.
+
+    """
+    def __init__(self):
+        self.omaps = dict()
+        self._pending = None
+
+    def set_omap(self, write_op, keys, values):
+        self._pending = ("set", dict(zip(keys, values)))
+
+    def remove_omap_keys(self, write_op, keys):
+        self._pending = ("remove", keys)
+
+    def operate_write_op(self, write_op, oid):
+        action, arguments = self._pending
+        omap = self.omaps.setdefault(oid, dict())
+        if action == "set":
+            omap.update(arguments)
+        else:
+            for key in arguments:
+                omap.pop(key, None)
+
+    def get_omap_vals(self, read_op, start_after, filter_prefix, max_return):
+        entries = list()
+        self._pending = (start_after, max_return, entries, True)
+        return entries, 0
+
+    def get_omap_keys(self, read_op, start_after, max_return):
+        entries = list()
+        self._pending = (start_after, max_return, entries, False)
+        return entries, 0
+
+    def operate_read_op(self, read_op, oid):
+        start_after, max_return, entries, with_values = self._pending
+        if oid not in self.omaps:
+            raise FakeObjectNotFound(oid)
+        for key in sorted(self.omaps[oid].keys()):
+            if key > start_after and len(entries) < max_return:
+                if with_values:
+                    entries.append((key, self.omaps[oid][key]))
+                else:
+                    entries.append((key, None))
+
+
+class Test_ChangeFeed(unittest.TestCase):
+
+    def setUp(self):
+        self.rados_patch = unittest.mock.patch.object(
+            change_feed, "rados", FakeRados)
+        self.rados_patch.start()
+
+        self.ioctx = FakeIoctx()
+
+        # the parts under test do not need a connection to the cluster
+        self.feed = object.__new__(change_feed.ChangeFeed)
+        self.feed._ioctx = self.ioctx
+        self.feed._control_object = change_feed.CONTROL_OBJECT
+        self.feed._clock_skew = 10
+        self.feed._max_entries = 2
+        self.feed._retention = 60
+        self.feed._newest_change = time.time()
+        self.feed._seen_changes = dict()
+
+    def tearDown(self):
+        self.rados_patch.stop()
+
+    def publish(self, key, timestamp=None, **kwargs):
+        if timestamp is None:
+            change_feed.publish_change(self.ioctx, "namespace", key, **kwargs)
+            return
+        with unittest.mock.patch.object(
+                change_feed.time, "time", return_value=timestamp):
+            change_feed.publish_change(self.ioctx, "namespace", key, **kwargs)
+
+    def test_nothing_published(self):
+        """a missing control object means there are no changes
+
+        """
+        self.assertEqual(self.feed._read_changes(), [])
+
+    def test_read_changes(self):
+        """every change is read once, in the order it was published
+
+        """
+        self.publish("old", timestamp=time.time() - 60)
+        self.publish("first", sha1sum="FIRSTHASH")
+        self.publish("second", removed=True)
+        self.publish("third")
+
+        changes = self.feed._read_changes()
+        self.assertEqual(
+            changes,
+            [
+                {"namespace": "namespace", "key": "first",
+                 "sha1sum": "FIRSTHASH", "removed": False},
+                {"namespace": "namespace", "key": "second",
+                 "sha1sum": "", "removed": True},
+                {"namespace": "namespace", "key": "third",
+                 "sha1sum": "", "removed": False}
+            ])
+
+        self.publish("fourth")
+        self.assertEqual(
+            [change["key"] for change in self.feed._read_changes()],
+            ["fourth"])
+        self.assertEqual(self.feed._read_changes(), [])
+
+    def test_late_writer(self):
+        """changes of writers with a clock that is a bit behind are read
+
+        """
+        self.publish("now")
+        self.feed._read_changes()
+
+        self.publish("late", timestamp=time.time() - 5)
+        self.assertEqual(
+            [change["key"] for change in self.feed._read_changes()],
+            ["late"])
+
+    def test_trim_changes(self):
+        """old changes are removed from the control object
+
+        """
+        self.publish("old", timestamp=time.time() - 120)
+        self.publish("older", timestamp=time.time() - 180)
+        self.publish("new")
+
+        self.feed._trim_changes()
+
+        values = self.ioctx.omaps[change_feed.CONTROL_OBJECT].values()
+        self.assertEqual(
+            [json.loads(value.decode())["key"] for value in values], ["new"])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Test connection_autoscaler.py
+
+"""
+import unittest
+
+try:
+    from modules.connection_autoscaler import ConnectionAutoscaler
+except ImportError:
+    import sys
+    sys.path.append('../../..')
+    from modules.connection_autoscaler import ConnectionAutoscaler
+
+
+class Test_ConnectionAutoscaler(unittest.TestCase):
+
+    def setUp(self):
+        self.autoscaler = ConnectionAutoscaler(
+            2, 6, tasks_per_connection=10, target_utilization=.5,
+            max_latency=.5, scale_down_delay=30)
+
+    def test_grows_with_the_backlog(self):
+        """waiting tasks lead to more connections, up to the maximum
+
+        """
+        self.autoscaler.report(0, running=10, latency=.01)
+        self.autoscaler.report(1, running=10, latency=.01)
+
+        self.assertEqual(
+            self.autoscaler.desired_connections([0, 1], 0, now=0), 4)
+        self.assertEqual(
+            self.autoscaler.desired_connections([0, 1], 100, now=0), 6)
+
+    def test_slow_cluster(self):
+        """no connections are added while the cluster is slow
+
+        """
+        self.autoscaler.report(0, running=10, latency=2)
+        self.autoscaler.report(1, running=10, latency=2)
+
+        self.assertEqual(
+            self.autoscaler.desired_connections([0, 1], 100, now=0), 2)
+
+    def test_minimum(self):
+        """the minimum is kept, no matter how slow the cluster is
+
+        """
+        self.autoscaler.report(0, running=10, latency=2)
+
+        self.assertEqual(
+            self.autoscaler.desired_connections([0], 100, now=0), 6)
+        self.assertEqual(
+            self.autoscaler.desired_connections([0], 0, now=0), 2)
+
+    def test_shrinks_slowly(self):
+        """connections are removed one by one once the load stays low
+
+        """
+        slots = [0, 1, 2, 3]
+
+        self.assertEqual(self.autoscaler.desired_connections(slots, 0, 0), 4)
+        self.assertEqual(self.autoscaler.desired_connections(slots, 0, 29), 4)
+        self.assertEqual(self.autoscaler.desired_connections(slots, 0, 30), 3)
+        self.assertEqual(
+            self.autoscaler.desired_connections(slots[:3], 0, 31), 3)
+        self.assertEqual(
+            self.autoscaler.desired_connections(slots[:3], 0, 60), 2)
+
+        # load in between starts the waiting over
+        slots = [0, 1, 2]
+        self.autoscaler.report(0, running=15)
+        self.assertEqual(self.autoscaler.desired_connections(slots, 0, 70), 3)
+        self.autoscaler.reset(0)
+        self.assertEqual(self.autoscaler.desired_connections(slots, 0, 80), 3)
+        self.assertEqual(
+            self.autoscaler.desired_connections(slots, 0, 100), 3)
+        self.assertEqual(
+            self.autoscaler.desired_connections(slots, 0, 110), 2)
+
+    def test_latency(self):
+        """the latency is averaged over the connections that reported one
+
+        """
+        self.autoscaler.report(0, latency=.1)
+        self.autoscaler.report(2, latency=.3)
+
+        self.assertAlmostEqual(self.autoscaler.latency([0, 1, 2]), .2)
+        self.assertEqual(self.autoscaler.latency([1]), 0)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Test disk_cache.py
+
+"""
+import os
+import time
+import hashlib
+import pathlib
+import tempfile
+import unittest
+
+try:
+    from modules.disk_cache import DiskCache
+except ImportError:
+    import sys
+    sys.path.append('../../..')
+    from modules.disk_cache import DiskCache
+
+
+def sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+class Test_DiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.directory = pathlib.Path(self.tmp_dir.name)
+        self.cache = DiskCache(self.directory, 1000)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_store_and_open(self):
+        """stored objects can be read back
+
+        """
+        data = os.urandom(500)
+        self.assertIsNone(self.cache.open(sha1(data)))
+        self.assertTrue(self.cache.store(sha1(data), data))
+
+        contents = self.cache.open(sha1(data))
+        self.assertEqual(bytes(contents), data)
+
+        stats = self.cache.statistics()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["bytes"], 500)
+
+    def test_empty_object(self):
+        """empty objects can be stored
+
+        """
+        self.assertTrue(self.cache.store(sha1(b""), b""))
+        self.assertEqual(self.cache.open(sha1(b"")), b"")
+
+    def test_wrong_sha1sum(self):
+        """objects that do not match their sha1sum are not stored
+
+        """
+        self.assertFalse(self.cache.store(sha1(b"other"), b"data"))
+        self.assertFalse(self.cache.store("not a sha1sum", b"data"))
+        self.assertIsNone(self.cache.open(sha1(b"other")))
+
+    def test_known_sha1sum(self):
+        """a sha1sum that comes with the data is not checked again
+
+        """
+        data = os.urandom(100)
+        self.assertTrue(self.cache.store(sha1(data), data, check_sha1sum=False))
+        self.assertEqual(bytes(self.cache.open(sha1(data))), data)
+
+    def test_survives_restart(self):
+        """a new cache in the same directory knows the stored objects
+
+        """
+        data = os.urandom(100)
+        self.cache.store(sha1(data), data)
+
+        cache = DiskCache(self.directory, 1000)
+        self.assertEqual(cache.statistics()["bytes"], 100)
+        self.assertEqual(bytes(cache.open(sha1(data))), data)
+
+    def test_least_recently_used_is_evicted(self):
+        """the oldest objects are removed when the cache is full
+
+        """
+        first = os.urandom(400)
+        second = os.urandom(400)
+        third = os.urandom(400)
+
+        self.cache.store(sha1(first), first)
+        self.cache.store(sha1(second), second)
+
+        # make the first object the most recently used one
+        old = time.time() - 100
+        os.utime(str(self.directory / sha1(second)[:2] / sha1(second)),
+                 (old, old))
+
+        self.cache.store(sha1(third), third)
+
+        self.assertIsNotNone(self.cache.open(sha1(first)))
+        self.assertIsNone(self.cache.open(sha1(second)))
+        self.assertIsNotNone(self.cache.open(sha1(third)))
+        self.assertEqual(self.cache.statistics()["bytes"], 800)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
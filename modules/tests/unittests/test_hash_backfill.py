@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Test hash_backfill.py
+
+"""
+import json
+import asyncio
+import pathlib
+import tempfile
+import unittest
+
+try:
+    from modules.hash_backfill import HashBackfill
+except ImportError:
+    import sys
+    sys.path.append('../../..')
+    from modules.hash_backfill import HashBackfill
+
+
+class Test_HashBackfill(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.progress_file = pathlib.Path(self.tmp_dir.name) / "progress.jsonl"
+
+        # the parts under test do not need a connection to the cluster
+        self.backfill = object.__new__(HashBackfill)
+        self.backfill._progress_file = self.progress_file
+        self.backfill._loop = asyncio.new_event_loop()
+        self.backfill._throttle_time = 0
+
+    def tearDown(self):
+        self.backfill._loop.close()
+        self.tmp_dir.cleanup()
+
+    def test_load_progress(self):
+        """objects done by an interrupted run are skipped
+
+        """
+        with self.progress_file.open("w") as progress:
+            progress.write(json.dumps(["namespace", "object"]) + "\n")
+            progress.write(json.dumps(["name\tspace", "obj\nect"]) + "\n")
+            progress.write('["namespace", "obj')    # interrupted write
+
+        done = self.backfill._load_progress(restart=False)
+        self.assertEqual(
+            done, {("namespace", "object"), ("name\tspace", "obj\nect")})
+
+    def test_restart(self):
+        """a restart forgets the progress of the interrupted run
+
+        """
+        self.progress_file.write_text(json.dumps(["namespace", "object"]))
+
+        self.assertEqual(self.backfill._load_progress(restart=True), set())
+        self.assertFalse(self.progress_file.exists())
+
+    def test_throttle(self):
+        """reading is spread out to stay below the maximum rate
+
+        """
+        self.backfill._max_rate = 1000
+
+        async def read_three_times():
+            start = self.backfill._loop.time()
+            await self.backfill._throttle(100)
+            await self.backfill._throttle(100)
+            await self.backfill._throttle(100)
+            return self.backfill._loop.time() - start
+
+        duration = self.backfill._loop.run_until_complete(read_three_times())
+        self.assertGreaterEqual(duration, .19)
+        self.assertLess(duration, .5)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
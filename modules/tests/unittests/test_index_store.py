@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Test index_store.py
+
+"""
+import pickle
+import unittest
+
+try:
+    from modules.index_store import IndexStore
+except ImportError:
+    import sys
+    sys.path.append('../../..')
+    from modules.index_store import IndexStore
+
+
+SHA1SUM = "0123456789abcdef0123456789abcdef01234567"
+OTHER_SHA1SUM = "fedcba9876543210fedcba9876543210fedcba98"
+
+
+class Test_IndexStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = IndexStore()
+        self.store.add(
+            "ns", "universe.fo.ta.nodes@1.000000",
+            ["1.000000", "ta", "nodes"], SHA1SUM)
+        self.store.add(
+            "ns", "universe.fo.ta.skin.c3d6.c3d6@1.000000",
+            ["1.000000", "ta", "skin", "c3d6", "c3d6"], "")
+        self.store.add(
+            "ns", "universe.fo.ta.nodal.NT11@2.000000",
+            ["2.000000", "ta", "nodal", "NT11"], "SOMEHASH")
+
+    def test_nested(self):
+        """the nested view has a leaf for every file
+
+        """
+        expected = {
+            "1.000000": {
+                "ta": {
+                    "nodes": {
+                        "object_key": "universe.fo.ta.nodes@1.000000",
+                        "sha1sum": SHA1SUM
+                    },
+                    "skin": {
+                        "c3d6": {
+                            "c3d6": {
+                                "object_key":
+                                    "universe.fo.ta.skin.c3d6.c3d6@1.000000",
+                                "sha1sum": ""
+                            }
+                        }
+                    }
+                }
+            },
+            "2.000000": {
+                "ta": {
+                    "nodal": {
+                        "NT11": {
+                            "object_key": "universe.fo.ta.nodal.NT11@2.000000",
+                            "sha1sum": "SOMEHASH"
+                        }
+                    }
+                }
+            }
+        }
+        self.assertEqual(self.store.nested("ns"), expected)
+        self.assertEqual(self.store.nested("other"), {})
+
+    def test_sha1sums(self):
+        """hex and other sha1sums come back as they were stored
+
+        """
+        self.assertEqual(
+            self.store.get_sha1sum("ns", "universe.fo.ta.nodes@1.000000"),
+            SHA1SUM)
+        self.assertEqual(
+            self.store.get_sha1sum(
+                "ns", "universe.fo.ta.skin.c3d6.c3d6@1.000000"),
+            "")
+        self.assertIsNone(self.store.get_sha1sum("ns", "missing"))
+
+        self.store.set_sha1sum(
+            "ns", "universe.fo.ta.nodal.NT11@2.000000", OTHER_SHA1SUM)
+        self.store.set_sha1sum(
+            "ns", "universe.fo.ta.nodes@1.000000", SHA1SUM.upper())
+        self.assertEqual(
+            dict(self.store.entries("ns")),
+            {
+                "universe.fo.ta.nodes@1.000000": SHA1SUM.upper(),
+                "universe.fo.ta.skin.c3d6.c3d6@1.000000": "",
+                "universe.fo.ta.nodal.NT11@2.000000": OTHER_SHA1SUM
+            })
+
+    def test_remove(self):
+        """the last row takes the place of a removed file
+
+        """
+        self.assertTrue(
+            self.store.remove("ns", "universe.fo.ta.nodes@1.000000"))
+        self.assertFalse(
+            self.store.remove("ns", "universe.fo.ta.nodes@1.000000"))
+
+        self.assertFalse(
+            self.store.contains("ns", "universe.fo.ta.nodes@1.000000"))
+        self.assertEqual(self.store.count("ns"), 2)
+        self.assertEqual(
+            self.store.get_sha1sum("ns", "universe.fo.ta.nodal.NT11@2.000000"),
+            "SOMEHASH")
+        self.assertEqual(
+            list(self.store.nested("ns")["2.000000"]["ta"]["nodal"].keys()),
+            ["NT11"])
+
+        self.store.remove("ns", "universe.fo.ta.nodal.NT11@2.000000")
+        self.store.remove("ns", "universe.fo.ta.skin.c3d6.c3d6@1.000000")
+        self.assertFalse(self.store.has_namespace("ns"))
+        self.assertEqual(self.store.count(), 0)
+
+    def test_nested_query(self):
+        """only the files that match a query are in the nested view
+
+        """
+        self.assertEqual(
+            list(self.store.nested("ns", timesteps=(1.5, None)).keys()),
+            ["2.000000"])
+        self.assertEqual(
+            list(self.store.nested("ns", timesteps=(None, 1)).keys()),
+            ["1.000000"])
+        self.assertEqual(
+            self.store.nested("ns", simtype="ta", usage="skin"),
+            {
+                "1.000000": {
+                    "ta": {
+                        "skin": self.store.nested("ns")["1.000000"]["ta"][
+                            "skin"]
+                    }
+                }
+            })
+        self.assertEqual(
+            list(self.store.nested("ns", fieldname="NT11").keys()),
+            ["2.000000"])
+        # the skintype is not a fieldname
+        self.assertEqual(self.store.nested("ns", fieldname="c3d6"), {})
+        self.assertEqual(self.store.nested("ns", simtype="ma"), {})
+
+    def test_pickle(self):
+        """a pickled store can be changed after loading
+
+        """
+        store = pickle.loads(pickle.dumps(self.store))
+
+        self.assertEqual(store.nested("ns"), self.store.nested("ns"))
+
+        store.add(
+            "new", "universe.fo.ta.nodes@1.000000",
+            ["1.000000", "ta", "nodes"], OTHER_SHA1SUM)
+        self.assertTrue(store.remove("ns", "universe.fo.ta.nodes@1.000000"))
+        self.assertEqual(sorted(store.namespaces()), ["new", "ns"])
+        self.assertEqual(store.count(), 3)
+
+    def test_copy(self):
+        """a copy does not change with the store
+
+        """
+        expected = self.store.nested("ns")
+        store = self.store.copy()
+
+        self.store.add(
+            "ns", "universe.fo.ta.nodes@3.000000",
+            ["3.000000", "ta", "nodes"], SHA1SUM)
+        self.store.set_sha1sum(
+            "ns", "universe.fo.ta.skin.c3d6.c3d6@1.000000", OTHER_SHA1SUM)
+        self.assertTrue(
+            self.store.remove("ns", "universe.fo.ta.nodes@1.000000"))
+
+        self.assertEqual(store.nested("ns"), expected)
+        self.assertEqual(store.count(), 3)
+        self.assertEqual(
+            pickle.loads(pickle.dumps(store)).nested("ns"), expected)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
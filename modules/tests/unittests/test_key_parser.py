@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Test key_parser.py
+
+"""
+import unittest
+
+try:
+    from modules.key_parser import ParsedKey, parse_key, index_path
+except ImportError:
+    import sys
+    sys.path.append('../../..')
+    from modules.key_parser import ParsedKey, parse_key, index_path
+
+
+class Test_KeyParser(unittest.TestCase):
+
+    def test_index_paths(self):
+        """every typical filetype has its path in the index
+
+        """
+        timestep = "0000000001.000000"
+        expected = {
+            "universe.fo.ta.nodes": ["ta", "nodes"],
+            "universe.fo.ta.boundingbox": ["ta", "boundingbox"],
+            "universe.fo.ta.elements.c3d8": ["ta", "elements", "c3d8"],
+            "universe.fo.ma.elementactivationbitmap.c3d6": [
+                "ma", "elementactivationbitmap", "c3d6"],
+            "universe.fo.ta.skin.outer.c3d8": ["ta", "skin", "outer", "c3d8"],
+            "universe.fo.ta.elset.top.c3d8": ["ta", "elset", "top", "c3d8"],
+            "universe.fo.ta.nset.top": ["ta", "nset", "top"],
+            "universe.fo.ta.nodal.NT11": ["ta", "nodal", "NT11"],
+            "universe.fo.ta.nodal.NT11.c3d8": ["ta", "nodal", "NT11"],
+            "universe.fo.ma.elemental.S.c3d8": ["ma", "elemental", "S", "c3d8"],
+            "universe.fo.ma.elemental.S": ["ma", "elemental", "S", None]
+        }
+        for objects, path in expected.items():
+            key = "{}@{}".format(objects, timestep)
+            self.assertEqual(index_path(key), [timestep] + path, key)
+            # the second time the objects come from the table
+            self.assertEqual(index_path(key), [timestep] + path, key)
+
+    def test_parse_key(self):
+        """the parts of a key are named
+
+        """
+        self.assertEqual(
+            parse_key("universe.fo.ta.skin.outer.c3d8@0000000001.000000"),
+            ParsedKey(
+                timestep="0000000001.000000", simtype="ta", usage="skin",
+                fieldname=None, elemtype="c3d8", skintype="outer"))
+        self.assertEqual(
+            parse_key("universe.fo.ma.elset.top.c3d6@2"),
+            ParsedKey(
+                timestep="2", simtype="ma", usage="elset",
+                fieldname="top", elemtype="c3d6", skintype=None))
+
+    def test_unparseable_keys(self):
+        """keys that do not follow the grammar are not parsed
+
+        """
+        for key in [
+                "",
+                "some_file",
+                "universe.fo.ta.nodes",
+                "universe.fo.ta.nodes@1@2",
+                "universe.fo.xx.nodes@1",
+                "universe.fo.ta@1",
+                "universe.fo.ta.unknown@1",
+                "universe.fo.ta.skin.outer@1",
+                "universe.fo.ta.elements@1",
+                "universe.fo.ta.nodal@1"
+        ]:
+            self.assertIsNone(index_path(key), key)
+            self.assertIsNone(parse_key(key), key)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
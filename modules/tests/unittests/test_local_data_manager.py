@@ -4,15 +4,22 @@ Test local_data_instance
 
 """
 import time
+import queue
+import asyncio
+import pathlib
+import tempfile
 import unittest
 import multiprocessing
+import concurrent.futures
 
 try:
     from modules.local_data_manager import LocalDataManager
+    from modules.presence_filter import PresenceFilter
 except ImportError:
     import sys
     sys.path.append('../../..')
     from modules.local_data_manager import LocalDataManager
+    from modules.presence_filter import PresenceFilter
 
 from util.loggers import CoreLog as cl, BackendLog as bl, SimulationLog as sl
 
@@ -162,7 +169,7 @@ class Test_Local_Data_Manager(unittest.TestCase):
 
         self.event_datacopy_backend_get_index.set()
 
-        res = self.queue_datacopy_backend_index_data.get(True, 1)
+        res = self.queue_datacopy_backend_index_data.get(True, 1)["index"]
         self.assertEqual(res, expected_index)
         self.assertNotEqual(res, different_expected_index)
 
@@ -185,7 +192,7 @@ class Test_Local_Data_Manager(unittest.TestCase):
 
         self.event_datacopy_backend_get_index.set()
 
-        res = self.queue_datacopy_backend_index_data.get(True, 1)
+        res = self.queue_datacopy_backend_index_data.get(True, 1)["index"]
         self.assertEqual(res, expected_index)
 
     def test_update_hash_from_ceph(self):
@@ -207,7 +214,7 @@ class Test_Local_Data_Manager(unittest.TestCase):
 
         self.event_datacopy_backend_get_index.set()
 
-        res = self.queue_datacopy_backend_index_data.get(True, 1)
+        res = self.queue_datacopy_backend_index_data.get(True, 1)["index"]
         self.assertEqual(res, expected_index)
 
     def test_have_hash_right_from_start(self):
@@ -223,7 +230,7 @@ class Test_Local_Data_Manager(unittest.TestCase):
 
         self.event_datacopy_backend_get_index.set()
 
-        res = self.queue_datacopy_backend_index_data.get(True, 1)
+        res = self.queue_datacopy_backend_index_data.get(True, 1)["index"]
         self.assertEqual(res, expected_index)
 
     def test_add_every_typical_filetype(self):
@@ -309,9 +316,507 @@ class Test_Local_Data_Manager(unittest.TestCase):
 
         self.event_datacopy_backend_get_index.set()
 
-        res = self.queue_datacopy_backend_index_data.get(True, 1)
+        res = self.queue_datacopy_backend_index_data.get(True, 1)["index"]
         self.assertEqual(res, expected_res)
 
 
+class Test_Local_Data_Manager_Snapshot(unittest.TestCase):
+    def setUp(self):
+        LocalDataManager._reset()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.snapshot_file = pathlib.Path(self.tmp_dir.name) / "index.pickle"
+        LocalDataManager._index_snapshot_file = self.snapshot_file
+
+    def tearDown(self):
+        LocalDataManager._reset()
+        self.tmp_dir.cleanup()
+
+    def test_snapshot_roundtrip(self):
+        """write the local copy to a snapshot and read it back
+
+        """
+        namespace = "some_namespace"
+        nodes = "universe.fo.ta.nodes@0000000001.000000"
+        skin = "universe.fo.ma.skin.outer.c3d8@0000000001.000000"
+
+        LocalDataManager.add_file(namespace, nodes, "NODESHASH")
+        LocalDataManager.add_file(namespace, skin, "SKINHASH")
+        expected_index = LocalDataManager.get_index()
+        expected_versions = LocalDataManager.get_namespace_versions()
+
+        self.assertTrue(LocalDataManager.write_index_snapshot())
+
+        LocalDataManager._reset()
+        LocalDataManager._index_snapshot_file = self.snapshot_file
+
+        self.assertTrue(LocalDataManager.load_index_snapshot())
+        self.assertEqual(LocalDataManager.get_index(), expected_index)
+        self.assertEqual(
+            LocalDataManager.get_namespace_versions(), expected_versions)
+        self.assertTrue(LocalDataManager.name_is_present(namespace, nodes))
+        self.assertTrue(LocalDataManager.name_is_present(namespace, skin))
+
+    def test_snapshot_in_executor(self):
+        """the snapshot is written from a copy in the executor, changes in the
+        meantime go into the next one
+
+        """
+        namespace = "some_namespace"
+        nodes = "universe.fo.ta.nodes@0000000001.000000"
+        skin = "universe.fo.ma.skin.outer.c3d8@0000000001.000000"
+
+        loop = asyncio.new_event_loop()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        LocalDataManager._loop = loop
+        LocalDataManager._index_snapshot_executor = executor
+        self.addCleanup(setattr, LocalDataManager, "_loop", None)
+        self.addCleanup(
+            setattr, LocalDataManager, "_index_snapshot_executor", None)
+        self.addCleanup(loop.close)
+        self.addCleanup(executor.shutdown)
+
+        LocalDataManager.add_file(namespace, nodes, "NODESHASH")
+
+        async def write_and_change():
+            writing = loop.create_task(
+                LocalDataManager._write_index_snapshot_coro(LocalDataManager))
+            # the copy is taken, the snapshot is being written
+            await asyncio.sleep(0)
+            LocalDataManager.add_file(namespace, skin, "SKINHASH")
+            return await writing
+
+        self.assertTrue(loop.run_until_complete(write_and_change()))
+        self.assertTrue(LocalDataManager._index_dirty)
+
+        LocalDataManager._reset()
+        LocalDataManager._index_snapshot_file = self.snapshot_file
+
+        self.assertTrue(LocalDataManager.load_index_snapshot())
+        self.assertTrue(LocalDataManager.name_is_present(namespace, nodes))
+        self.assertFalse(LocalDataManager.name_is_present(namespace, skin))
+
+    def test_presence_file(self):
+        """the names are written next to the snapshot for other processes
+
+        """
+        namespace = "some_namespace"
+        nodes = "universe.fo.ta.nodes@0000000001.000000"
+        skin = "universe.fo.ma.skin.outer.c3d8@0000000001.000000"
+
+        LocalDataManager.add_file(namespace, nodes, "NODESHASH")
+        LocalDataManager.add_file(namespace, skin, "SKINHASH")
+        LocalDataManager.remove_file(namespace, skin)
+
+        # built when the snapshot is written
+        self.assertFalse(LocalDataManager.get_presence_file().exists())
+        self.assertTrue(LocalDataManager.write_index_snapshot())
+
+        presence_filter = PresenceFilter.open(
+            LocalDataManager.get_presence_file())
+        self.assertTrue(presence_filter.might_contain(namespace, nodes))
+        self.assertFalse(presence_filter.might_contain(namespace, skin))
+        self.assertFalse(presence_filter.might_contain("other", nodes))
+        presence_filter._bits.release()
+
+        LocalDataManager._reset()
+        LocalDataManager._index_snapshot_file = self.snapshot_file
+
+        self.assertTrue(LocalDataManager.load_index_snapshot())
+        self.assertTrue(LocalDataManager.name_is_present(namespace, nodes))
+        self.assertFalse(LocalDataManager.name_is_present(namespace, skin))
+
+    def test_presence_file_updates(self):
+        """the presence filter is only built anew when the changes are not
+        known anymore or too many files are gone
+
+        """
+        namespace = "some_namespace"
+        nodes = "universe.fo.ta.nodes@0000000001.000000"
+        skin = "universe.fo.ma.skin.outer.c3d8@0000000001.000000"
+
+        def written_filter_contains(key):
+            presence_filter = PresenceFilter.open(
+                LocalDataManager.get_presence_file())
+            try:
+                return presence_filter.might_contain(namespace, key)
+            finally:
+                presence_filter._bits.release()
+
+        LocalDataManager.add_file(namespace, nodes, "NODESHASH")
+        self.assertTrue(LocalDataManager.write_index_snapshot())
+        presence_filter = LocalDataManager._presence_filter
+
+        LocalDataManager.add_file(namespace, skin, "SKINHASH")
+        self.assertTrue(LocalDataManager.write_index_snapshot())
+        self.assertIs(LocalDataManager._presence_filter, presence_filter)
+        self.assertEqual(presence_filter.added, 2)
+        self.assertTrue(written_filter_contains(skin))
+
+        # the bits of a removed file stay set
+        LocalDataManager.remove_file(namespace, skin)
+        self.assertTrue(LocalDataManager.write_index_snapshot())
+        self.assertIs(LocalDataManager._presence_filter, presence_filter)
+        self.assertEqual(presence_filter.removed, 1)
+
+        # the change log does not reach back far enough
+        LocalDataManager._index_changes.clear()
+        LocalDataManager.add_file(namespace, skin, "SKINHASH")
+        LocalDataManager._index_changes.clear()
+        self.assertTrue(LocalDataManager.write_index_snapshot())
+        self.assertIsNot(LocalDataManager._presence_filter, presence_filter)
+        self.assertEqual(LocalDataManager._presence_filter.added, 2)
+        self.assertTrue(written_filter_contains(skin))
+
+    def test_query_index(self):
+        """a query returns the matching part of the index
+
+        """
+        nodes = "universe.fo.ta.nodes@0000000001.000000"
+        skin = "universe.fo.ma.skin.outer.c3d8@0000000002.000000"
+        field = "universe.fo.ma.nodal.U@0000000002.000000"
+
+        for namespace in ["some_namespace", "other_namespace"]:
+            LocalDataManager.add_file(namespace, nodes, "NODESHASH")
+            LocalDataManager.add_file(namespace, skin, "SKINHASH")
+            LocalDataManager.add_file(namespace, field, "FIELDHASH")
+
+        self.assertEqual(
+            LocalDataManager.query_index()["index"],
+            LocalDataManager.get_index())
+
+        answer = LocalDataManager.query_index({
+            "namespace": "some_namespace",
+            "timesteps": [2, None],
+            "usage": "nodal",
+            "fieldname": "U"
+        })
+        self.assertEqual(
+            answer["index"],
+            {
+                "some_namespace": {
+                    "0000000002.000000": {
+                        "ma": {
+                            "nodal": {
+                                "U": {
+                                    "object_key": field,
+                                    "sha1sum": "FIELDHASH"
+                                }
+                            }
+                        }
+                    }
+                }
+            })
+        self.assertEqual(
+            answer["namespace_states"], {"some_namespace": "ready"})
+
+        self.assertEqual(
+            LocalDataManager.query_index({"namespace": "gone"})["index"], {})
+        self.assertEqual(
+            sorted(LocalDataManager.query_index({"simtype": "ta"})["index"]),
+            ["other_namespace", "some_namespace"])
+
+        for query in [
+                {"timesteps": "all"},
+                {"timesteps": [1]},
+                {"usage": 3},
+                {"colour": "blue"},
+                "some_namespace"
+        ]:
+            answer = LocalDataManager.query_index(query)
+            self.assertEqual(answer["index"], {})
+            self.assertIn("error", answer)
+
+    def test_index_changes(self):
+        """the changes since a version replace the whole index
+
+        """
+        namespace = "some_namespace"
+        nodes = "universe.fo.ta.nodes@0000000001.000000"
+        skin = "universe.fo.ma.skin.outer.c3d8@0000000001.000000"
+        field = "universe.fo.ma.nodal.U@0000000002.000000"
+
+        LocalDataManager.add_file(namespace, nodes, "NODESHASH")
+        LocalDataManager.add_file(namespace, skin, "SKINHASH")
+
+        answer = LocalDataManager.query_index()
+        index_id, version = answer["index_id"], answer["version"]
+        self.assertEqual(
+            (index_id, version), LocalDataManager.get_index_version())
+
+        # nothing has changed
+        answer = LocalDataManager.query_index(None, version, index_id)
+        self.assertNotIn("index", answer)
+        self.assertEqual(answer["changes"], {"added": [], "removed": []})
+
+        LocalDataManager.add_file(namespace, field, "")
+        LocalDataManager.add_file(namespace, field, "FIELDHASH")
+        LocalDataManager.remove_file(namespace, skin)
+        LocalDataManager.add_file("other_namespace", nodes, "")
+        LocalDataManager.remove_file("other_namespace", nodes)
+
+        answer = LocalDataManager.query_index(None, version, index_id)
+        self.assertEqual(answer["version"], version + 5)
+        self.assertEqual(
+            answer["changes"]["added"],
+            [{
+                "namespace": namespace,
+                "object_key": field,
+                "sha1sum": "FIELDHASH",
+                "path": ["0000000002.000000", "ma", "nodal", "U"]
+            }])
+        self.assertEqual(
+            sorted(
+                (change["namespace"], change["object_key"])
+                for change in answer["changes"]["removed"]),
+            [("other_namespace", nodes), (namespace, skin)])
+
+        # the changes of a query only contain the matching files
+        answer = LocalDataManager.query_index(
+            {"namespace": "other_namespace"}, version, index_id)
+        self.assertEqual(answer["changes"]["added"], [])
+        self.assertEqual(len(answer["changes"]["removed"]), 1)
+
+        # unknown or forgotten versions get the whole index
+        for since, answer_id in [
+                (version, "other run"),
+                (version + 6, index_id),
+                ("all", index_id)
+        ]:
+            answer = LocalDataManager.query_index(None, since, answer_id)
+            self.assertEqual(answer["index"], LocalDataManager.get_index())
+            self.assertNotIn("changes", answer)
+
+        # the change of the first file is forgotten
+        LocalDataManager._index_changes.popleft()
+        answer = LocalDataManager.query_index(None, version - 2, index_id)
+        self.assertIn("index", answer)
+        answer = LocalDataManager.query_index(None, version - 1, index_id)
+        self.assertIn("changes", answer)
+
+    def test_missing_snapshot(self):
+        """starting without a snapshot leaves the local copy empty
+
+        """
+        self.assertFalse(LocalDataManager.load_index_snapshot())
+        self.assertEqual(LocalDataManager.get_index(), {})
+
+    def test_reconcile_removes_deleted_files(self):
+        """files missing from a fresh index are removed
+
+        """
+        namespace = "some_namespace"
+        nodes = "universe.fo.ta.nodes@0000000001.000000"
+        elements = "universe.fo.ta.elements.c3d8@0000000001.000000"
+
+        LocalDataManager.add_file(namespace, nodes, "NODESHASH")
+        LocalDataManager.add_file(namespace, elements, "ELEMENTSHASH")
+
+        # a fresh index that only contains the nodes with a new hash
+        LocalDataManager._begin_reindex()
+        LocalDataManager._set_index_namespaces([namespace])
+        LocalDataManager.add_file(namespace, nodes, "NEWHASH")
+        LocalDataManager._reconcile_namespace(namespace)
+        LocalDataManager._reconcile_index()
+
+        expected_index = {
+            '0000000001.000000': {
+                'ta': {
+                    'nodes': {
+                        'object_key': nodes, 'sha1sum': 'NEWHASH'
+                    }
+                }
+            }
+        }
+        self.assertEqual(LocalDataManager.get_index(namespace), expected_index)
+        self.assertFalse(LocalDataManager.name_is_present(namespace, elements))
+
+        # the reconciled index has been written to disk
+        self.assertTrue(self.snapshot_file.exists())
+
+    def test_reindex_failed(self):
+        """an index that could not be read keeps the local copy and can be
+        read again right away
+
+        """
+        nodes = "universe.fo.ta.nodes@0000000001.000000"
+
+        hash_requests = queue.Queue()
+        LocalDataManager._queue_datacopy_ceph_request_hash_for_new_file = (
+            hash_requests)
+        self.addCleanup(
+            setattr, LocalDataManager,
+            "_queue_datacopy_ceph_request_hash_for_new_file", None)
+
+        LocalDataManager.add_file("done", nodes, "NODESHASH")
+        LocalDataManager.add_file("pending", nodes, "NODESHASH")
+        LocalDataManager.add_file("unlisted", nodes, "NODESHASH")
+
+        LocalDataManager._begin_reindex()
+        LocalDataManager._set_index_namespaces(["done", "pending"])
+        LocalDataManager.add_file("done", nodes, "NODESHASH")
+        LocalDataManager._reconcile_namespace("done")
+        LocalDataManager._reconcile_index(failed=True)
+
+        self.assertIsNone(LocalDataManager._reindex_seen)
+        self.assertEqual(LocalDataManager.get_namespace_states(), {
+            "done": "ready",
+            "pending": "failed",
+            "unlisted": "ready"
+        })
+        for namespace in ["done", "pending", "unlisted"]:
+            self.assertTrue(LocalDataManager.name_is_present(namespace, nodes))
+
+        # new files are not taken for a part of the failed index
+        LocalDataManager.add_file("new", nodes, "NODESHASH")
+        self.assertIsNone(LocalDataManager._reindex_seen)
+
+        self.assertTrue(LocalDataManager.refresh_index())
+        self.assertEqual(hash_requests.get(False), {"refresh_index": True})
+
+    def test_namespaces_ready_one_by_one(self):
+        """every namespace is ready as soon as its index has arrived
+
+        """
+        nodes = "universe.fo.ta.nodes@0000000001.000000"
+        elements = "universe.fo.ta.elements.c3d8@0000000001.000000"
+
+        LocalDataManager.add_file("done", nodes, "NODESHASH")
+        LocalDataManager.add_file("done", elements, "ELEMENTSHASH")
+        LocalDataManager.add_file("slow", nodes, "NODESHASH")
+        LocalDataManager.add_file("gone", nodes, "NODESHASH")
+        LocalDataManager.write_index_snapshot()
+        LocalDataManager._reset()
+        LocalDataManager._index_snapshot_file = self.snapshot_file
+        LocalDataManager.load_index_snapshot()
+
+        self.assertEqual(
+            LocalDataManager.get_namespace_states(),
+            {"done": "stale", "slow": "stale", "gone": "stale"})
+
+        LocalDataManager._begin_reindex()
+
+        # a small namespace can be done before the list of namespaces arrives
+        LocalDataManager.add_files("done", [nodes], ["NODESHASH"])
+        LocalDataManager._reconcile_namespace("done")
+        LocalDataManager._set_index_namespaces(["done", "slow", "failing"])
+
+        self.assertEqual(
+            LocalDataManager.get_namespace_states(),
+            {"done": "ready", "slow": "indexing", "gone": "stale",
+             "failing": "indexing"})
+        self.assertEqual(
+            list(LocalDataManager.iter_index_entries("done")),
+            [(nodes, "NODESHASH")])
+
+        LocalDataManager.add_files("slow", [nodes], ["NEWHASH"])
+        LocalDataManager._reconcile_namespace("slow")
+        LocalDataManager._reconcile_namespace("failing", failed=True)
+        LocalDataManager._reconcile_index()
+
+        self.assertEqual(
+            LocalDataManager.get_namespace_states(),
+            {"done": "ready", "slow": "ready", "failing": "failed"})
+        self.assertEqual(
+            list(LocalDataManager.iter_index_entries("slow")),
+            [(nodes, "NEWHASH")])
+        self.assertEqual(LocalDataManager.get_index("gone"), {})
+
+    def test_refresh_index(self):
+        """a refresh only asks for the tags of new files
+
+        """
+        nodes = "universe.fo.ta.nodes@0000000001.000000"
+        elements = "universe.fo.ta.elements.c3d8@0000000001.000000"
+        skin = "universe.fo.ta.skin.outer.c3d8@0000000001.000000"
+        new_nodes = "universe.fo.ta.nodes@0000000002.000000"
+
+        requests = queue.Queue()
+        LocalDataManager._queue_datacopy_ceph_request_hash_for_new_file = (
+            requests)
+
+        LocalDataManager.add_file("known", nodes, "NODESHASH")
+        LocalDataManager.add_file("known", elements, "ELEMENTSHASH")
+        LocalDataManager.add_file("known", skin, "")
+
+        self.assertTrue(LocalDataManager.refresh_index())
+        self.assertFalse(LocalDataManager.refresh_index())
+        self.assertEqual(requests.get(False), {"refresh_index": True})
+
+        LocalDataManager._set_index_namespaces(["known", "new"])
+        LocalDataManager.add_listed_files(
+            "known", [nodes, skin, new_nodes, "not a simulation file"])
+        LocalDataManager.add_listed_files("new", [nodes])
+
+        LocalDataManager._reconcile_namespace("known")
+        LocalDataManager._reconcile_namespace("new")
+        LocalDataManager._reconcile_index()
+
+        request = requests.get(False)
+        self.assertEqual(request["namespace"], "known")
+        self.assertEqual(sorted(request["keys"]), [new_nodes, skin])
+        self.assertEqual(
+            requests.get(False), {"namespace": "new", "keys": [nodes]})
+        self.assertFalse(LocalDataManager.name_is_present("known", elements))
+        self.assertEqual(
+            LocalDataManager.get_namespace_states(),
+            {"known": "ready", "new": "indexing"})
+
+        LocalDataManager.add_files("new", [nodes], ["NODESHASH"])
+        LocalDataManager._namespace_refreshed("new")
+
+        self.assertEqual(
+            LocalDataManager.get_namespace_states(),
+            {"known": "ready", "new": "ready"})
+        self.assertEqual(
+            list(LocalDataManager.iter_index_entries("new")),
+            [(nodes, "NODESHASH")])
+
+    def test_add_files(self):
+        """a batch of files is added like single files
+
+        """
+        namespace = "some_namespace"
+        nodes = "universe.fo.ta.nodes@0000000001.000000"
+        elements = "universe.fo.ta.elements.c3d8@0000000001.000000"
+
+        LocalDataManager.add_file(namespace, nodes, "NODESHASH")
+
+        changed = LocalDataManager.add_files(
+            namespace,
+            [nodes, elements, "not a simulation file"],
+            ["NODESHASH", "ELEMENTSHASH", "OTHERHASH"])
+
+        self.assertEqual(changed, 1)
+        self.assertEqual(
+            sorted(LocalDataManager.iter_index_entries(namespace)),
+            [(elements, "ELEMENTSHASH"), (nodes, "NODESHASH")])
+
+    def test_removed_file_reaches_backend(self):
+        """files removed through the change feed are forwarded to the backend
+        like new files
+
+        """
+        namespace = "some_namespace"
+        nodes = "universe.fo.ta.nodes@0000000001.000000"
+
+        backend_queue = queue.Queue()
+        LocalDataManager._queue_datacopy_backend_new_file_and_hash = (
+            backend_queue)
+        self.addCleanup(
+            setattr, LocalDataManager,
+            "_queue_datacopy_backend_new_file_and_hash", None)
+
+        added = {"namespace": namespace, "key": nodes, "sha1sum": "NODESHASH"}
+        LocalDataManager._handle_new_file(added)
+        self.assertTrue(LocalDataManager.name_is_present(namespace, nodes))
+
+        removed = dict(added, removed=True)
+        LocalDataManager._handle_new_file(removed)
+        self.assertFalse(LocalDataManager.name_is_present(namespace, nodes))
+
+        self.assertEqual(backend_queue.get(False), added)
+        self.assertEqual(backend_queue.get(False), removed)
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Test object_cache.py
+
+"""
+import unittest
+
+try:
+    from modules.object_cache import ObjectCache
+except ImportError:
+    import sys
+    sys.path.append('../../..')
+    from modules.object_cache import ObjectCache
+
+
+def request_dict(key, size, sha1sum="hash"):
+    return {
+        "namespace": "namespace",
+        "object": key,
+        "tags": {"sha1sum": sha1sum},
+        "value": b"x" * size
+    }
+
+
+class Test_ObjectCache(unittest.TestCase):
+
+    def setUp(self):
+        self.released = list()
+        self.cache = ObjectCache(100, release_callback=self.released.append)
+
+    def test_hit_and_miss(self):
+        """cached objects are returned and counted
+
+        """
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.put("a", request_dict("a", 10))
+
+        entry = self.cache.get("a")
+        self.assertEqual(entry["request_dict"]["object"], "a")
+        self.cache.unpin(entry)
+
+        stats = self.cache.statistics()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["bytes"], 10)
+
+    def test_least_recently_used_is_evicted(self):
+        """the budget is kept by evicting the least recently used object
+
+        """
+        self.cache.put("a", request_dict("a", 40))
+        self.cache.put("b", request_dict("b", 40))
+        self.cache.unpin(self.cache.get("a"))
+        self.cache.put("c", request_dict("c", 40))
+
+        self.assertIn("a", self.cache)
+        self.assertNotIn("b", self.cache)
+        self.assertIn("c", self.cache)
+        self.assertEqual(self.cache.statistics()["evictions"], 1)
+        self.assertEqual(self.cache.statistics()["bytes"], 80)
+        self.assertEqual([r["object"] for r in self.released], ["b"])
+
+    def test_pinned_entries_are_released_when_unpinned(self):
+        """an evicted object is released by its last user
+
+        """
+        entry = self.cache.put("a", request_dict("a", 60), pins=1)
+        self.cache.put("b", request_dict("b", 60))
+
+        self.assertNotIn("a", self.cache)
+        self.assertEqual(self.released, [])
+
+        self.cache.unpin(entry)
+        self.assertEqual([r["object"] for r in self.released], ["a"])
+
+    def test_too_large(self):
+        """objects larger than the cache are handed out but not stored
+
+        """
+        entry = self.cache.put("a", request_dict("a", 101), pins=1)
+
+        self.assertNotIn("a", self.cache)
+        self.assertEqual(entry["size"], 101)
+
+        self.cache.unpin(entry)
+        self.assertEqual(len(self.released), 1)
+
+    def test_sha1sum_validation(self):
+        """outdated objects are not returned
+
+        """
+        self.cache.put("a", request_dict("a", 10, "old"))
+
+        entry = self.cache.get("a", "old")
+        self.assertIsNotNone(entry)
+        self.cache.unpin(entry)
+
+        self.assertIsNone(self.cache.get("a", "new"))
+        self.assertNotIn("a", self.cache)
+
+    def test_invalidate(self):
+        """invalidation only drops objects with a different hash
+
+        """
+        self.cache.put("a", request_dict("a", 10, "old"))
+
+        self.cache.invalidate("a", "old")
+        self.assertIn("a", self.cache)
+
+        self.cache.invalidate("a", "new")
+        self.assertNotIn("a", self.cache)
+        self.assertEqual(self.cache.statistics()["bytes"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Test presence_filter.py
+
+"""
+import pickle
+import pathlib
+import tempfile
+import unittest
+
+try:
+    from modules.presence_filter import PresenceFilter
+except ImportError:
+    import sys
+    sys.path.append('../../..')
+    from modules.presence_filter import PresenceFilter
+
+
+class Test_PresenceFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.files = [
+            ("namespace_{}".format(i % 7), "universe.fo.ta.nodes@{}".format(i))
+            for i in range(5000)]
+        self.presence_filter = PresenceFilter.build(self.files, len(self.files))
+
+    def test_no_false_negatives(self):
+        """every added file might be present
+
+        """
+        for namespace, key in self.files:
+            self.assertTrue(self.presence_filter.might_contain(namespace, key))
+
+    def test_false_positives(self):
+        """only few files that are not there might be present
+
+        """
+        false_positives = sum(
+            self.presence_filter.might_contain(
+                "other", "universe.fo.ta.nodes@{}".format(i))
+            for i in range(10000))
+        self.assertLess(false_positives, 200)
+
+    def test_stable(self):
+        """a pickled filter knows the same files
+
+        """
+        presence_filter = pickle.loads(pickle.dumps(self.presence_filter))
+        for namespace, key in self.files:
+            self.assertTrue(presence_filter.might_contain(namespace, key))
+
+    def test_shared_file(self):
+        """the filter can be opened read-only from a file
+
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = pathlib.Path(tmp_dir) / "index.presence"
+            self.presence_filter.write(path)
+
+            presence_filter = PresenceFilter.open(path)
+            for namespace, key in self.files:
+                self.assertTrue(presence_filter.might_contain(namespace, key))
+            self.assertFalse(any(
+                presence_filter.might_contain(
+                    "other", "universe.fo.ta.nodes@{}".format(i))
+                != self.presence_filter.might_contain(
+                    "other", "universe.fo.ta.nodes@{}".format(i))
+                for i in range(1000)))
+
+            with self.assertRaises(TypeError):
+                presence_filter.add("other", "universe.fo.ta.nodes@1")
+
+            presence_filter._bits.release()
+
+    def test_needs_rebuild(self):
+        """a filter with many removed or too many files is rebuilt
+
+        """
+        presence_filter = PresenceFilter(capacity=10)
+        self.assertFalse(presence_filter.needs_rebuild())
+        for i in range(11):
+            presence_filter.add("namespace", str(i))
+        self.assertTrue(presence_filter.needs_rebuild())
+
+        self.assertFalse(self.presence_filter.needs_rebuild())
+        for namespace, key in self.files[:1500]:
+            self.presence_filter.discard(namespace, key)
+        self.assertTrue(self.presence_filter.needs_rebuild())
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Test shared_buffer_pool.py
+
+"""
+import os
+import unittest
+import multiprocessing
+
+try:
+    from modules.shared_buffer_pool import SharedBufferPool
+except ImportError:
+    import sys
+    sys.path.append('../../..')
+    from modules.shared_buffer_pool import SharedBufferPool
+
+
+def write_in_other_process(buffer_pool, data, descriptor_queue):
+    descriptor = buffer_pool.store(data)
+    descriptor_queue.put(descriptor)
+
+
+class Test_SharedBufferPool(unittest.TestCase):
+
+    def setUp(self):
+        self.buffer_pool = SharedBufferPool(2, 1024)
+
+    def test_store_and_view(self):
+        """stored data can be viewed
+
+        """
+        data = os.urandom(1000)
+        descriptor = self.buffer_pool.store(data)
+        self.assertEqual(descriptor["size"], len(data))
+        self.assertEqual(bytes(self.buffer_pool.view(descriptor)), data)
+
+    def test_too_large(self):
+        """data that does not fit into a slot is not stored
+
+        """
+        self.assertIsNone(self.buffer_pool.store(os.urandom(1025)))
+
+    def test_exhausted_and_release(self):
+        """released slots can be used again
+
+        """
+        first = self.buffer_pool.store(b"first")
+        second = self.buffer_pool.store(b"second")
+        self.assertNotEqual(first["slot"], second["slot"])
+        self.assertIsNone(self.buffer_pool.store(b"third"))
+
+        self.buffer_pool.release(first)
+        third = self.buffer_pool.store(b"third")
+        self.assertEqual(third["slot"], first["slot"])
+        self.assertEqual(bytes(self.buffer_pool.view(third)), b"third")
+        self.assertEqual(bytes(self.buffer_pool.view(second)), b"second")
+
+    def test_release_owned_by(self):
+        """only the slots an owner still holds are given back
+
+        """
+        held = self.buffer_pool.acquire(10, 3)
+        handed_on = self.buffer_pool.acquire(10, 3)
+        self.buffer_pool.disown(handed_on)
+        self.assertIsNone(self.buffer_pool.acquire(10, 4))
+
+        self.assertEqual(self.buffer_pool.release_owned_by(4), 0)
+        self.assertEqual(self.buffer_pool.release_owned_by(3), 1)
+        self.assertEqual(self.buffer_pool.acquire(10)["slot"], held["slot"])
+        self.assertEqual(self.buffer_pool.release_owned_by(3), 0)
+
+    def test_other_process(self):
+        """data written in another process is visible here
+
+        """
+        data = os.urandom(512)
+        descriptor_queue = multiprocessing.Queue()
+
+        writer = multiprocessing.Process(
+            target=write_in_other_process,
+            args=(self.buffer_pool, data, descriptor_queue)
+        )
+        writer.start()
+        descriptor = descriptor_queue.get(True, 5)
+        writer.join()
+
+        self.assertEqual(bytes(self.buffer_pool.view(descriptor)), data)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Test task_scheduler.py
+
+"""
+import time
+import unittest
+import multiprocessing
+
+try:
+    from modules.task_scheduler import TaskScheduler
+except ImportError:
+    import sys
+    sys.path.append('../../..')
+    from modules.task_scheduler import TaskScheduler
+
+
+def take_tasks(scheduler, count, results):
+    for _ in range(count):
+        results.put(scheduler.get(timeout=5))
+
+
+class Test_TaskScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = TaskScheduler(["data", "hashes", "index"])
+
+    def test_priority(self):
+        """the most important task is taken first
+
+        """
+        self.scheduler.put("index", "scan")
+        self.scheduler.put("hashes", "hash")
+        self.scheduler.put("data", "download")
+        self.scheduler.put("index", "scan again")
+
+        self.assertEqual(self.scheduler.get(timeout=1), ("data", "download"))
+        self.assertEqual(self.scheduler.get(timeout=1), ("hashes", "hash"))
+        self.assertEqual(self.scheduler.get(timeout=1), ("index", "scan"))
+        self.assertEqual(
+            self.scheduler.get(timeout=1), ("index", "scan again"))
+
+    def test_only_allowed_classes(self):
+        """tasks of other classes are left alone
+
+        """
+        self.scheduler.put("data", "download")
+        self.scheduler.put("index", "scan")
+
+        self.assertEqual(
+            self.scheduler.get(["hashes", "index"], timeout=1),
+            ("index", "scan"))
+        self.assertIsNone(self.scheduler.get(["hashes", "index"], timeout=.1))
+        self.assertEqual(self.scheduler.backlog()["data"], 1)
+
+    def test_timeout(self):
+        """an empty scheduler returns None after the timeout
+
+        """
+        start = time.monotonic()
+        self.assertIsNone(self.scheduler.get(timeout=.1))
+        self.assertGreaterEqual(time.monotonic() - start, .1)
+
+    def test_other_processes(self):
+        """waiting processes are woken up and every task is taken once
+
+        """
+        results = multiprocessing.Queue()
+        consumers = [
+            multiprocessing.Process(
+                target=take_tasks, args=(self.scheduler, 50, results))
+            for _ in range(2)
+        ]
+        for consumer in consumers:
+            consumer.start()
+
+        for i in range(100):
+            self.scheduler.put(["data", "hashes", "index"][i % 3], i)
+
+        taken = sorted(results.get(timeout=5)[1] for _ in range(100))
+
+        for consumer in consumers:
+            consumer.join()
+
+        self.assertEqual(taken, list(range(100)))
+        self.assertEqual(
+            self.scheduler.backlog(), {"data": 0, "hashes": 0, "index": 0})
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)